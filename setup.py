@@ -158,7 +158,7 @@ setup(
             'numpy>=1.15',
     ],
     install_requires=requirements,
-    scripts=['bin/lisflood'],
+    scripts=['bin/lisflood', 'bin/lisflood-preprocess'],
     zip_safe=True,
     classifiers=[
         # complete classifier list: http://pypi.python.org/pypi?%3Aaction=list_classifiers
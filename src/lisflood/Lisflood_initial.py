@@ -71,6 +71,23 @@ def _vegSum(ax_veg, variable, soil_fracs):
     return (soil_fracs * variable).sum(ax_veg)
 
 
+class VegetationIndexes(object):
+    """Positions of the vegetation fractions and land uses in the state arrays, resolved once at initialisation.
+    Vegetation-dimensioned arrays have the vegetation (or landuse) axis first (see allocateDataArray): the dynamic
+    parts of the modules index their values with these positions, labels are only used to read and write maps.
+        prescribed: positions of the prescribed fractions in the vegetation axis (prescribed arrays are in the same order)
+        landuse: position of each land use in the landuse axis
+        landuse_vegetation: (positions in the vegetation axis, positions in the prescribed fractions, position in the
+                            landuse axis) of the fractions of each land use (see get_indexes_from_landuse_and_veg_list_GLOBAL)
+    """
+
+    def __init__(self, model):
+        self.prescribed = np.array([model.vegetation.index(veg) for veg in model.prescribed_vegetation], dtype=int)
+        self.landuse = OrderedDict((landuse, i) for i, landuse in enumerate(model.epic_settings.soil_uses))
+        self.landuse_vegetation = [model.get_indexes_from_landuse_and_veg_list_GLOBAL(landuse, veg_list)
+                                   for landuse, veg_list in model.LANDUSE_VEGETATION.items()]
+
+
 # --------------------------------------------
 class LisfloodModel_ini(DynamicModel):
 
@@ -170,6 +187,7 @@ class LisfloodModel_ini(DynamicModel):
             self.epic_settings.landuse_vegetation["Irrigated"] += self.crop_module.irrigated_crops.tolist()
             self.interactive_vegetation += self.crop_module.simulated_crops.tolist()
         self.vegetation = self.prescribed_vegetation + self.interactive_vegetation
+        self.vegetation_indexes = VegetationIndexes(self)
 
         # --------------------------------------
 
@@ -330,14 +348,17 @@ class LisfloodModel_ini(DynamicModel):
             iveg_list.append(self.vegetation.index(veg))
         return iveg_list,iveg_list_pres,ilanduse
 
-    def allocateVariableAllVegetation(self, dtype=float):
+    def allocateVariableAllVegetation(self, dtype=None):
         """Allocate xarray.DataArray filled by 0 with dimensions 'vegetation' and 'pixel'. It covers all vegetation types (including EPIC crops, if simulated)."""
         return self.allocateDataArray(self.coord_vegetation, dtype)
 
-    def allocateDataArray(self, dimensions, dtype=float):
+    def allocateDataArray(self, dimensions, dtype=None):
         """Allocate xarray.DataArray filled by 0 with input dimensions.
-           Argument 'dimensions' is a list of tuples of the type ('dimension name', coordinate list/array)."""
+           Argument 'dimensions' is a list of tuples of the type ('dimension name', coordinate list/array).
+           Values are of the model precision (see ModelPrecision), unless dtype is given."""
         coords = OrderedDict(dimensions)
+        if dtype is None:
+            dtype = self.maskinfo.dtype
         option = self.settings.options
         if option.get('cropsEPIC'):
             return xr.DataArray(np.zeros([len(v) for v in coords.values()], dtype), coords=coords, dims=coords.keys())
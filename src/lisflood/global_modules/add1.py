@@ -29,6 +29,8 @@ import sys
 import datetime
 import os
 import pickle
+import hashlib
+import tempfile
 from bisect import bisect_left
 
 import pcraster
@@ -41,7 +43,7 @@ from .zusatz import iterOpenNetcdf, iterReadPCRasterMap, iterSetClonePCR, checkm
 from .settings import (calendar_inconsistency_warning, get_calendar_type, calendar, MaskAttrs, CutMap, NetCDFMetadata,
                        LisSettings, MaskInfo, MaskAreaInfo)
 from .errors import LisfloodWarning, LisfloodError
-from .decorators import Cache
+from .decorators import Cache, netcdf_locked
 
 # modified numpy class to ensure code compatibility with EPIC (that uses XArray in computations)
 # while keeping higher performance when EPIC modules are not needed (use of only numpy arrays in computations)
@@ -132,6 +134,7 @@ def valuecell(mask, coordx, coordstr):
     return map
 
 
+@netcdf_locked
 def mapattrNetCDF(name):
     """
     get the map attributes like col, row etc from a ntcdf map
@@ -279,7 +282,7 @@ def compressArray(map, pcr=True, name=None):
             msg = name + " has less valid pixels than area or ldd \n"
             raise LisfloodError(msg)
             # test if map has less valid pixel than area.map (or ldd)
-    return mapC.astype(float)
+    return mapC.astype(maskinfo.dtype)
 
 
 def decompress(map):
@@ -327,17 +330,151 @@ def loadmap(*args, **kwargs):
             name = kwargs['name']
         value = binding[name]
         kwargs['value'] = value
-        data = loadmap_cached(*args, **kwargs)
+        # size and modification time of the map file, so that a modified file is not taken from the cache
+        data = loadmap_cached(*args, source=MapsStore.source(value), precision=binding.get('ModelPrecision'), **kwargs)
     else:
-        data = loadmap_base(*args, **kwargs)
+        data = loadmap_stored(*args, **kwargs)
     
     return data
 
 @Cache
-def loadmap_cached(*args, **kwargs):
-    return loadmap_base(*args, **kwargs)
+def loadmap_cached(*args, source=None, precision=None, **kwargs):
+    return loadmap_stored(*args, **kwargs)
 
 
+MAPS_STORE_VERSION = 1  # to be increased when the format of the maps store changes
+
+
+class MapsStore(object):
+    """ On-disk store of the maps read by loadmap, compressed to the pixels of the mask map
+
+    Each map is a .npy file in store_dir named after a hash of its source file (path, size and modification
+    time), of the mask map and cut window and of the options it was read with, so that a map is read again
+    from its source when any of them changes. Stored maps are memory-mapped (copy-on-write) when read, so that
+    runs on the same domain skip the decoding of netcdf and PCRaster maps. Maps are written to a temporary file
+    and renamed, so that concurrent runs can safely share the same store_dir.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    @staticmethod
+    def source(value):
+        """ Path, size and modification time of the file of map value, or None for constant values and missing files
+        """
+        try:
+            float(value)
+            return None
+        except ValueError:
+            pass
+        path = value if os.path.isfile(value) else os.path.splitext(value)[0] + '.nc'
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def key(source, timestampflag='exact', averageyearflag=False):
+        """ Hash identifying the compressed map read from source with the current mask map and settings
+        """
+        settings = LisSettings.instance()
+        binding = settings.binding
+        mask = np.ascontiguousarray(MaskInfo.instance().info.mask, dtype=bool)
+        # the step read from netcdf stacks depends on the initial step and on the calendar
+        step = None
+        if settings.timestep_init:
+            step = (settings.timestep_init, binding.get('CalendarDayStart'), binding.get('DtSec'),
+                    binding.get('calendar_type'), timestampflag, averageyearflag)
+        digest = hashlib.sha1()
+        digest.update(repr((MAPS_STORE_VERSION, source, mask.shape, [int(cut) for cut in CutMap.instance().cuts],
+                            step, MaskInfo.instance().dtype.str)).encode())
+        digest.update(np.packbits(mask).tobytes())
+        return digest.hexdigest()
+
+    def read(self, key):
+        """ Memory-mapped (copy-on-write) map stored under key, or None if it is missing or unreadable
+        """
+        try:
+            return np.load(os.path.join(self.store_dir, key + '.npy'), mmap_mode='c')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, key, data):
+        """ Store map data (compressed array) under key
+        """
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir, exist_ok=True)
+        tmp_handle, tmp_path = tempfile.mkstemp(prefix='.tmp_' + key, suffix='.npy', dir=self.store_dir)
+        try:
+            with os.fdopen(tmp_handle, 'wb') as tmp_file:
+                np.save(tmp_file, data)
+            os.replace(tmp_path, os.path.join(self.store_dir, key + '.npy'))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def loadmap_stored(name, pcr=False, lddflag=False, timestampflag='exact', averageyearflag=False, value=None):
+    """ Load a map as loadmap_base, through the maps store (MapsStore binding, see MapsStore) if set
+
+    Only compressed maps read from files are stored: PCRaster maps (pcr=True) and constant values
+    are always read by loadmap_base, as well as all maps when files are checked (checkfiles flag).
+    """
+    settings = LisSettings.instance()
+    binding = settings.binding
+    if value is None:
+        value = binding[name]
+    source = None
+    if binding.get('MapsStore') and not pcr and not settings.flags['checkfiles']:
+        source = MapsStore.source(value)
+    if source is not None:
+        try:
+            key = MapsStore.key(source, timestampflag, averageyearflag)
+        except (KeyError, AttributeError):
+            # mask map or cut window not set yet
+            source = None
+    if source is None:
+        return loadmap_base(name, pcr, lddflag, timestampflag, averageyearflag, value)
+
+    store = MapsStore(binding['MapsStore'])
+    data = store.read(key)
+    if data is None:
+        data = loadmap_base(name, pcr, lddflag, timestampflag, averageyearflag, value)
+        store.write(key, data)
+    return data
+
+
+def gatheredVariable(nf1):
+    """
+    Name of the variable compressed by gathering (CF conventions: a dimension of land points, with an index
+    variable whose "compress" attribute lists the dimensions of the grid) in netCDF file nf1, and name of its
+    index variable; None if no variable is compressed by gathering
+    """
+    for index_name in nf1.variables:
+        if 'compress' in nf1.variables[index_name].ncattrs() and nf1.variables[index_name].dimensions == (index_name,):
+            for varname in nf1.variables:
+                if varname != index_name and index_name in nf1.variables[varname].dimensions:
+                    return varname, index_name
+    return None
+
+
+def ungatherVariable(nf1, varname, index_name):
+    """
+    Values of variable varname compressed by gathering (see gatheredVariable) on the full grid,
+    as masked array (masked and missing values outside the land points)
+    """
+    index = nf1.variables[index_name]
+    grid_shape = tuple(len(nf1.dimensions[dim]) for dim in index.compress.split())
+    values = nf1.variables[varname][:]
+    missing = np.nan if np.issubdtype(values.dtype, np.floating) else getattr(nf1.variables[varname], '_FillValue', -9999)
+    grid = np.full(values.shape[:-1] + (int(np.prod(grid_shape)),), missing, dtype=values.dtype)
+    grid[..., np.asarray(index[:])] = np.ma.filled(values, missing)
+    grid = grid.reshape(values.shape[:-1] + grid_shape)
+    return np.ma.masked_invalid(grid) if np.isnan(missing) else np.ma.masked_equal(grid, missing)
+
+
+@netcdf_locked
 def loadmap_base(name, pcr=False, lddflag=False, timestampflag='exact', averageyearflag=False, value=None):
     """ Load a static map either value or pcraster map or netcdf (single or stack)
     
@@ -399,9 +536,16 @@ def loadmap_base(name, pcr=False, lddflag=False, timestampflag='exact', averagey
         cut0, cut1, cut2, cut3 = mapattrNetCDF(filename)
         # load netcdf map but only the rectangle needed
         nf1 = iterOpenNetcdf(filename, "", 'r')
-        # Only one variable must be present in netcdf files
-        num_dims = 3 if 'time' in nf1.variables else 2
-        varname = [v for v in nf1.variables if len(nf1.variables[v].dimensions) == num_dims][0]
+        gathered = gatheredVariable(nf1)
+        if gathered is not None:
+            # compressed by gathering (OutputMapsLandPoints): expand to the grid
+            varname = gathered[0]
+            variable = ungatherVariable(nf1, *gathered)
+        else:
+            # Only one variable must be present in netcdf files
+            num_dims = 3 if 'time' in nf1.variables else 2
+            varname = [v for v in nf1.variables if len(nf1.variables[v].dimensions) == num_dims][0]
+            variable = nf1.variables[varname]
 
         # read maps using always a standard x and y reference system using x in ascending and y in descending order
         spatial_dims = ('x', 'y') if 'x' in nf1.variables else ('lon', 'lat')
@@ -419,7 +563,7 @@ def loadmap_base(name, pcr=False, lddflag=False, timestampflag='exact', averagey
 
         if not settings.timestep_init:
             # if timestep_init is missing, read netcdf as single static map
-            mapnp = func_x(func_y(nf1.variables[varname]))[cut2:cut3, cut0:cut1]
+            mapnp = func_x(func_y(variable))[cut2:cut3, cut0:cut1]
         else:
             if 'time' in nf1.variables:
                 # read a netcdf  (stack) - state files
@@ -481,10 +625,10 @@ def loadmap_base(name, pcr=False, lddflag=False, timestampflag='exact', averagey
                         timestepI = timestepInew
 
                 itime = np.where(nf1.variables['time'][:] == timestepI)[0][0]
-                mapnp = func_x(func_y(nf1.variables[varname][itime]))[cut2:cut3, cut0:cut1]
+                mapnp = func_x(func_y(variable[itime]))[cut2:cut3, cut0:cut1]
             else:
                 # read a netcdf (single one)
-                mapnp = func_x(func_y(nf1.variables[varname]))[cut2:cut3, cut0:cut1]
+                mapnp = func_x(func_y(variable))[cut2:cut3, cut0:cut1]
 
         # masking
         try:
@@ -534,7 +678,7 @@ def loadmap_base(name, pcr=False, lddflag=False, timestampflag='exact', averagey
             nanCheckMap(map, filename, name)
         return map
     elif isinstance(mapC, np.ndarray):
-        return mapC.astype(float)
+        return mapC.astype(MaskInfo.instance().dtype)
     else:
         if flags['nancheck'] and name != 'Ldd':
             nanCheckMap(mapC, filename, name)
@@ -565,6 +709,7 @@ def takeClosest(myList, myNumber):
     return before
 
 
+@netcdf_locked
 def loadLAI(value, pcrvalue, i, pcr=False):
     """
     load Leaf are map stacks  or water use maps stacks
@@ -660,6 +805,7 @@ def readmapsparse(name, time, oldmap):
     return mapC
 
 
+@netcdf_locked
 def readnetcdf(name, time, timestampflag='exact', averageyearflag=False):
     """ Read maps from netCDF stacks (forcings, fractions, water demand)
 
@@ -795,6 +941,7 @@ def readnetcdfsparse(name, time, oldmap):
     return mapC
 
 
+@netcdf_locked
 def checknetcdf(name, start, end):
     """ Check available time steps in netCDF input file
     
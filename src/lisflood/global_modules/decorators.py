@@ -15,8 +15,21 @@ See the Licence for the specific language governing permissions and limitations
 
 """
 
+from collections import OrderedDict
 from functools import wraps
 import copy
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+
+
+# Lock taken by xarray around the netCDF-C and HDF5 libraries, which are not thread safe
+NETCDF_LOCK = combine_locks([NETCDFC_LOCK, HDF5_LOCK])
+_netcdf_lock_owner = threading.local()
 
 
 def counted(fn):
@@ -47,14 +60,67 @@ def cached(f):
     return _decorator
 
 
+def netcdf_locked(fn):
+    """
+    Hold NETCDF_LOCK while fn accesses NetCDF files with netCDF4, as forcings may be read
+    at the same time by xarray in background threads (see netcdf.XarrayChunked).
+    The lock is taken once per thread, so that locked functions can call each other.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if getattr(_netcdf_lock_owner, 'locked', False):
+            return fn(*args, **kwargs)
+        with NETCDF_LOCK:
+            _netcdf_lock_owner.locked = True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _netcdf_lock_owner.locked = False
+
+    return wrapper
+
+
+def cache_nbytes(data):
+    """
+    Memory taken by an object stored in Cache: arrays (and xarray objects) give their nbytes,
+    lists and tuples the total of their items and other objects (e.g. XarrayCached) the total of their array attributes
+    """
+    if hasattr(data, 'nbytes'):
+        return int(data.nbytes)
+    if isinstance(data, (list, tuple)):
+        return sum(cache_nbytes(item) for item in data)
+    if hasattr(data, '__dict__') and not isinstance(data, type):
+        # only arrays in memory (not lazy xarray datasets)
+        return sum(int(value.nbytes) for value in vars(data).values()
+                   if isinstance(value, np.ndarray) or isinstance(getattr(value, 'data', None), np.ndarray))
+    return 0
+
+
 class Cache:
     """
     Class decorator used to cache large objects read from disk
     Mostly used for forcings and static maps
+
+    Items are kept in order of use: when max_bytes is set (see configure), the least recently used items
+    are evicted once the cached items take more than max_bytes. Evicted numpy arrays are written to spill_dir,
+    if set, and read back from there (memory-mapped) when used again.
+
+    With shared_dir set (e.g. a folder in /dev/shm), numpy arrays are shared between processes: the first
+    process writes each array to shared_dir, and all processes (including the first) use copy-on-write
+    memory-mapped views of the file, found by cache key: changes to the arrays stay in the process that
+    makes them. Files in shared_dir are kept until clear_shared.
     """
 
-    cache = {}
+    cache = OrderedDict()
     found = {}
+    missed = {}
+    item_bytes = {}
+    spilled = {}
+    stats = {'nbytes': 0, 'evicted': 0, 'spilled_found': 0, 'shared_found': 0}
+    max_bytes = None
+    spill_dir = None
+    shared_dir = None
 
     def __init__(self, fn):
         self.name = fn.__name__
@@ -63,34 +129,132 @@ class Cache:
         # or we lose the reference
         if self.name not in self.found:
             self.found[self.name] = 0
+            self.missed[self.name] = 0
 
     def __call__(self, *args, **kwargs):
 
         key = '{}, {}, {}'.format(self.name, args, kwargs)
 
-        if key not in self.cache:
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return_data = self.cache[key]
+            self.found[self.name] += 1
+        elif key in self.spilled:
+            return_data = np.load(self.spilled[key], mmap_mode='c')
+            self.found[self.name] += 1
+            self.stats['spilled_found'] += 1
+        elif self.shared_dir is not None and os.path.exists(self._shared_path(key)):
+            # written by another process
+            return_data = self.attach(key)
+            self.found[self.name] += 1
+            self.stats['shared_found'] += 1
+            self._store(key, return_data)
+        else:
+            self.missed[self.name] += 1
             data = self.fn(*args, **kwargs)
             # we don't cache small objects (e.g. floats from loadmap)
             if isinstance(data, float):
                 return_data = data
             else:
-                self.cache[key] = data
-                return_data = self.cache[key]
-        else:
-            return_data = self.cache[key]
-            self.found[self.name] += 1
+                if self.shared_dir is not None and self.shareable(data):
+                    data = self.share(key, data)
+                self._store(key, data)
+                return_data = data
         return return_data
-    
+
+    @staticmethod
+    def shareable(data):
+        return isinstance(data, np.ndarray) and data.dtype != object
+
+    @classmethod
+    def _shared_path(cls, key):
+        return os.path.join(cls.shared_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    @classmethod
+    def attach(cls, key):
+        """
+        Copy-on-write view of the array shared by key, or None if not shared (or no shared_dir)
+        """
+        if cls.shared_dir is None or not os.path.exists(cls._shared_path(key)):
+            return None
+        return np.load(cls._shared_path(key), mmap_mode='c')
+
+    @classmethod
+    def share(cls, key, data):
+        """
+        Write array data to shared_dir (unless another process did it first) and return its copy-on-write view
+        """
+        path = cls._shared_path(key)
+        if not os.path.exists(path):
+            # written to a temporary file and renamed, so that other processes never see partial files
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'wb') as temp_file:
+                np.save(temp_file, data)
+            os.replace(temp_path, path)
+        return np.load(path, mmap_mode='c')
+
+    @classmethod
+    def clear_shared(cls):
+        """
+        Remove the arrays shared in shared_dir (when no process uses them anymore)
+        """
+        if cls.shared_dir is not None and os.path.isdir(cls.shared_dir):
+            for filename in os.listdir(cls.shared_dir):
+                if filename.endswith('.npy'):
+                    os.remove(os.path.join(cls.shared_dir, filename))
+
+    @classmethod
+    def _store(cls, key, data):
+        cls.cache[key] = data
+        # shared arrays are in the page cache, not in the memory of this process (but for the pages changed)
+        cls.item_bytes[key] = 0 if isinstance(data, np.memmap) and data.mode == 'c' else cache_nbytes(data)
+        cls.stats['nbytes'] += cls.item_bytes[key]
+        cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        # the last item used is kept, even if larger than max_bytes
+        while cls.max_bytes is not None and cls.stats['nbytes'] > cls.max_bytes and len(cls.cache) > 1:
+            key, data = cls.cache.popitem(last=False)
+            cls.stats['nbytes'] -= cls.item_bytes.pop(key)
+            cls.stats['evicted'] += 1
+            if cls.spill_dir is not None and cls.shareable(data) and not isinstance(data, np.memmap):
+                path = os.path.join(cls.spill_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+                np.save(path, data)
+                cls.spilled[key] = path
+
+    @classmethod
+    def configure(cls, max_bytes=None, spill_dir=None, shared_dir=None):
+        """
+        Set the memory limit of cached items (bytes, None for no limit), the folder of evicted arrays (None to drop them)
+        and the folder of arrays shared between processes (None for no sharing)
+        """
+        cls.max_bytes = max_bytes
+        for folder in (spill_dir, shared_dir):
+            if folder is not None:
+                os.makedirs(folder, exist_ok=True)
+        cls.spill_dir = spill_dir
+        cls.shared_dir = shared_dir
+        cls._evict()
+
     @classmethod
     def clear(cls):
         print('Clearing cache')
         cls.cache.clear()
+        cls.item_bytes.clear()
+        for path in cls.spilled.values():
+            if os.path.exists(path):
+                os.remove(path)
+        cls.spilled.clear()
         for i in cls.found:
             cls.found[i] = 0
+            cls.missed[i] = 0
+        for i in cls.stats:
+            cls.stats[i] = 0
 
     @classmethod
     def size(cls):
-        return len(cls.cache)
+        return len(cls.cache) + len(cls.spilled)
 
     @classmethod
     def extract(cls):
@@ -100,7 +264,9 @@ class Cache:
     def apply(cls, cache_in):
         # We need to loop to keep the reference to cache
         for i in cache_in:
-            cls.cache[i] = cache_in[i]
+            if i in cls.cache:
+                cls.stats['nbytes'] -= cls.item_bytes[i]
+            cls._store(i, cache_in[i])
 
     @classmethod
     def values_found(cls):
@@ -108,9 +274,23 @@ class Cache:
 
     @classmethod
     def info(cls):
+        """
+        Print and return the statistics of the cache: items in memory and spilled to disk, bytes in memory,
+        items found (hits) and not found (misses) for each cached function, evicted items
+        """
+        stats = {'items': len(cls.cache), 'spilled': len(cls.spilled), 'nbytes': cls.stats['nbytes'],
+                 'max_bytes': cls.max_bytes, 'found': dict(cls.found), 'missed': dict(cls.missed),
+                 'evicted': cls.stats['evicted'], 'spilled_found': cls.stats['spilled_found'],
+                 'shared_found': cls.stats['shared_found']}
         print('Caching')
-        print('Number of items cached: {}'.format(cls.size()))
+        print('Number of items cached: {} ({} spilled to disk)'.format(cls.size(), stats['spilled']))
+        print('Memory used: {:.1f} MB (limit: {})'.format(
+            stats['nbytes'] / 1024**2, 'none' if cls.max_bytes is None else '{:.1f} MB'.format(cls.max_bytes / 1024**2)))
         print('Number of items retrieved: {}'.format(cls.found))
+        print('Number of items not found: {}'.format(cls.missed))
+        print('Number of items evicted: {} (retrieved from disk: {})'.format(stats['evicted'], stats['spilled_found']))
+        print('Number of items retrieved from other processes: {}'.format(stats['shared_found']))
         print('Keys:')
         for key in cls.cache.keys():
             print('   - {}'.format(key))
+        return stats
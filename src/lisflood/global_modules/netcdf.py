@@ -1,5 +1,9 @@
 import os
 import glob
+import json
+import shutil
+import hashlib
+import tempfile
 import warnings
 import xarray as xr
 import numpy as np
@@ -7,6 +11,8 @@ import datetime
 import pcraster
 from netCDF4 import num2date, date2num
 import time as xtime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from nine import range
 from pyproj import Proj
 
@@ -73,8 +79,44 @@ def uncompress_array(masked_data):
     return data
 
 
+def gathered_dimension(ds):
+    """ Dimension of the land points of a dataset compressed by gathering (CF conventions: index variable with
+    a "compress" attribute listing the dimensions of the grid), or None
+    """
+    for name, variable in ds.variables.items():
+        if 'compress' in variable.attrs and variable.dims == (name,):
+            return name
+    return None
+
+
+def ungather_np(data, index, grid_shape):
+    grid = np.full(data.shape[:-1] + (grid_shape[0] * grid_shape[1],), np.nan, dtype=np.result_type(data.dtype, np.float32))
+    grid[..., index] = data
+    return grid.reshape(data.shape[:-1] + grid_shape)
+
+
+def ungather_xarray(ds, da, landpoint_dim):
+    """ Expand da, compressed by gathering along landpoint_dim, to the (y, x) grid (lazily, missing values outside the land points)
+    """
+    grid_dims = ds[landpoint_dim].attrs['compress'].split()
+    grid_shape = tuple(ds.sizes[dim] for dim in grid_dims)
+    data = xr.apply_ufunc(ungather_np, da,
+                          dask='parallelized',
+                          input_core_dims=[[landpoint_dim]],
+                          exclude_dims={landpoint_dim},
+                          output_dtypes=[np.result_type(da.dtype, np.float32)],
+                          output_core_dims=[grid_dims],
+                          dask_gufunc_kwargs=dict(output_sizes=dict(zip(grid_dims, grid_shape))),
+                          kwargs={'index': ds[landpoint_dim].values, 'grid_shape': grid_shape})
+    data = data.assign_coords({dim: ds[dim] for dim in grid_dims if dim in ds.variables})
+    data.attrs, data.encoding = da.attrs, da.encoding
+    return data.rename(da.name)
+
+
 def find_main_var(ds, path):
-    variable_names = [k for k in ds.variables if len(ds.variables[k].dims) == 3]
+    landpoint_dim = gathered_dimension(ds)
+    variable_names = [k for k in ds.variables if len(ds.variables[k].dims) == 3 or
+                      (landpoint_dim is not None and ds.variables[k].dims == ('time', landpoint_dim))]
     if len(variable_names) > 1:
         raise LisfloodWarning('More than one variable in dataset {}'.format(path))
     elif len(variable_names) == 0:
@@ -167,31 +209,106 @@ def map_dates_index(dates, time, indexer, climatology=False):
     return index_map
 
 
+def open_forcing(data_path, time_chunk):
+    """ Open a netcdf time series (single file or multiple files) with xarray, in temporal chunks of time_chunk steps
+
+    Returns
+    -------
+    tuple
+        Dataset, main variable (DataArray), name of the main variable and path of the netcdf file(s)
+    """
+    data_path = data_path + ".nc" if not data_path.endswith('.nc') else data_path
+    try:
+        ds = xr.open_mfdataset(
+            data_path, engine='netcdf4', 
+            chunks={'time': time_chunk}, combine='by_coords',
+            mask_and_scale=True
+        )
+    except OSError:
+        raise OSError(f"Could not open file {data_path}")
+
+    # check calendar type
+    check_dataset_calendar_type(ds, data_path)
+
+    # extract main variable
+    var_name = find_main_var(ds, data_path)
+    da = ds[var_name]
+    landpoint_dim = gathered_dimension(ds)
+    if landpoint_dim is not None:  # compressed by gathering (OutputMapsLandPoints)
+        da = ungather_xarray(ds, da, landpoint_dim)
+    return ds, da, var_name, data_path
+
+
+def compress_forcing(ds, da, var_name, data_path):
+    """ Compress the main variable da of dataset ds (opened with open_forcing) to the pixels of the mask map
+
+    Maps are flipped to a standard x and y reference system, cut to the mask map and checked against
+    the valid range (valid_min, valid_max) of the variable. Computation is lazy (dask).
+    """
+    # read maps using always a standard x and y reference system using x in ascending and y in descending order
+    spatial_dims = ('x', 'y') if 'x' in ds.variables else ('lon', 'lat')
+    x_flipped = ds.variables[spatial_dims[0]][0]>ds.variables[spatial_dims[0]][-1] 
+    y_flipped = ds.variables[spatial_dims[1]][0]<ds.variables[spatial_dims[1]][-1] 
+    func_y = lambda y : y
+    func_x = lambda x : x
+    # read maps using always a standard x and y reference system using x in ascending and y in descending order
+    if (y_flipped):   # y in in ascending order
+        warnings.warn(LisfloodWarning("Warning: map {} (var_name: '{}') has y coordinates in ascending order and will be flipped vertically".format(data_path, var_name)))
+        func_y = lambda y : np.flipud(y).copy()
+    if (x_flipped):   # x in in descending order
+        warnings.warn(LisfloodWarning("Warning: map {} (var_name: '{}') has x coordinates in descending order and will be flipped horizontally".format(data_path, var_name)))
+        func_x = lambda x : np.fliplr(x).copy()
+
+    # compress dataset (remove missing values and flatten the array)
+    maskinfo = MaskInfo.instance()
+    mask = np.logical_not(maskinfo.info.mask)
+    cutmap = CutMap.instance()
+    crop = cutmap.cuts
+
+    # in case the dataset contains valid_min and valid_max set, store here the scaled adn offset values of them
+    scale_factor=da.encoding['scale_factor'] if 'scale_factor' in da.encoding else 1
+    add_offset=da.encoding['add_offset'] if 'add_offset' in da.encoding else 0
+    valid_min_scaled = None
+    valid_max_scaled = None
+    settings = LisSettings.instance()
+    flags = settings.flags
+    if not flags['skipvalreplace']:
+        valid_min_scaled = (da.attrs['valid_min']*scale_factor+add_offset) if 'valid_min' in da.attrs else None
+        valid_max_scaled = (da.attrs['valid_max']*scale_factor+add_offset) if 'valid_max' in da.attrs else None
+    return compress_xarray(mask, crop, da, var_name, valid_min_scaled, valid_max_scaled, func_x, func_y)
+
+
+def check_forcing_step(data, name, step):
+    """ Raise an error if data (one step of forcing name) contains missing values
+    """
+    if np.issubdtype(data.dtype, np.floating):
+        if (np.isnan(data).any()):
+            #warnings.warn(LisfloodWarning('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(name,step)))
+            raise LisfloodError('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(name,step))
+    else:
+        if (data==default_fillvals[data.dtype.str[1:]]).any():
+            #warnings.warn(LisfloodWarning('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(name,step)))
+            raise LisfloodError('Data in var "{}" contains missing values or values out of valid range inside mask map for step: {}'.format(name,step))
+
+
 class XarrayChunked():
     """ Class that handles the reading of netcdf files with temporal chunks
+
+    With prefetch > 0, the next chunks (up to prefetch chunks ahead, and no more than prefetch_memory bytes)
+    are loaded in a background thread while the model runs on the current chunk.
+    wait_time is the total time (seconds) spent waiting for chunks to be loaded.
     """
 
-    def __init__(self, data_path, time_chunk, dates, indexer=None, climatology=False):
+    def __init__(self, data_path, time_chunk, dates, indexer=None, climatology=False, prefetch=0, prefetch_memory=None):
+
+        self.prefetch = prefetch
+        self.prefetch_memory = prefetch_memory
+        self.wait_time = 0.
 
         # load dataset using xarray
         if time_chunk != 'auto' and time_chunk is not None:
             time_chunk = int(time_chunk)
-        data_path = data_path + ".nc" if not data_path.endswith('.nc') else data_path
-        try:
-            ds = xr.open_mfdataset(
-                data_path, engine='netcdf4', 
-                chunks={'time': time_chunk}, combine='by_coords',
-                mask_and_scale=True
-            )
-        except OSError:
-            raise OSError(f"Could not open file {data_path}")
-
-        # check calendar type
-        check_dataset_calendar_type(ds, data_path)
-
-        # extract main variable
-        var_name = find_main_var(ds, data_path)
-        da = ds[var_name]
+        ds, da, var_name, data_path = open_forcing(data_path, time_chunk)
 
         # extract time range
         try:
@@ -207,37 +324,7 @@ class XarrayChunked():
 
         self.index_map = map_dates_index(dates, da.time, indexer, climatology)
 
-        # read maps using always a standard x and y reference system using x in ascending and y in descending order
-        spatial_dims = ('x', 'y') if 'x' in ds.variables else ('lon', 'lat')
-        x_flipped = ds.variables[spatial_dims[0]][0]>ds.variables[spatial_dims[0]][-1] 
-        y_flipped = ds.variables[spatial_dims[1]][0]<ds.variables[spatial_dims[1]][-1] 
-        func_y = lambda y : y
-        func_x = lambda x : x
-        # read maps using always a standard x and y reference system using x in ascending and y in descending order
-        if (y_flipped):   # y in in ascending order
-            warnings.warn(LisfloodWarning("Warning: map {} (var_name: '{}') has y coordinates in ascending order and will be flipped vertically".format(data_path, var_name)))
-            func_y = lambda y : np.flipud(y).copy()
-        if (x_flipped):   # x in in descending order
-            warnings.warn(LisfloodWarning("Warning: map {} (var_name: '{}') has x coordinates in descending order and will be flipped horizontally".format(data_path, var_name)))
-            func_x = lambda x : np.fliplr(x).copy()
-
-        # compress dataset (remove missing values and flatten the array)
-        maskinfo = MaskInfo.instance()
-        mask = np.logical_not(maskinfo.info.mask)
-        cutmap = CutMap.instance()
-        crop = cutmap.cuts
-
-        # in case the dataset contains valid_min and valid_max set, store here the scaled adn offset values of them
-        scale_factor=da.encoding['scale_factor'] if 'scale_factor' in da.encoding else 1
-        add_offset=da.encoding['add_offset'] if 'add_offset' in da.encoding else 0
-        valid_min_scaled = None
-        valid_max_scaled = None
-        settings = LisSettings.instance()
-        flags = settings.flags
-        if not flags['skipvalreplace']:
-            valid_min_scaled = (da.attrs['valid_min']*scale_factor+add_offset) if 'valid_min' in da.attrs else None
-            valid_max_scaled = (da.attrs['valid_max']*scale_factor+add_offset) if 'valid_max' in da.attrs else None
-        self.dataset = compress_xarray(mask, crop, da, var_name, valid_min_scaled, valid_max_scaled, func_x, func_y) # final dataset to store
+        self.dataset = compress_forcing(ds, da, var_name, data_path) # final dataset to store
 
         # initialise class variables and load first chunk
         self.init_chunks(self.dataset, time_chunk)
@@ -252,17 +339,57 @@ class XarrayChunked():
             self.chunk_indexes.append(int(np.sum(chunks[:i])))
         self.chunk_indexes.append(int(np.sum(chunks)))
 
+        # chunks being loaded in the background thread: {chunk number: future}
+        self.prefetched = OrderedDict()
+        self.executor = None
+        if self.prefetch > 0 and len(chunks) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch_{}'.format(self.dataset.name))
+
         # load first chunk
         self.ichunk = -1
         self.load_next_chunk()
 
+    def load_chunk(self, ichunk):
+        begin = self.chunk_indexes[ichunk]
+        end = self.chunk_indexes[ichunk+1]
+
+        chunk = self.dataset.isel(time=range(begin, end))
+        return chunk.load()  # triggers xarray computation
+
+    def chunk_nbytes(self, ichunk):
+        steps = self.chunk_indexes[ichunk+1] - self.chunk_indexes[ichunk]
+        return steps * int(np.prod(self.dataset.shape[1:])) * self.dataset.dtype.itemsize
+
+    def prefetch_chunks(self):
+        """ Start loading the chunks following the current one in the background thread, within prefetch and prefetch_memory
+        (the current chunk counts in the memory budget, but the next chunk is always prefetched)
+        """
+        if self.executor is None:
+            return
+        num_chunks = len(self.chunk_indexes) - 1
+        if self.prefetch_memory is not None:
+            budget = self.prefetch_memory - sum(self.chunk_nbytes(ichunk) for ichunk in [self.ichunk, *self.prefetched])
+        ichunk = self.ichunk + len(self.prefetched) + 1
+        while len(self.prefetched) < self.prefetch and ichunk < num_chunks:
+            if self.prefetch_memory is not None:
+                budget -= self.chunk_nbytes(ichunk)
+                if budget < 0 and self.prefetched:
+                    break
+            self.prefetched[ichunk] = self.executor.submit(self.load_chunk, ichunk)
+            ichunk += 1
+        if ichunk == num_chunks:  # all chunks submitted: the thread ends after loading the last one
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
     def load_next_chunk(self):
         self.ichunk += 1
-        begin = self.chunk_indexes[self.ichunk]
-        end = self.chunk_indexes[self.ichunk+1]
-        
-        chunk = self.dataset.isel(time=range(begin, end))
-        self.dataset_chunk = chunk.load()  # triggers xarray computation
+        start = xtime.perf_counter()
+        if self.ichunk in self.prefetched:
+            self.dataset_chunk = self.prefetched.pop(self.ichunk).result()
+        else:
+            self.dataset_chunk = self.load_chunk(self.ichunk)
+        self.wait_time += xtime.perf_counter() - start
+        self.prefetch_chunks()
 
     def __getitem__(self, step):
 
@@ -279,14 +406,7 @@ class XarrayChunked():
             raise LisfloodError(msg)
 
         data = self.dataset_chunk.values[local_index]
-        if np.issubdtype(data.dtype, np.floating):
-            if (np.isnan(data).any()):
-                #warnings.warn(LisfloodWarning('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(self.dataset.name,local_index)))
-                raise LisfloodError('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(self.dataset.name,local_index))
-        else:
-            if (data==default_fillvals[data.dtype.str[1:]]).any():
-                #warnings.warn(LisfloodWarning('Data in var "{}" contains NaN values or values out of valid range inside mask map for step: {}'.format(self.dataset.name,local_index)))
-                raise LisfloodError('Data in var "{}" contains missing values or values out of valid range inside mask map for step: {}'.format(self.dataset.name,local_index))
+        check_forcing_step(data, self.dataset.name, local_index)
 
         return data
 
@@ -294,11 +414,126 @@ class XarrayChunked():
 @Cache
 class XarrayCached(XarrayChunked):
     """ Class that extends the main XarrayChunked class to allow caching the full dataset in memory
+
+    With Cache.shared_dir set, the compressed dataset is shared with other processes (see Cache): it is read
+    from the netcdf files by the first process only, the others attach a copy-on-write view of it.
     """
 
     def __init__(self, data_path, dates, indexer=None, climatology=False):
+        self.shared_key = 'XarrayCached, {}'.format((data_path, dates, indexer, climatology))
         super().__init__(data_path, None, dates, indexer, climatology)
 
+    def load_chunk(self, ichunk):
+        if Cache.shared_dir is None:
+            return super().load_chunk(ichunk)
+        values = Cache.attach(self.shared_key)
+        if values is None:
+            values = Cache.share(self.shared_key, super().load_chunk(ichunk).values)
+        chunk = self.dataset.isel(time=range(self.chunk_indexes[ichunk], self.chunk_indexes[ichunk+1]))
+        return chunk.copy(data=values)
+
+
+FORCING_STORE_VERSION = 1  # to be increased when the format of the forcing store changes
+
+
+class ForcingStore():
+    """ On-disk store of forcings compressed to the pixels of the mask map (written by lisflood-preprocess)
+
+    Each forcing is a sub-directory of store_dir named after its binding (e.g. PrecipitationMaps) holding
+    data.npy, a (time, pixels) array with the pixels in the order of the compressed arrays, time.npy with
+    the dates of the steps and header.json, identifying the netcdf files, mask map, cut window and settings
+    the forcing was compressed with. Stored forcings are memory-mapped (read-only) when read, so that
+    each step is read from disk with no flipping, cutting or masking.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def entry(self, dataname):
+        return os.path.join(self.store_dir, dataname)
+
+    @staticmethod
+    def header(data_path):
+        """ Header identifying the compressed forcing read from data_path with the current mask map and settings
+        """
+        data_path = data_path + ".nc" if not data_path.endswith('.nc') else data_path
+        settings = LisSettings.instance()
+        mask = np.ascontiguousarray(MaskInfo.instance().info.mask, dtype=bool)
+        digest = hashlib.sha1()
+        digest.update(repr((mask.shape, [int(cut) for cut in CutMap.instance().cuts])).encode())
+        digest.update(np.packbits(mask).tobytes())
+        return {'version': FORCING_STORE_VERSION,
+                'mask': digest.hexdigest(),
+                'calendar': settings.binding['calendar_type'],
+                'skipvalreplace': bool(settings.flags['skipvalreplace']),
+                'sources': [[os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+                            for path in sorted(glob.glob(data_path))]}
+
+    def read(self, dataname, data_path):
+        """ Memory-mapped data and dates of forcing dataname,
+        or None if it is missing or was not compressed from data_path with the current mask map and settings
+        """
+        entry = self.entry(dataname)
+        try:
+            with open(os.path.join(entry, 'header.json')) as header_file:
+                if json.load(header_file) != self.header(data_path):
+                    return None
+            return np.load(os.path.join(entry, 'data.npy'), mmap_mode='r'), np.load(os.path.join(entry, 'time.npy'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, dataname, data_path, time_chunk='auto'):
+        """ Compress forcing dataname (netcdf time series data_path) to the mask map and store it,
+        reading time_chunk steps at a time. Returns the path of the stored forcing.
+        """
+        ds, da, var_name, data_path = open_forcing(data_path, time_chunk)
+        dataset = compress_forcing(ds, da, var_name, data_path)
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        # written to a temporary directory and renamed, so that runs never read a partially written forcing
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp_' + dataname, dir=self.store_dir)
+        try:
+            data = np.lib.format.open_memmap(os.path.join(tmp_entry, 'data.npy'), mode='w+',
+                                             dtype=dataset.dtype, shape=dataset.shape)
+            begin = 0
+            for steps in dataset.chunks[0]:
+                data[begin:begin+steps] = dataset.isel(time=slice(begin, begin+steps)).values
+                begin += steps
+            data.flush()
+            del data
+            np.save(os.path.join(tmp_entry, 'time.npy'), dataset.time.values)
+            with open(os.path.join(tmp_entry, 'header.json'), 'w') as header_file:
+                json.dump(self.header(data_path), header_file)
+            entry = self.entry(dataname)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp_entry, entry)
+        except BaseException:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        finally:
+            ds.close()
+        return entry
+
+
+class ForcingStoreReader():
+    """ Class that handles the reading of forcings from a ForcingStore (same interface as XarrayChunked)
+    """
+
+    def __init__(self, data, times, name, dates, indexer=None, climatology=False):
+        self.dataset = data
+        self.name = name
+        self.wait_time = 0.
+        time = xr.DataArray(times, coords={'time': times}, dims='time').time
+        try:
+            self.index_map = map_dates_index(dates, time, indexer, climatology)
+        except KeyError:
+            raise KeyError(f"not all values found in index 'time' for forcing {name} in forcing store")
+
+    def __getitem__(self, step):
+        data = self.dataset[self.index_map[step]]
+        check_forcing_step(data, self.name, step)
+        return data
+
 
 def xarray_reader(dataname, indexer=None, climatology=False):
     """ Reads a netcdf time series using Xarray
@@ -315,7 +550,7 @@ def xarray_reader(dataname, indexer=None, climatology=False):
     Returns
     -------
     object
-        Xarray reader object, can be accessed as a simple array/list
+        Xarray reader object (ForcingStoreReader if the forcing is in the forcing store), can be accessed as a simple array/list
     """
 
     # get bindings
@@ -327,8 +562,19 @@ def xarray_reader(dataname, indexer=None, climatology=False):
     # extract run date range from bindings -> (begin, end, step)
     dates = run_date_range(binding)
 
+    # read forcing from the forcing store, if it was stored for this mask map (see lisflood-preprocess)
+    if binding.get('ForcingStore'):
+        stored = ForcingStore(binding['ForcingStore']).read(dataname, data_path)
+        if stored is not None:
+            return ForcingStoreReader(*stored, dataname, dates, indexer, climatology)
+        warnings.warn(LisfloodWarning('Forcing {} not found in forcing store {} for this mask map and settings: '
+                                      'reading it from {}'.format(dataname, binding['ForcingStore'], data_path)))
+
     # extract chunk from bindings
     time_chunk = binding['NetCDFTimeChunks']  # -1 to load everything, 'auto' to let xarray decide
+    # number of chunks loaded in advance in a background thread, and memory available for them (MB)
+    prefetch = int(binding.get('NetCDFTimeChunksPrefetch', 0))
+    prefetch_memory = float(binding.get('NetCDFPrefetchMemoryMB', 1024)) * 1024**2
 
     if binding['MapsCaching'] == "True":
         data = XarrayCached(data_path, dates, indexer, climatology)
@@ -336,7 +582,7 @@ def xarray_reader(dataname, indexer=None, climatology=False):
         if climatology:  # for climatology, load the entire dataset
             data = XarrayChunked(data_path, None, dates, indexer, climatology)
         else:
-            data = XarrayChunked(data_path, time_chunk, dates, indexer, climatology)
+            data = XarrayChunked(data_path, time_chunk, dates, indexer, climatology, prefetch, prefetch_memory)
     
     return data
 
@@ -429,6 +675,63 @@ def get_space_coords_pcraster(nrow, ncol, dim_lat_y, dim_lon_x):
     return coordinates
 
 
+OUTPUT_COMPRESSION = ('none', 'zlib', 'szip', 'zstd', 'bzip2',
+                      'blosc_lz', 'blosc_lz4', 'blosc_lz4hc', 'blosc_zlib', 'blosc_zstd')  # see netCDF4 createVariable
+
+
+def output_encoding(binding, map_key=None):
+    """ NetCDF layout of output map stack map_key
+
+    Read from bindings map_key + ChunkShape, Compression, CompressionLevel, Shuffle and LandPoints (e.g. DischargeMapsChunkShape)
+    or, if missing (or map_key is None), from OutputMapsChunkShape, OutputMapsCompression, ...
+
+    Returns
+    -------
+    dict
+        chunk_shape: chunk sizes along (time, y, x), -1 for the full dimension
+        compression: compression codec (see OUTPUT_COMPRESSION)
+        complevel: compression level
+        shuffle: use the shuffle filter
+        landpoints: write only the pixels of the mask map, on a landpoint dimension (CF compression by gathering)
+    """
+    def setting(name, default):
+        value = binding.get('OutputMaps' + name, default)
+        return binding.get(map_key + name, value) if map_key is not None else value
+
+    try:
+        chunk_shape = tuple(int(size) for size in setting('ChunkShape', '1,-1,-1').split(','))
+        complevel = int(setting('CompressionLevel', 4))
+    except ValueError:
+        raise LisfloodError('Chunk shape and compression level of output maps {} must be integers'.format(map_key or ''))
+    if len(chunk_shape) != 3 or any(size == 0 or size < -1 for size in chunk_shape):
+        raise LisfloodError('Chunk shape of output maps {} must be "time,y,x" sizes (-1 for the full dimension), '
+                            'found: {}'.format(map_key or '', chunk_shape))
+    compression = setting('Compression', 'zlib')
+    if compression not in OUTPUT_COMPRESSION:
+        raise LisfloodError('Compression of output maps {} must be one of {}, found: {}'.format(
+            map_key or '', ', '.join(OUTPUT_COMPRESSION), compression))
+    shuffle = setting('Shuffle', 'True') == 'True'
+    landpoints = setting('LandPoints', 'False') == 'True'
+    return {'chunk_shape': chunk_shape, 'compression': compression, 'complevel': complevel, 'shuffle': shuffle,
+            'landpoints': landpoints}
+
+
+def encoding_kwargs(encoding, shape):
+    """ netCDF4 createVariable keyword arguments of a variable of shape (time, y, x) or (y, x),
+    or (time, landpoint) or (landpoint,) with landpoints, with output_encoding encoding
+    """
+    chunk_shape = encoding['chunk_shape']
+    if encoding['landpoints']:  # y and x chunk sizes give the number of land points per chunk
+        chunk_shape = (chunk_shape[0], -1 if -1 in chunk_shape[1:] else chunk_shape[1] * chunk_shape[2])
+    chunk_shape = chunk_shape[-len(shape):]
+    kwargs = {'chunksizes': tuple(max(1, dim if size == -1 else min(size, dim)) for size, dim in zip(chunk_shape, shape))}
+    if encoding['compression'] == 'zlib':  # supported by all netCDF4 versions
+        kwargs.update(zlib=True, complevel=encoding['complevel'], shuffle=encoding['shuffle'])
+    elif encoding['compression'] != 'none':
+        kwargs.update(compression=encoding['compression'], complevel=encoding['complevel'], shuffle=encoding['shuffle'])
+    return kwargs
+
+
 def write_netcdf_header(settings, 
                         var_name,
                         netfile,
@@ -439,6 +742,7 @@ def write_netcdf_header(settings,
                         start_date,
                         rep_steps,
                         frequency,
+                        encoding=None,
                         ):
     
     """ Writes a netcdf header without the data inside
@@ -465,6 +769,8 @@ def write_netcdf_header(settings,
         list of reporting steps
     frequency:
         output frequency (all, monthly or yearly)
+    encoding: dict
+        chunk shape and compression of the variable (see output_encoding), default from OutputMaps bindings
     
     Returns
     -------
@@ -569,9 +875,24 @@ def write_netcdf_header(settings,
             time.units = 'minutes since %s' % start_date.strftime("%Y-%m-%d %H:%M:%S.0")
         nf1.variables["time"][:] = date2num(time_stamps, time.units, time.calendar)
 
-        value = nf1.createVariable(var_name, dtype, ('time', dim_lat_y, dim_lon_x), zlib=True, fill_value=-9999, chunksizes=(1, nrow, ncol))
+    if encoding is None:
+        encoding = output_encoding(binding)
+    if encoding['landpoints']:
+        # CF compression by gathering: pixels of the mask map only, indexed in the flattened (y, x) grid
+        landpoints = np.flatnonzero(~MaskInfo.instance().info.maskflat)
+        nf1.createDimension('landpoint', landpoints.size)
+        landpoint = nf1.createVariable('landpoint', 'i4' if nrow * ncol < 2**31 else 'i8', ('landpoint',))
+        landpoint.compress = '{} {}'.format(dim_lat_y, dim_lon_x)
+        landpoint[:] = landpoints
+        space_dims, space_shape = ('landpoint',), (landpoints.size,)
+    else:
+        space_dims, space_shape = (dim_lat_y, dim_lon_x), (nrow, ncol)
+    if frequency is not None:
+        value = nf1.createVariable(var_name, dtype, ('time',) + space_dims, fill_value=-9999,
+                                   **encoding_kwargs(encoding, (steps.size,) + space_shape))
     else:
-        value = nf1.createVariable(var_name, dtype, (dim_lat_y, dim_lon_x), zlib=True, fill_value=-9999)
+        value = nf1.createVariable(var_name, dtype, space_dims, fill_value=-9999,
+                                   **encoding_kwargs(encoding, space_shape))
     
     # value attributes
     value.standard_name = value_standard_name
@@ -16,29 +16,60 @@ See the Licence for the specific language governing permissions and limitations
 """
 import os
 import numpy as np
-from pcraster import ifthen, catchmenttotal, mapmaximum
+from pcraster import ifthen
 import sys
+import threading
+from collections import namedtuple, deque
+from functools import partial
 
 from .zusatz import TimeoutputTimeseries
 from .add1 import decompress, valuecell, loadmap, compressArray
-from .netcdf import write_netcdf_header, iterOpenNetcdf, nanCheckMap, uncompress_array
-from .errors import LisfloodFileError, LisfloodWarning
+from .netcdf import write_netcdf_header, iterOpenNetcdf, nanCheckMap, uncompress_array, output_encoding
+from .errors import LisfloodError, LisfloodFileError, LisfloodWarning
+from .decorators import netcdf_locked
 from .settings import inttodate, CDFFlags, LisSettings
 
 
 # ------------------------------------------------------------------------
 # Writer classes
 # ------------------------------------------------------------------------
+# Write of staged data taken from a writer: write() does the I/O with no reference to the state of the model,
+# nbytes is the memory taken by the staged data
+WriteJob = namedtuple('WriteJob', 'write, nbytes')
+
+
 class Writer():
     """ Abstract writer class
     """
 
+    # write jobs can run on another thread than the model
+    threadsafe = True
+
     def stage(self, map_data):
         """ Registers the output data and store it in the object for future write
             Implemented here as the staging depends on the type of outputs
         """
         raise NotImplementedError
 
+    def take(self, start_date, rep_steps):
+        """ Takes the staged data if it is time to write them
+
+        Implemented here as the writing depends on the type of outputs
+
+        Parameters
+        ----------
+        start_date : datetime.datetime object
+            Start date to write in the output file
+        rep_steps : list
+            List of steps to write
+
+        Returns
+        -------
+        WriteJob
+            Write of the staged data, or None if there is nothing to write yet
+        """
+        raise NotImplementedError
+
     def write(self, start_date, rep_steps):
         """ Write the staged data
 
@@ -49,7 +80,14 @@ class Writer():
         rep_steps : list
             List of steps to write
         """
-        raise NotImplementedError
+        job = self.take(start_date, rep_steps)
+        if job is not None:
+            job.write()
+
+    def close(self):
+        """ Close the output file if kept open between writes
+        """
+        pass
 
     def _extract_map(self):
         """ Private, extracts the output map from the variable (self.var) object
@@ -82,28 +120,38 @@ class NetcdfWriter(Writer):
         self.map_path = map_path+'.nc'
 
         self.frequency = frequency
+        self.encoding = output_encoding(self.settings.binding, map_key)
 
         self.data = None
 
+    def _output_array(self, data):
+        """ Private, staged map as written to the netcdf file: compressed array with land points, map otherwise
+        """
+        return data if self.encoding['landpoints'] else uncompress_array(data)
+
     def stage(self):
         self.data = self._extract_map()
         flags = self.settings.flags
         if flags['nancheck']:
             nanCheckMap(self.data, self.map_name, self.map_key)
     
-    def write(self, start_date, rep_steps):
+    def take(self, start_date, rep_steps):
         if self.data is not None:
-            nf1 = write_netcdf_header(self.settings, self.map_name, self.map_path, self.var.DtDay,
-                                    self.map_key, self.map_value.output_var, self.map_value.unit,
-                                    start_date, rep_steps, self.frequency)
+            return WriteJob(partial(self._write_map, self.data, start_date, rep_steps, self.var.DtDay), self.data.nbytes)
+        else:
+            raise Exception('You need to stage the variable data before writing!')
 
-            map_np = uncompress_array(self.data)
+    @netcdf_locked
+    def _write_map(self, data, start_date, rep_steps, dt_day):
+        """ Private, writes the file with map data
+        """
+        nf1 = write_netcdf_header(self.settings, self.map_name, self.map_path, dt_day,
+                                self.map_key, self.map_value.output_var, self.map_value.unit,
+                                start_date, rep_steps, self.frequency, self.encoding)
 
-            nf1.variables[self.map_name][:, :] = map_np
+        nf1.variables[self.map_name][...] = self._output_array(data)
 
-            nf1.close()
-        else:
-            raise Exception('You need to stage the variable data before writing!')
+        nf1.close()
 
 
 class NetcdfStepsWriter(NetcdfWriter):
@@ -120,6 +168,8 @@ class NetcdfStepsWriter(NetcdfWriter):
         self.end_step = end_step
         self.step_range = []
         self.data_steps = []
+        # netCDF file kept open from the first write to the end of the run (see close)
+        self.nf1 = None
 
         super().__init__(var, map_key, map_value, map_path, frequency)
 
@@ -145,26 +195,51 @@ class NetcdfStepsWriter(NetcdfWriter):
         self.step_range.append(step)
         self.data_steps.append(map_np)
 
-    def write(self, start_date, rep_steps):
+    def take(self, start_date, rep_steps):
         if self._checkpoint():
             if self.data_steps:
-                if self.step_range[0] == 0:
-                    nf1 = write_netcdf_header(self.settings, self.map_name, self.map_path, self.var.DtDay,
-                                            self.map_key, self.map_value.output_var, self.map_value.unit,
-                                            start_date, rep_steps, self.frequency)
-                else:
-                    nf1 = iterOpenNetcdf(self.map_path, "", 'a', format='NETCDF4')
+                step_range, data_steps = self.step_range, self.data_steps
+                # new lists for next chunk
+                self.step_range, self.data_steps = [], []
+                end_run = self.var.currentTimeStep() == self.end_step
+                return WriteJob(partial(self._write_steps, step_range, data_steps, start_date, rep_steps,
+                                        self.var.DtDay, end_run),
+                                sum(data.nbytes for data in data_steps))
+            else:
+                raise Exception('You need to stage data before writing!')
+        return None
 
-                for step, data in zip(self.step_range, self.data_steps):
-                    nf1.variables[self.map_name][step, :, :] = uncompress_array(data)
+    @netcdf_locked
+    def _write_steps(self, step_range, data_steps, start_date, rep_steps, dt_day, end_run):
+        """ Private, writes maps data_steps at steps step_range, then closes the file at the end of the run
+        """
+        if step_range[0] == 0:
+            self.close()
+            self.nf1 = write_netcdf_header(self.settings, self.map_name, self.map_path, dt_day,
+                                           self.map_key, self.map_value.output_var, self.map_value.unit,
+                                           start_date, rep_steps, self.frequency, self.encoding)
+        elif self.nf1 is None:
+            # reopened after close (e.g. at a checkpoint)
+            self.nf1 = iterOpenNetcdf(self.map_path, "", 'a', format='NETCDF4')
+
+        if np.all(np.diff(step_range) == 1):
+            # consecutive steps are written at once, so that chunks spanning several steps are compressed once
+            self.nf1.variables[self.map_name][step_range[0]:step_range[-1]+1] = \
+                np.ma.stack([self._output_array(data) for data in data_steps])
+        else:
+            for step, data in zip(step_range, data_steps):
+                self.nf1.variables[self.map_name][step] = self._output_array(data)
 
-                nf1.close()
+        if end_run:
+            self.close()
 
-                # clear lists for next chunk
-                self.step_range.clear()
-                self.data_steps.clear()
-            else:
-                raise Exception('You need to stage data before writing!')
+    @netcdf_locked
+    def close(self):
+        """ Close the netCDF file, so that all written steps are flushed to disk. It is reopened at the next write.
+        """
+        if self.nf1 is not None:
+            self.nf1.close()
+            self.nf1 = None
 
 
 class PCRasterWriter(Writer):
@@ -173,6 +248,9 @@ class PCRasterWriter(Writer):
         Writing outputs in temporal chunks not supported for PCRaster
     """
 
+    # maps are named after the current step of the model
+    threadsafe = False
+
     def __init__(self, var, map_path):
         self.var = var
         self.map_path = map_path
@@ -181,9 +259,9 @@ class PCRasterWriter(Writer):
     def stage(self):
         self.data = self._extract_map()
 
-    def write(self, start_date, rep_steps):
+    def take(self, start_date, rep_steps):
         if self.data is not None:
-            self.var.report(decompress(self.data), str(self.map_path))
+            return WriteJob(partial(self.var.report, decompress(self.data), str(self.map_path)), self.data.nbytes)
         else:
             raise Exception('You need to stage data before writing!')
 
@@ -296,6 +374,18 @@ class MapOutput():
         """
         if self._output_checkpoint():
             return self.writer.write(self._start_date, self._rep_steps)
+
+    def take(self):
+        """ Takes staged maps for writing (see Writer.take)
+        """
+        if self._output_checkpoint():
+            return self.writer.take(self._start_date, self._rep_steps)
+        return None
+
+    def close(self):
+        """ Closes the output file if kept open by the writer
+        """
+        self.writer.close()
     
 
 class MapOutputEnd(MapOutput):
@@ -445,43 +535,128 @@ class OutputMapsFactory():
             out.stage()
             out.write()
 
+    def close(self):
+        """ Close all output files kept open between writes (at the end of the run, or at a checkpoint
+        to make the maps written so far readable by other processes)
+        """
+        for out in self.output_maps:
+            out.close()
 
-class OutputMapsFactoryThreads(OutputMapsFactory):
+
+class OutputMapsFactoryAsync(OutputMapsFactory):
     """ Extension of the OutputMapsFactory class
-        Allows asynchronous writing on threads
-        NOT FULLY TESTED, USE AS A PROOF OF CONTEXT
+        Writes outputs on a writer thread, while the model computes the next steps
+        Maps are staged (copied) at each step on the model thread and written in the same order, so that
+        the writes to each file keep their order. The model waits while the staged maps not yet written take
+        more than max_memory bytes. Errors of the writer thread are raised on the model thread at the next write.
     """
 
-    def __init__(self, var):
+    def __init__(self, var, max_memory):
         super().__init__(var)
 
-        from multiprocessing import pool
-        self.thread_pool = pool.ThreadPool(16)
-        self.thread_out = None
+        self.max_memory = max_memory
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+        self.error = None
+        self.thread = None
+
+    def _writer_loop(self):
+        """ Private, writes staged maps in order until close (None job)
+        """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                job = self.pending[0]
+            if job is None:
+                break
+            try:
+                if self.error is None:  # after an error, staged maps are dropped
+                    job.write()
+            except BaseException as e:
+                self.error = e
+            with self.condition:
+                self.pending.popleft()
+                self.pending_bytes -= job.nbytes
+                self.condition.notify_all()
+
+    def _check_error(self):
+        """ Private, raises the error of the writer thread, if any, once the thread is stopped
+        """
+        if self.error is not None:
+            self._stop()
+            error, self.error = self.error, None
+            raise error
+
+    def _submit(self, job):
+        """ Private, queues job for the writer thread, waiting for memory if needed
+        """
+        with self.condition:
+            # a job larger than the whole memory budget is written alone
+            while self.pending and self.pending_bytes + job.nbytes > self.max_memory and self.error is None:
+                self.condition.wait()
+            self.pending.append(job)
+            self.pending_bytes += job.nbytes
+            self.condition.notify_all()
+
+    def _drain(self):
+        """ Private, waits until all staged maps are written
+        """
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def _stop(self):
+        """ Private, stops the writer thread once all staged maps are written
+        """
+        if self.thread is not None:
+            with self.condition:
+                self.pending.append(None)
+                self.condition.notify_all()
+            self.thread.join()
+            self.pending.clear()
+            self.pending_bytes = 0
+            self.thread = None
 
     def write(self):
-        # make sure that previous step finished writing, then stage data
-        if self.thread_out is not None:
-            self.thread_out.wait()
-    
+        self._check_error()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer_loop, name='lisflood-output', daemon=True)
+            self.thread.start()
         for out in self.output_maps:
             out.stage()
+            job = out.take()
+            if job is None:
+                continue
+            if out.writer.threadsafe:
+                self._submit(job)
+            else:
+                # maps written by the model thread, after those staged before
+                self._drain()
+                job.write()
+        self._check_error()
 
-        # quickly wraps OutputMaps write function to allow the use of map_async
-        def write_output(output_map):
-            output_map.write()
-        
-        # write outputs using thread pool
-        if self.output_maps:
-            self.thread_out = self.thread_pool.map_async(write_output, self.output_maps)
+    def close(self):
+        self._stop()
+        self._check_error()
+        super().close()
 
-        # for last step, wait until everything is finished
-        if self.var.currentTimeStep() == self.var.nrTimeSteps() and self.thread_out is not None:
-            self.thread_out.wait()
 
 # ------------------------------------------------------------------------
 # Output Module
 # ------------------------------------------------------------------------
+def outputGetter(module, output_var):
+    """ Function returning the current value of output_var, a variable of module.var or an expression
+        evaluated as 'self.var.' + output_var (e.g. 'Theta1a[0]', 'TotalRunoff+self.var.GwLossPixel'),
+        resolved once so that no string is parsed at each step
+    """
+    if output_var.isidentifier():
+        return partial(getattr, module.var, output_var)
+    code = compile('self.var.' + output_var, output_var, 'eval')
+    return partial(eval, code, {'self': module})
+
+
 class outputTssMap(object):
 
     """
@@ -536,8 +711,20 @@ class outputTssMap(object):
                     msg = "Checking output timeseries \n"
                     raise LisfloodFileError(str(binding[tss]), msg)
 
+        # time series values: getters resolved once, and operators of 'total' outputs (upstream average,
+        # as catchmenttotal(values * PixelArea, Ldd) / UpArea) on compressed arrays
+        self.tss_values = {tss: outputGetter(self, report_time_serie_act[tss].output_var) for tss in report_time_serie_act}
+        self.inv_up_area = compressArray(self.var.InvUpArea)
+
         # initialise output objects
-        self.output_maps = OutputMapsFactory(self.var)
+        output_writer = binding.get('OutputMapsWriter', 'sync')
+        if output_writer == 'sync':
+            self.output_maps = OutputMapsFactory(self.var)
+        elif output_writer == 'thread':
+            max_memory = int(binding.get('OutputMapsWriterMemoryMB', '512')) * 1024**2
+            self.output_maps = OutputMapsFactoryAsync(self.var, max_memory)
+        else:
+            raise LisfloodError('OutputMapsWriter must be "sync" or "thread", found: {}'.format(output_writer))
 
     def dynamic(self):
         """ dynamic part of the output module
@@ -564,21 +751,23 @@ class outputTssMap(object):
 
             for tss in report_time_serie_act:
                 # report time series
-                what = 'self.var.' + report_time_serie_act[tss].output_var
+                values = self.tss_values[tss]()
+                if np.ndim(values) == 0:
+                    values = np.full(self.inv_up_area.shape, values, dtype=float)
                 how = report_time_serie_act[tss].operation[0] if len(report_time_serie_act[tss].operation) else ''
                 if how == 'mapmaximum':
-                    changed = compressArray(mapmaximum(decompress(eval(what))))
-                    what = 'changed'
+                    values = np.broadcast_to(np.nanmax(values), values.shape)
                 if how == 'total':
-                    changed = compressArray(catchmenttotal(decompress(eval(what)) * self.var.PixelAreaPcr, self.var.Ldd) * self.var.InvUpArea)
-                    what = 'changed'
-                self.var.Tss[tss].sample(decompress(eval(what)))
+                    values = self.var.LddNetwork.accuflux(values * self.var.PixelArea) * self.inv_up_area
+                self.var.Tss[tss].sampleCompressed(values)
 
         # ************************************************************
         # ***** WRITING RESULTS: MAPS   ******************************
         # ************************************************************
 
-        self.output_maps.write()      
+        self.output_maps.write()
+        if self.var.currentTimeStep() == self.var.nrTimeSteps():
+            self.output_maps.close()
 
         # update local output steps
         cdfflags = CDFFlags.instance()
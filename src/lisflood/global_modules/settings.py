@@ -241,11 +241,16 @@ class MaskInfo(with_metaclass(Singleton)):
         self.mask_all = np.ma.masked_all(self.flat.shape)
         self.mask_all.mask = self.flat
         self.info = self.Info(mask, mask.shape, self.flat, self.flat.shape, self.mask_compressed.shape, self.mask_all)
-        self._in_zero = np.zeros(self.mask_compressed.shape)
+        # floating point type of compressed maps and states (see model_precision)
+        self.dtype = model_precision(LisSettings.instance().binding)
+        self._in_zero = np.zeros(self.mask_compressed.shape, self.dtype)
         self.maskmap = maskmap
 
-    def in_zero(self):
-        return self._in_zero.copy()
+    def in_zero(self, dtype=None):
+        """Compressed map of zeros, of the model precision unless dtype is given (e.g. np.float64 for accumulators)"""
+        if dtype is None:
+            return self._in_zero.copy()
+        return np.zeros(self._in_zero.shape, dtype)
 
     def __iter__(self):
         return iter(self.info)
@@ -270,6 +275,15 @@ class MaskAreaInfo(with_metaclass(Singleton)):
         return iter(self.info)
 
 
+def model_precision(binding):
+    """Floating point type of compressed maps, states and forcings (ModelPrecision setting: float64 or float32).
+    With float32, channel routing and mass balance accumulators are still computed in float64."""
+    precision = binding.get('ModelPrecision', 'float64') or 'float64'
+    if precision not in ('float64', 'float32'):
+        raise LisfloodError('ModelPrecision must be float64 or float32, not {}'.format(precision))
+    return np.dtype(precision)
+
+
 def get_core_dims(dims):
     if 'x' in dims and 'y' in dims:
         core_dims = ('y', 'x')
@@ -30,11 +30,12 @@ except ImportError:
 from pcraster.framework import *  # TODO fix import star
 import numpy as np
 
-from .decorators import counted
+from .decorators import counted, netcdf_locked
 from .settings import datetoint, LisSettings, MaskInfo, MaskAreaInfo
 from .errors import LisfloodError, LisfloodFileError, LisfloodWarning
 
 
+TSS_FORMATS = ('tss', 'netcdf')    # file formats of time series outputs (TssFormat)
 MAX_READ_TRIALS = 100 # max number of trial allowed re-read an input file: to avoid crashes due to temporary network interruptions
 READ_PAUSE = 0.1      # pause (seconds) between each re-read trial over the network
 try:
@@ -241,11 +242,85 @@ class TimeoutputTimeseries(TimeoutputTimeseries):
 
         return filename
 
+    def _openTssFile(self, outputFilename):
+        """
+        opens the tss file for writing (with header) or, after the first block of steps, for appending
+        """
+        option = LisSettings.instance().options
+        if self._fileStarted or (option['EnKF'] and os.path.exists(outputFilename)):
+            return open(outputFilename, "a")
+        if self._writeHeader:
+            self._writeFileHeader(outputFilename)
+            return open(outputFilename, "a")
+        return open(outputFilename, "w")
+
+    def _formatRows(self, timesteps, values):
+        """
+        tss text of values (one row per timestep): "%14g" columns, missing values (NaN) as 1e31
+        """
+        table = np.empty((values.shape[0], values.shape[1] + 1))
+        table[:, 0] = timesteps
+        table[:, 1:] = np.where(np.isnan(values), np.nan, values)  # NaN without sign
+        row_format = " %8g" + " %14g" * values.shape[1] + "\n"
+        text = (row_format * values.shape[0]) % tuple(table.ravel())
+        return text.replace(" " * 12 + "nan", " " * 11 + "1e31")
+
+    @netcdf_locked
+    def _writeNetcdfBlock(self, outputFilename, timesteps, values):
+        """
+        appends values (one row per timestep) to the netCDF time series file (TssFormat "netcdf")
+        """
+        # <name>.tss.nc, not to be mixed up with a map stack <name>.nc
+        var_name = os.path.splitext(os.path.splitext(os.path.basename(outputFilename))[0])[0]
+        if not self._fileStarted:
+            settings = LisSettings.instance()
+            nf1 = Dataset(outputFilename, 'w', format='NETCDF4')
+            nf1.settingsfile = settings.settings_path
+            nf1.history = 'Created ' + xtime.ctime(xtime.time())
+            nf1.createDimension('time', None)
+            nf1.createDimension('point', self._ncodesId)
+            timestep = nf1.createVariable('time', 'i4', ('time',))
+            timestep.long_name = 'timestep'
+            point = nf1.createVariable('point', 'f8', ('point',))
+            point.long_name = 'ID of the output point'
+            point[:] = self._codesId
+            nf1.createVariable(var_name, 'f4', ('time', 'point'), fill_value=np.nan, zlib=True,
+                               chunksizes=(max(1, min(self._sampleValues.shape[0], 1024)), self._ncodesId))
+        else:
+            nf1 = Dataset(outputFilename, 'a')
+        first = timesteps[0] - self._userModel.firstTimeStep()
+        nf1.variables['time'][first:first + len(timesteps)] = timesteps
+        nf1.variables[var_name][first:first + len(timesteps), :] = values
+        nf1.close()
+
+    def _writeBlock(self):
+        """
+        writes the steps in the buffer (sampled since the last write) to disk and empties the buffer
+        """
+        if self._bufferRows == 0:
+            return
+        outputFilename = self._configureOutputFilename(self._outputFilename)
+        timesteps = np.arange(self._bufferStep, self._bufferStep + self._bufferRows)
+        values = self._sampleValues[:self._bufferRows]
+        if self._format == 'netcdf':
+            self._writeNetcdfBlock(outputFilename + '.nc', timesteps, values)
+        else:
+            with self._openTssFile(outputFilename) as outputFile:
+                outputFile.write(self._formatRows(timesteps, values))
+        self._fileStarted = True
+        self._bufferStep += self._bufferRows
+        self._bufferRows = 0
+        self._sampleValues.fill(np.nan)
+
     def _writeTssFile(self):
         """
         writing timeseries to disk
         """
         #
+        if self._spatialIdGiven:
+            # steps not written yet
+            self._writeBlock()
+            return
         option = LisSettings.instance().options
         outputFilename = self._configureOutputFilename(self._outputFilename)
         if option['EnKF']:
@@ -272,21 +347,12 @@ class TimeoutputTimeseries(TimeoutputTimeseries):
         for timestep in range(start, end):
             row = ""
             row += " %8g" % timestep
-            if self._spatialIdGiven:
-                for cellId in range(0, self._ncodesId):
-                    value = self._sampleValues[timestep - start][cellId]
-                    if isinstance(value, Decimal):
-                        row += "           1e31"
-                    else:
-                        row += " %14g" % (value)
-                row += "\n"
+            value = self._sampleValues[timestep - start]
+            if isinstance(value, Decimal):
+                row += "           1e31"
             else:
-                value = self._sampleValues[timestep - start]
-                if isinstance(value, Decimal):
-                    row += "           1e31"
-                else:
-                    row += " %14g" % (value)
-                row += "\n"
+                row += " %14g" % (value)
+            row += "\n"
 
             outputFile.write(row)
         outputFile.close()
@@ -310,6 +376,19 @@ class TimeoutputTimeseries(TimeoutputTimeseries):
         self._writeHeader = not noHeader
         # array to store the timestep values
         self._sampleValues = None
+        # compressed-array sampling (see sampleCompressed)
+        self._sampleIndex = None
+        self._zonePixels = None
+        self._pixelZones = None
+        # values are written every TssFlushSteps steps (0: at the end of the run)
+        # _sampleValues is a buffer of the steps from _bufferStep, the first not written yet
+        flush_steps = int(binding.get('TssFlushSteps', '100'))
+        self._format = binding.get('TssFormat', 'tss')
+        if self._format not in TSS_FORMATS:
+            raise LisfloodError('TssFormat must be one of {}, found: {}'.format(', '.join(TSS_FORMATS), self._format))
+        self._bufferStep = self._userModel.firstTimeStep()
+        self._bufferRows = 0
+        self._fileStarted = False
 
         _idMap = False
         if isinstance(idMap, str) or isinstance(idMap, pcraster._pcraster.Field):
@@ -378,13 +457,103 @@ class TimeoutputTimeseries(TimeoutputTimeseries):
                     self._sampleAddresses[outlet_idx] = cell
 
             self._spatialIdGiven = True
+            self._setCompressedSampling(codesId if self._spatialId.isSpatial() else np.array([1.]))
 
             nrCols = self._ncodesId
-            self._sampleValues = [
-                [Decimal("NaN")] * nrCols for _ in [0] * nrRows]
+            if flush_steps > 0 and not settings.options['EnKF']:
+                nrRows = min(nrRows, flush_steps)
+            # missing values are NaN
+            self._sampleValues = np.full((nrRows, nrCols), np.nan)
         else:
             self._sampleValues = [[Decimal("NaN")] * 1 for _ in [0] * nrRows]
 
+    def _setCompressedSampling(self, codesId):
+        """
+        zone (index of the code in codesId) of the pixels of the mask map, for sampleCompressed
+        """
+        maskinfo = MaskInfo.instance()
+        if self._spatialId.isSpatial():
+            ids = pcr2numpy(self._spatialId, np.nan)[~maskinfo.info.mask]
+        else:
+            ids = np.ones(maskinfo.info.mapC)
+        zones = np.minimum(np.searchsorted(codesId, ids), codesId.size - 1)
+        in_zone = codesId[zones] == ids
+        self._zonePixels = np.flatnonzero(in_zone)
+        self._pixelZones = zones[in_zone]
+        if np.array_equal(np.bincount(self._pixelZones, minlength=codesId.size), np.ones(codesId.size, dtype=int)):
+            # gauges or sites: one pixel per code, sampled with a single np.take
+            self._sampleIndex = np.empty(codesId.size, dtype=int)
+            self._sampleIndex[self._pixelZones] = self._zonePixels
+
+    def _bufferRow(self):
+        """
+        row of the current step in the buffer, after writing the full buffer to disk if needed
+        """
+        row = self._userModel.currentTimeStep() - self._bufferStep
+        while row >= self._sampleValues.shape[0]:
+            self._bufferRows = self._sampleValues.shape[0]
+            self._writeBlock()
+            row = self._userModel.currentTimeStep() - self._bufferStep
+        self._bufferRows = max(self._bufferRows, row + 1)
+        return row
+
+    def sample(self, expression):
+        """
+        sampling of a PCRaster map at the locations of idMap (areaaverage, or areamajority for non scalar maps);
+        same buffer as sampleCompressed, written to disk every TssFlushSteps steps
+        """
+        if not self._spatialIdGiven:
+            return super(TimeoutputTimeseries, self).sample(expression)
+        try:
+            # store the data type for tss file header
+            if self._spatialDatatype is None:
+                self._spatialDatatype = str(expression.dataType())
+        except AttributeError as e:
+            datatype, sep, tail = str(e).partition(" ")
+            msg = "Argument must be a PCRaster map, type %s given. If necessary use data conversion functions like scalar()" % (datatype)
+            raise AttributeError(msg)
+        if expression.dataType() == pcraster.Scalar or expression.dataType() == pcraster.Directional:
+            tmp = pcraster.areaaverage(pcraster.spatial(expression), pcraster.spatial(self._spatialId))
+        else:
+            tmp = pcraster.areamajority(pcraster.spatial(expression), pcraster.spatial(self._spatialId))
+        row = self._bufferRow()
+        for col, cellIndex in enumerate(self._sampleAddresses):
+            value, valid = pcraster.cellvalue(tmp, cellIndex)
+            self._sampleValues[row, col] = value if valid else np.nan
+        if self._userModel.currentTimeStep() == self._userModel.nrTimeSteps():
+            self._writeTssFile()
+
+    def sampleCompressed(self, values):
+        """
+        same as sample(decompress(values)) for a compressed array: the average of values over the pixels
+        of each code of idMap (pcraster.areaaverage, or areamajority for integer values) is computed
+        without PCRaster; steps are written to disk every TssFlushSteps steps
+        """
+        if not self._spatialIdGiven:
+            from .add1 import decompress
+            return self.sample(decompress(values))
+        if not np.issubdtype(values.dtype, np.floating):
+            # majority over each code, constant over its pixels
+            from .add1 import decompress, compressArray
+            values = compressArray(pcraster.areamajority(decompress(values), pcraster.spatial(self._spatialId)))
+            if self._spatialDatatype is None:
+                self._spatialDatatype = str(pcraster.Nominal)
+        if self._spatialDatatype is None:
+            self._spatialDatatype = str(pcraster.Scalar)
+        row = self._bufferRow()
+        if self._sampleIndex is not None:
+            self._sampleValues[row] = np.take(values, self._sampleIndex)
+        else:
+            # average over the pixels of each code, ignoring missing values (NaN)
+            zone_values = np.take(values, self._zonePixels)
+            valid = ~np.isnan(zone_values)
+            totals = np.bincount(self._pixelZones[valid], weights=zone_values[valid], minlength=self._ncodesId)
+            counts = np.bincount(self._pixelZones[valid], minlength=self._ncodesId)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._sampleValues[row] = totals / counts
+        if self._userModel.currentTimeStep() == self._userModel.nrTimeSteps():
+            self._writeTssFile()
+
     def firstout(self,expression):
         """
         returns the first cell as output value
@@ -0,0 +1,91 @@
+"""
+
+Copyright 2019 European Union
+
+Licensed under the EUPL, Version 1.2 or as soon they will be approved by the European Commission  subsequent versions of the EUPL (the "Licence");
+
+You may not use this work except in compliance with the Licence.
+You may obtain a copy of the Licence at:
+
+https://joinup.ec.europa.eu/sites/default/files/inline-files/EUPL%20v1_2%20EN(1).txt
+
+Unless required by applicable law or agreed to in writing, software distributed under the Licence is distributed on an "AS IS" basis,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the Licence for the specific language governing permissions and limitations under the Licence.
+
+Totals over the zones of a zone map (e.g. Catchments, WUseRegionC), broadcast back to the pixels of each zone:
+replaces np.take(np.bincount(zones, weights=values), zones) in the dynamic sections.
+The zone index of each pixel is computed once at initialisation, and several weight vectors are summed in
+one traversal of the pixels. Values are summed in pixel order and combined term by term, so that results
+are identical to those of the corresponding sequence of np.bincount calls.
+"""
+from __future__ import absolute_import, print_function
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=False, cache=True)
+def zoneTotals(weights, coefficients, zone_index, num_zones, result, accumulate):
+    """Called by AreaAggregator: result[r] (+)= sum_t coefficients[r,t] * total of weights[t] over the zone of each pixel.
+    weights is a tuple of num_terms (num_pixels) arrays; coefficients is a (num_results, num_terms) array."""
+    num_terms = len(weights)
+    num_results = coefficients.shape[0]
+    num_pixels = zone_index.size
+    # Zone totals: serial, to sum in the same order as np.bincount
+    totals = np.zeros((num_zones, num_terms))
+    for pix in range(num_pixels):
+        zone = zone_index[pix]
+        for term in range(num_terms):
+            totals[zone,term] += weights[term][pix]
+    # Broadcast to the pixels
+    for pix in prange(num_pixels):
+        zone = zone_index[pix]
+        for res in range(num_results):
+            value = result[res,pix] if accumulate else 0.0
+            for term in range(num_terms):
+                if coefficients[res,term] != 0: # terms not in this result must not spread NaNs
+                    value += coefficients[res,term] * totals[zone,term]
+            result[res,pix] = value
+
+
+class AreaAggregator:
+    """Area totals over the zones of a compressed zone map (non-negative integers)."""
+
+    def __init__(self, zones):
+        # Zones are numbered 0 to num_zones - 1, so that zone totals take no more memory than needed
+        zone_ids, zone_index = np.unique(zones, return_inverse=True)
+        self.zone_index = np.ascontiguousarray(zone_index, dtype=np.int64)
+        self.num_zones = zone_ids.size
+        self.num_pixels = self.zone_index.size
+
+    def _weights(self, weights):
+        """Tuple of contiguous and writeable float arrays (as Numba needs a homogeneous tuple), one per weight vector"""
+        return tuple(np.full(self.num_pixels, w, dtype=float) if np.ndim(w) == 0 else np.require(w, float, ["C", "W"])
+                     for w in weights)
+
+    def areatotal(self, *weights, coefficients=None, add_to=None):
+        """Total over the zone of each pixel of the sum of weights (each multiplied by its coefficient, default 1):
+        same as np.take(np.bincount(zones, weights=w), zones) summed over w.
+        If add_to is given, totals are added to it in place (in the order of weights) and add_to is returned."""
+        coefficients = np.ones((1, len(weights))) if coefficients is None else np.array(coefficients, float).reshape(1, -1)
+        if add_to is None:
+            result = np.empty((1, self.num_pixels))
+        else:
+            result = add_to[np.newaxis]
+        zoneTotals(self._weights(weights), coefficients, self.zone_index, self.num_zones, result, add_to is not None)
+        return result[0] if add_to is None else add_to
+
+    def areatotals(self, *groups):
+        """Separate totals over the zone of each pixel, one for each of groups, computed in one traversal.
+        Each group is a weight vector, or a list (or tuple) of weight vectors that are summed as in areatotal."""
+        groups = [group if isinstance(group, (list, tuple)) else [group] for group in groups]
+        weights = [w for group in groups for w in group]
+        coefficients = np.zeros((len(groups), len(weights)))
+        first = 0
+        for res, group in enumerate(groups):
+            coefficients[res,first:first+len(group)] = 1
+            first += len(group)
+        result = np.empty((len(groups), self.num_pixels))
+        zoneTotals(self._weights(weights), coefficients, self.zone_index, self.num_zones, result, False)
+        return tuple(result)
@@ -0,0 +1,112 @@
+"""
+
+Copyright 2019 European Union
+
+Licensed under the EUPL, Version 1.2 or as soon they will be approved by the European Commission  subsequent versions of the EUPL (the "Licence");
+
+You may not use this work except in compliance with the Licence.
+You may obtain a copy of the Licence at:
+
+https://joinup.ec.europa.eu/sites/default/files/inline-files/EUPL%20v1_2%20EN(1).txt
+
+Unless required by applicable law or agreed to in writing, software distributed under the Licence is distributed on an "AS IS" basis,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the Licence for the specific language governing permissions and limitations under the Licence.
+
+Operations along the flow network of a LDD map on compressed arrays (one value per pixel of the land mask).
+The FlowNetwork class replaces the PCRaster accuflux, upstream and downstream functions, and insertPits
+replaces lddrepair(ifthenelse(..., 5, ldd)), so that they can be used without converting arrays to and from
+PCRaster maps. The flow network is described by the same lookups used by the parallel kinematic wave
+(see kinematic_wave_parallel.streamLookups) and accumulations are computed by routing order with the Numba
+functions in kinematic_wave_parallel_tools.py.
+Pixels where the LDD is not defined (missing value, e.g. outside the channels for the kinematic LDD) are
+not part of the network: as in PCRaster, the results are missing values (NaN) there.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import numpy as np
+
+from .kinematic_wave_parallel import FLOW_CODE, PARALLEL_MIN_ORDER_WIDTH, rebuildFlowMatrix, decodeFlowMatrix, streamLookups, \
+    routingSchedule
+from ..global_modules.errors import LisfloodError
+
+from . import kinematic_wave_parallel_tools as kwpt
+
+
+PIT_CODE = FLOW_CODE[8] # LISFLOOD (and PCRaster) encoding of a pit in the LDD
+
+
+def insertPits(compressed_encoded_ldd, is_pit):
+    """Compressed LDD with a pit at all pixels where is_pit is True: same as lddrepair(ifthenelse(is_pit, 5, ldd)).
+    Cutting the flow path at a pixel cannot make a sound LDD unsound, so no further repair is needed."""
+    return np.where(is_pit, PIT_CODE, compressed_encoded_ldd)
+
+
+class FlowNetwork:
+    """Flow network of a compressed LDD map.
+    Arguments:
+        compressed_encoded_ldd (numpy.ndarray): LDD values (FLOW_CODE) of the pixels of the land mask; other values are missing values.
+        land_mask (numpy.ndarray): land mask on coordinate mesh.
+        min_parallel_width (int): minimum number of pixels of a routing order to be accumulated in parallel (see routingSchedule).
+    """
+
+    def __init__(self, compressed_encoded_ldd, land_mask, min_parallel_width=PARALLEL_MIN_ORDER_WIDTH):
+        self.defined = np.isin(compressed_encoded_ldd, FLOW_CODE)
+        # Pixels with missing LDD are isolated pits, and so are the pixels draining into them
+        encoded_ldd = insertPits(compressed_encoded_ldd, ~self.defined)
+        self._setLookups(encoded_ldd, land_mask)
+        downstream_missing = self.has_downstream & ~self.defined[np.maximum(self.downstream_lookup, 0)]
+        if np.any(downstream_missing):
+            self._setLookups(insertPits(encoded_ldd, downstream_missing), land_mask)
+        self.min_parallel_width = min_parallel_width
+        self.pixels_ordered = None # routing orders are only needed by accuflux: computed on first call
+
+    def _setLookups(self, compressed_encoded_ldd, land_mask):
+        """Downstream and upstream lookups of the flow network"""
+        flow_dir = decodeFlowMatrix(rebuildFlowMatrix(compressed_encoded_ldd.astype(float), land_mask))
+        downstream_lookup, self.upstream_lookup = streamLookups(flow_dir, land_mask)
+        self.downstream_lookup = downstream_lookup.astype(int)
+        self.has_downstream = self.downstream_lookup != -1
+        self.num_upstream_pixels = (self.upstream_lookup != -1).sum(1).astype(int)
+
+    def _setRoutingOrders(self):
+        """Routing orders, as in kinematic_wave_parallel.kinematicWave._setRoutingOrders"""
+        self.pixels_ordered, order_start_stop, num_reached = kwpt.routingOrders(self.downstream_lookup, self.upstream_lookup,
+                                                                                self.num_upstream_pixels)
+        if num_reached != self.downstream_lookup.size:
+            raise LisfloodError("The flow direction map (LDD) contains loops: {} pixels do not drain to any outlet".format(
+                self.downstream_lookup.size - num_reached))
+        self.schedule = routingSchedule(order_start_stop, self.min_parallel_width)
+
+    def _values(self, values):
+        """Contiguous float array of values, one per pixel (scalars are broadcast)"""
+        return np.ascontiguousarray(np.broadcast_to(values, self.downstream_lookup.shape), dtype=float)
+
+    def _missing(self, result):
+        """Set missing values where the LDD is not defined"""
+        result[~self.defined] = np.nan
+        return result
+
+    def accuflux(self, values):
+        """Sum of values over each pixel and all pixels upstream of it: same as pcraster.accuflux(ldd, values)"""
+        if self.pixels_ordered is None:
+            self._setRoutingOrders()
+        accumulated = np.empty(self.downstream_lookup.size)
+        kwpt.accumulateFlux(self._values(values), self.upstream_lookup, self.num_upstream_pixels, self.pixels_ordered,
+                            self.schedule, accumulated)
+        return self._missing(accumulated)
+
+    def upstream(self, values):
+        """Sum of values over the immediately upstream pixels of each pixel: same as pcraster.upstream(ldd, values)"""
+        total = np.empty(self.downstream_lookup.size)
+        kwpt.upstreamTotal(self._values(values), self.upstream_lookup, self.num_upstream_pixels, total)
+        return self._missing(total)
+
+    def downstream(self, values):
+        """Value of the downstream pixel (own value for pits): same as pcraster.downstream(ldd, values)"""
+        values = self._values(values)
+        return self._missing(np.where(self.has_downstream, values[self.downstream_lookup], values))
+
+    def downstreamIndex(self, pit_index):
+        """Index of the downstream pixel of each pixel; pits and pixels where the LDD is not defined get pit_index"""
+        return np.where(self.has_downstream, self.downstream_lookup, pit_index).astype(np.int32)
@@ -117,9 +117,9 @@ class groundwater(HydroModule):
         # Initialising cumulative output variables
         # These are all needed to compute the cumulative mass balance error
 
-        self.var.GwLossCUM = maskinfo.in_zero()
+        self.var.GwLossCUM = maskinfo.in_zero(np.float64)
         # Cumulative groundwater loss [mm]
-        self.var.LZInflowCUM = maskinfo.in_zero()
+        self.var.LZInflowCUM = maskinfo.in_zero(np.float64)
         # Cumulative lower zone inflow [mm]
         # Needed for calculation of average LZ inflow (initialisation)
 
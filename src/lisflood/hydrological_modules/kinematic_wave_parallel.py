@@ -30,15 +30,17 @@ __date__ = "2016/06/01"
 
 import os
 import glob
+import shutil
+import hashlib
+import tempfile
 import warnings
 from multiprocessing import cpu_count
 from platform import system
 
 import numpy as np
-import pandas as pd
-import numexpr as nx
+from numba import get_num_threads
 
-from ..global_modules.errors import LisfloodWarning
+from ..global_modules.errors import LisfloodError, LisfloodWarning
 
 from . import kinematic_wave_parallel_tools as kwpt
 
@@ -49,6 +51,11 @@ from . import kinematic_wave_parallel_tools as kwpt
 IX_ADDS = np.array([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]) # flow directions (row and column shifts in coordinate mesh)
 SEA_CODE = 0 # Value for sea pixel in LISFLOOD flow direction matrix
 FLOW_CODE = [2, 3, 6, 9, 8, 7, 4, 1, 5] # Flow directions according to LISFLOOD encoding (see IX_ADDS for directions expressed as row/column shifts)
+TOPOLOGY_ARRAYS = ("downstream_lookup", "upstream_lookup", "num_upstream_pixels", "pixels_ordered", "order_start_stop") # kinematicWave attributes stored by TopologyCache
+PARALLEL_MIN_ORDER_WIDTH = 500 # default minimum number of pixels of a routing order to be routed in parallel (see routingSchedule)
+ROUTING_ENGINES = ("orders", "subbasins") # see kinematicWave.kinematicWaveRouting
+SUBBASINS_PER_THREAD = 4 # number of sub-basins per Numba thread for the "subbasins" routing engine (see kinematicWave._setSubbasins)
+TOPOLOGY_CACHE_VERSION = 1 # bump when the content or layout of the cached topology arrays changes
 
 
 
@@ -89,48 +96,145 @@ def streamLookups(flow_dir, land_mask):
     max_num_ups_pixs = max(1, np.any(upstream_lookup != -1, 0).sum()) # maximum number of upstreams pixels
     return downstream_lookup, np.ascontiguousarray(upstream_lookup[:,:max_num_ups_pixs]).astype(int) 
 
-def topoDistFromSea(downstream_lookup, upstream_lookup):
-    """"""
-    num_pixels = downstream_lookup.size
-    topological_distance = - np.ones(num_pixels, int)
-    is_outlet = np.zeros(num_pixels, bool)
-    is_outlet[downstream_lookup == -1] = True
-    distance = 1
-    while (topological_distance == -1).any():
-        to_track = np.logical_and(is_outlet, topological_distance == -1)
-        topological_distance[to_track] = distance
-        next_ups = np.unique(upstream_lookup[to_track])
-        next_ups = next_ups[next_ups != -1]
-        is_outlet[next_ups] = True
-        distance += 1
-    return topological_distance
+def routingSchedule(order_start_stop, min_parallel_width):
+    '''
+    Group routing orders into blocks for kinematic_wave_parallel_tools.kinematicRouting.
+    Orders with at least min_parallel_width pixels are routed in parallel, each in its own block;
+    consecutive narrower orders (e.g. near outlets and along main stems) are merged into one block
+    that is routed serially in topological order, thus avoiding a parallel region per order.
+    Returns:
+        schedule (numpy.ndarray): [start, stop, parallel] index range in pixels_ordered of each block; size = num_blocks x 3
+    '''
+    widths = order_start_stop[:,1] - order_start_stop[:,0]
+    parallel = widths >= min_parallel_width
+    new_block = np.ones(widths.size, bool)
+    new_block[1:] = parallel[1:] | parallel[:-1]
+    first_orders = np.flatnonzero(new_block)
+    starts = order_start_stop[first_orders,0]
+    stops = np.append(starts[1:], order_start_stop[-1,1])
+    return np.column_stack((starts, stops, parallel[first_orders])).astype(int)
 
 
+def splitSideflow(sideflow, chan_m3, chan2_m3, chan2_m3_start, m3_limit, chan2_q_start, inv_chan_length, out=None):
+    '''
+    Split the channel sideflow [m3 s-1 m-1] between main channel and floodplains for split routing.
+    The ratio of main channel volume to total volume goes to the main channel when the floodplains are active
+    (i.e. total volume above M3Limit) and the sideflow is not negligible; the rest goes to the floodplains, together
+    with the constant QLimit discharge (chan2_q_start * inv_chan_length).
+    Arguments:
+        out (tuple of numpy.ndarray): optional (sideflow1, sideflow2) arrays where results are written in place.
+    Returns:
+        sideflow1, sideflow2 (numpy.ndarray): sideflow to main channel and to floodplains
+    '''
+    if out is None:
+        out = (np.empty_like(sideflow), np.empty_like(sideflow))
+    sideflow1, sideflow2 = out
+    kwpt.splitSideflow(sideflow, chan_m3, chan2_m3, chan2_m3_start, m3_limit, chan2_q_start, inv_chan_length, sideflow1, sideflow2)
+    return sideflow1, sideflow2
+
 
 # -------------------------------------------------------------------------------------------------
-# CLASS
+# CLASSES
 # -------------------------------------------------------------------------------------------------
 
+class TopologyCache:
+    """On-disk cache of the routing topology of kinematicWave objects (see TOPOLOGY_ARRAYS).
+    Each entry is a sub-directory of cache_dir named after a hash of the compressed LDD, the land mask and
+    the cut window, and holds one .npy file per array. Arrays are memory-mapped (read-only) when loaded,
+    so that warm starts and ensemble members sharing the same LDD skip the pre-processing of the flow
+    direction matrix. Entries are written to a temporary directory and renamed, so that concurrent runs
+    can safely share the same cache_dir."""
+
+    def __init__(self, cache_dir, cut_window=None):
+        self.cache_dir = cache_dir
+        self.cut_window = cut_window
+
+    def key(self, compressed_encoded_ldd, land_mask):
+        """Hash identifying the routing topology of a compressed LDD on a land mask"""
+        land_mask = np.ascontiguousarray(land_mask, dtype=bool)
+        digest = hashlib.sha1()
+        digest.update(repr((TOPOLOGY_CACHE_VERSION, land_mask.shape, self.cut_window)).encode())
+        digest.update(np.packbits(land_mask).tobytes())
+        digest.update(np.ascontiguousarray(compressed_encoded_ldd).astype(np.uint8).tobytes())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Return a dictionary of memory-mapped topology arrays, or None if the entry is missing or unreadable"""
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            return {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r") for name in TOPOLOGY_ARRAYS}
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, key, topology):
+        """Store the topology arrays (dictionary name: array) under key"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_" + key, dir=self.cache_dir)
+        try:
+            for name in TOPOLOGY_ARRAYS:
+                np.save(os.path.join(tmp_entry, name + ".npy"), np.ascontiguousarray(topology[name]))
+            os.rename(tmp_entry, os.path.join(self.cache_dir, key))
+        except OSError: # entry written in the meantime by another run
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
 class kinematicWave:
     """"""
 
-    def __init__(self, compressed_encoded_ldd, land_mask, alpha_channel, beta, space_delta, time_delta, alpha_floodplains=None, flagnancheck=False):
-        """"""
+    def __init__(self, compressed_encoded_ldd, land_mask, alpha_channel, beta, space_delta, time_delta, alpha_floodplains=None, flagnancheck=False,
+                 topology_cache=None, min_parallel_width=PARALLEL_MIN_ORDER_WIDTH, engine="orders", warm_start=False):
+        """alpha_channel (and alpha_floodplains) may be given as a (K, num_pixels) array, to route K discharge fields on the
+        same flow network in one traversal (see kinematicWaveRouting).
+        If topology_cache (TopologyCache) is given, the routing topology is read from it when available, and stored in it otherwise.
+        Routing orders with less than min_parallel_width pixels are routed serially (see routingSchedule).
+        engine (see ROUTING_ENGINES) selects the parallelisation strategy:
+            "orders": pixels of the same routing order are routed in parallel, one order after the other;
+            "subbasins": independent sub-basins are routed in parallel, each one serially (see _setSubbasins).
+        If warm_start is True, Newton-Raphson iterations start from the previous discharge when it lies within the analytical
+        bounds of the solution (see kinematic_wave_parallel_tools.solve1Pixel). The number of iterations of each pixel
+        in the last call to kinematicWaveRouting is stored in newton_iterations[section]."""
+        if engine not in ROUTING_ENGINES:
+            raise LisfloodError("Unknown kinematic wave routing engine '{}': it must be one of {}".format(engine, ", ".join(ROUTING_ENGINES)))
+        self.engine = engine
         # variable to avoid printing repeated warning messages
         self.kinematic_wave_warning_printed=False
         self.flagnancheck=flagnancheck
         # Parameters for the solution of the discretised Kinematic wave continuity equation
-        self.space_delta = space_delta
+        self.warm_start = warm_start
+        # parameters in the floating point type of alpha (e.g. float32 overland flow, see ModelPrecision)
+        dtype = np.result_type(alpha_channel, np.float32)
+        self.space_delta = np.ascontiguousarray(np.broadcast_to(space_delta, compressed_encoded_ldd.shape), dtype=dtype)
         self.beta = beta
         self.inv_beta = 1 / beta
         self.b_minus_1 = beta - 1
-        self.a_dx_div_dt_channel = alpha_channel * space_delta / time_delta
+        self.a_dx_div_dt_channel = np.atleast_2d(alpha_channel * space_delta / time_delta).astype(dtype, copy=False)
         self.b_a_dx_div_dt_channel = beta * self.a_dx_div_dt_channel
+        self.newton_iterations = {"main_channel": np.zeros(self.a_dx_div_dt_channel.shape, np.int32)}
         # If split-routing (floodplains)
         if alpha_floodplains is not None:
-            self.a_dx_div_dt_floodplains = alpha_floodplains * space_delta / time_delta
+            self.a_dx_div_dt_floodplains = np.atleast_2d(alpha_floodplains * space_delta / time_delta).astype(dtype, copy=False)
             self.b_a_dx_div_dt_floodplains = beta * self.a_dx_div_dt_floodplains
-        # Process flow direction matrix: downstream and upstream lookups, and routing orders
+            self.newton_iterations["floodplains"] = np.zeros(self.a_dx_div_dt_floodplains.shape, np.int32)
+        # Routing topology: read from cache if available, otherwise process the flow direction matrix
+        topology = None
+        if topology_cache is not None:
+            topology_key = topology_cache.key(compressed_encoded_ldd, land_mask)
+            topology = topology_cache.load(topology_key)
+        if topology is None:
+            self._processFlowMatrix(compressed_encoded_ldd, land_mask)
+            if topology_cache is not None:
+                topology_cache.save(topology_key, {name: getattr(self, name) for name in TOPOLOGY_ARRAYS})
+        else:
+            for name in TOPOLOGY_ARRAYS:
+                setattr(self, name, topology[name])
+        # Blocks of routing orders: wide orders are routed in parallel, narrow ones serially
+        self.schedule = routingSchedule(self.order_start_stop, min_parallel_width)
+        if self.engine == "subbasins":
+            self._setSubbasins()
+
+    def _processFlowMatrix(self, compressed_encoded_ldd, land_mask):
+        """Process flow direction matrix: downstream and upstream lookups, and routing orders"""
         flow_dir = decodeFlowMatrix(rebuildFlowMatrix(compressed_encoded_ldd, land_mask))
         self.downstream_lookup, self.upstream_lookup = streamLookups(flow_dir, land_mask)
         self.num_upstream_pixels = (self.upstream_lookup != -1).sum(1).astype(int) 
@@ -144,23 +248,34 @@ class kinematicWave:
         Liu et al. (2014), A layered approach to parallel computing for spatially distributed hydrological modeling,
         Environmental Modelling & Software 51, 221-227.
         Order MAX is given to pixels with no downstream relations (outlets); order MAX-1 is given to
-        pixels whose downstream pixels are all of order MAX; and so on."""
-        ocean_topo_distance = topoDistFromSea(self.downstream_lookup, self.upstream_lookup)
-        routing_order = ocean_topo_distance.max() - ocean_topo_distance
-        self.pixels_ordered = pd.DataFrame({"pixels": np.arange(routing_order.size), "order": routing_order})
-        try:
-            self.pixels_ordered = self.pixels_ordered.sort_values(["order", "pixels"]).set_index("order").squeeze()
-        except: # FOR COMPATIBILITY WITH OLDER PANDAS VERSIONS
-            self.pixels_ordered = self.pixels_ordered.sort(["order", "pixels"]).set_index("order").squeeze()
-        order_counts = self.pixels_ordered.groupby(self.pixels_ordered.index).count()
-        stop = order_counts.cumsum()
-        self.order_start_stop = np.column_stack((np.append(0, stop[:-1]), stop)).astype(int) 
-        self.pixels_ordered = self.pixels_ordered.values.astype(int) 
+        pixels whose downstream pixels are all of order MAX; and so on.
+        Orders are computed in a single breadth-first traversal from the outlets (see kinematic_wave_parallel_tools.routingOrders)."""
+        self.pixels_ordered, self.order_start_stop, num_reached = kwpt.routingOrders(self.downstream_lookup, self.upstream_lookup,
+                                                                                     self.num_upstream_pixels)
+        if num_reached != self.downstream_lookup.size:
+            raise LisfloodError("The flow direction map (LDD) contains loops: {} pixels do not drain to any outlet".format(
+                self.downstream_lookup.size - num_reached))
+
+    def _setSubbasins(self):
+        """Decompose the flow network into independent sub-basins for the "subbasins" routing engine.
+        Instead of a synchronisation barrier per routing order, there is one per sub-basin level (see
+        kinematic_wave_parallel_tools.subbasinDecomposition): headwater sub-basins are routed first, each
+        one serially by a single thread; the sub-basins downstream of confluences follow in a few short phases.
+        Sub-basins have about num_pixels / (SUBBASINS_PER_THREAD * num_threads) pixels."""
+        subbasin_size = max(1, self.pixels_ordered.size // (SUBBASINS_PER_THREAD * get_num_threads()))
+        self.subbasin_pixels, self.subbasin_start_stop, self.subbasins_ordered, self.level_start_stop =\
+            kwpt.subbasinDecomposition(self.downstream_lookup, self.upstream_lookup, self.num_upstream_pixels,
+                                       self.pixels_ordered, subbasin_size)
 
     def kinematicWaveRouting(self, discharge, specific_lateral_inflow, section="main_channel"):
-        """Kinematic wave routing: wrapper around kinematic_wave_parallel_tools.kinematicWave"""
-        # Lateral inflow (m3 s-1)
-        lateral_inflow = nx.evaluate("q * dx", local_dict={"q": specific_lateral_inflow, "dx": self.space_delta})
+        """Kinematic wave routing: wrapper around kinematic_wave_parallel_tools.kinematicWave.
+        discharge is updated in place. If the router was built with (K, num_pixels) alpha arrays, discharge and
+        specific_lateral_inflow are (K, num_pixels) arrays, and the K fields are routed in a single traversal
+        of the flow network, with the same results as K separate routers.
+        No temporary arrays are allocated: lateral inflow and the constant term of the Newton-Raphson method are
+        computed pixel by pixel within the Numba kernel."""
+        discharge = discharge[np.newaxis] if discharge.ndim == 1 else discharge # view: routed in place
+        specific_lateral_inflow = specific_lateral_inflow[np.newaxis] if specific_lateral_inflow.ndim == 1 else specific_lateral_inflow
         # Choose between main channel and floodplain routing
         if section == "main_channel":
             a_dx_div_dt = self.a_dx_div_dt_channel
@@ -170,13 +285,18 @@ class kinematicWave:
             b_a_dx_div_dt = self.b_a_dx_div_dt_floodplains
         else:
             raise Exception("The section parameter must be either 'main_channel' or 'floodplain'!")
-        # Constant term in f(x) evaluation for Newton-Raphson method
-        local_dict = {"a_dx_div_dt": a_dx_div_dt, "Qold": discharge, "b": self.beta, "lateral_inflow": lateral_inflow}
-        constant = nx.evaluate("a_dx_div_dt * Qold ** b + lateral_inflow", local_dict=local_dict)
         # Solve the Kinematic wave equation
-        kwpt.kinematicRouting(discharge, lateral_inflow, constant, self.upstream_lookup,\
-                              self.num_upstream_pixels, self.pixels_ordered, self.order_start_stop,\
-                              self.beta, self.inv_beta, self.b_minus_1, a_dx_div_dt, b_a_dx_div_dt)
+        if self.engine == "subbasins":
+            kwpt.subbasinRouting(discharge, specific_lateral_inflow, self.space_delta, self.upstream_lookup,\
+                                 self.num_upstream_pixels, self.subbasin_pixels, self.subbasin_start_stop,\
+                                 self.subbasins_ordered, self.level_start_stop,\
+                                 self.beta, self.inv_beta, self.b_minus_1, a_dx_div_dt, b_a_dx_div_dt,\
+                                 self.warm_start, self.newton_iterations[section])
+        else:
+            kwpt.kinematicRouting(discharge, specific_lateral_inflow, self.space_delta, self.upstream_lookup,\
+                                  self.num_upstream_pixels, self.pixels_ordered, self.schedule,\
+                                  self.beta, self.inv_beta, self.b_minus_1, a_dx_div_dt, b_a_dx_div_dt,\
+                                  self.warm_start, self.newton_iterations[section])
         if self.flagnancheck:
             if self.kinematic_wave_warning_printed==False:
                 if np.all(np.isfinite(discharge))==False:
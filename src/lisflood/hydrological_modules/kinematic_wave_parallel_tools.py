@@ -13,13 +13,13 @@ Unless required by applicable law or agreed to in writing, software distributed
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the Licence for the specific language governing permissions and limitations under the Licence.
 
-Collection of functions called by the Python module kinematic_wave_parallel.py. 
+Collection of functions called by the Python modules kinematic_wave_parallel.py and flow_network.py.
 """
 
 from math import fabs
 import numpy as np
 from numba import njit, prange
-from builtins import max
+from builtins import max, min
 
 
 
@@ -32,34 +32,74 @@ MIN_DISCHARGE = 1e-30 # Minimum allowed discharge value to avoid numerical insta
 # ROUTING FUNCTIONS
 # -------------------------------------------------------------------------------------------------
 @njit(parallel=True, fastmath=False, cache=True)
-def kinematicRouting(discharge, lateral_inflow, constant, upstream_lookup,\
-                     num_upstream_pixels, ordered_pixels, start_stop, beta, inv_beta,\
-                     b_minus_1, a_dx_div_dt, b_a_dx_div_dt):
-    """"""
-    num_orders = start_stop.shape[0]
-    # Iterate through routing orders (sets of pixels for which the kinemativc wave can be solved independently and thus in parallel)
-    for order in range(num_orders):
-        first = start_stop[order,0]
-        last = start_stop[order,1]
-        for index in prange(first, last):
-            solve1Pixel(ordered_pixels[index], discharge, lateral_inflow, constant, upstream_lookup,\
-                        num_upstream_pixels, a_dx_div_dt, b_a_dx_div_dt, beta, inv_beta, b_minus_1)
+def kinematicRouting(discharge, specific_lateral_inflow, space_delta, upstream_lookup,\
+                     num_upstream_pixels, ordered_pixels, schedule, beta, inv_beta,\
+                     b_minus_1, a_dx_div_dt, b_a_dx_div_dt, warm_start, iterations):
+    """Route K discharge fields on the same flow network in one traversal: discharge, specific_lateral_inflow, a_dx_div_dt,
+    b_a_dx_div_dt and iterations are (K, num_pixels) arrays; space_delta is a (num_pixels) array.
+    Each row of schedule is a [start, stop, parallel] block of ordered_pixels (see kinematic_wave_parallel.routingSchedule):
+    blocks made of a wide routing order are solved in parallel; blocks made of consecutive narrow routing orders are solved serially."""
+    num_blocks = schedule.shape[0]
+    # Iterate through blocks of routing orders (sets of pixels for which the kinemativc wave can be solved independently and thus in parallel)
+    for block in range(num_blocks):
+        first = schedule[block,0]
+        last = schedule[block,1]
+        if schedule[block,2]:
+            for index in prange(first, last):
+                solvePixelFields(ordered_pixels[index], discharge, specific_lateral_inflow, space_delta, upstream_lookup,\
+                                 num_upstream_pixels, a_dx_div_dt, b_a_dx_div_dt, beta, inv_beta, b_minus_1,\
+                                 warm_start, iterations)
+        else: # narrow orders: thread start-up would cost more than the solution
+            for index in range(first, last):
+                solvePixelFields(ordered_pixels[index], discharge, specific_lateral_inflow, space_delta, upstream_lookup,\
+                                 num_upstream_pixels, a_dx_div_dt, b_a_dx_div_dt, beta, inv_beta, b_minus_1,\
+                                 warm_start, iterations)
+
+@njit(parallel=True, fastmath=False, cache=True)
+def subbasinRouting(discharge, specific_lateral_inflow, space_delta, upstream_lookup,\
+                    num_upstream_pixels, subbasin_pixels, subbasin_start_stop, subbasins_ordered,\
+                    level_start_stop, beta, inv_beta, b_minus_1, a_dx_div_dt, b_a_dx_div_dt, warm_start, iterations):
+    """Alternative to kinematicRouting: sub-basins of the same level are routed in parallel, each by a single thread
+    that solves its pixels serially in topological order (see subbasinDecomposition). Results are identical to kinematicRouting."""
+    num_levels = level_start_stop.shape[0]
+    for level in range(num_levels):
+        for index in prange(level_start_stop[level,0], level_start_stop[level,1]):
+            subbasin = subbasins_ordered[index]
+            for pix_index in range(subbasin_start_stop[subbasin,0], subbasin_start_stop[subbasin,1]):
+                solvePixelFields(subbasin_pixels[pix_index], discharge, specific_lateral_inflow, space_delta, upstream_lookup,\
+                                 num_upstream_pixels, a_dx_div_dt, b_a_dx_div_dt, beta, inv_beta, b_minus_1,\
+                                 warm_start, iterations)
+
+@njit(nogil=True, fastmath=False, cache=True)
+def solvePixelFields(pix, discharge, specific_lateral_inflow, space_delta,\
+                     upstream_lookup, num_upstream_pixels, a_dx_div_dt,\
+                     b_a_dx_div_dt, beta, inv_beta, b_minus_1, warm_start, iterations):
+    """Call solve1Pixel for pixel pix of each of the K discharge fields ((K, num_pixels) arrays)"""
+    for field in range(discharge.shape[0]):
+        solve1Pixel(pix, discharge[field], specific_lateral_inflow[field], space_delta, upstream_lookup,\
+                    num_upstream_pixels, a_dx_div_dt[field], b_a_dx_div_dt[field], beta, inv_beta, b_minus_1,\
+                    warm_start, iterations[field])
 
 @njit(nogil=True, fastmath=False, cache=True)
-def solve1Pixel(pix, discharge, lateral_inflow, constant,\
+def solve1Pixel(pix, discharge, specific_lateral_inflow, space_delta,\
                       upstream_lookup, num_upstream_pixels, a_dx_div_dt,\
-                      b_a_dx_div_dt, beta, inv_beta, b_minus_1):
-    """"""
+                      b_a_dx_div_dt, beta, inv_beta, b_minus_1, warm_start, iterations):
+    """Solve the kinematic wave equation for pixel pix with Newton-Raphson iterations; the number of iterations is stored in iterations[pix].
+    If warm_start is True, iterations start from the previous discharge (discharge[pix] on entry) whenever it lies within the
+    analytically derived bounds of the solution, instead of the middle of these bounds."""
     count = 0
     previous_estimate = -1.0
     upstream_inflow = 0.0
     # Inflow from upstream pixels
     for ups_ix in range(num_upstream_pixels[pix]):
         upstream_inflow += discharge[upstream_lookup[pix,ups_ix]]
-    const_plus_ups_infl = upstream_inflow + constant[pix] # upstream_inflow + alpha*dx/dt*Qold**beta + dx*specific_lateral_inflow
+    # Constant term in f(x) evaluation for Newton-Raphson method: alpha*dx/dt*Qold**beta + dx*specific_lateral_inflow
+    constant = a_dx_div_dt[pix] * discharge[pix]**beta + specific_lateral_inflow[pix] * space_delta[pix]
+    const_plus_ups_infl = upstream_inflow + constant
     # If old discharge, upstream inflow and lateral inflow are below accuracy: set discharge to 0 and exit
     if const_plus_ups_infl <= NEWTON_TOL:
         discharge[pix] = 0
+        iterations[pix] = 0
         return
     # Initial discharge guess using analytically derived boundary values
     a_cpui_pow_b_m_1 = b_a_dx_div_dt[pix] * const_plus_ups_infl**b_minus_1
@@ -68,18 +108,23 @@ def solve1Pixel(pix, discharge, lateral_inflow, constant,\
     else:
         secant_bound = const_plus_ups_infl / (1 + a_cpui_pow_b_m_1**inv_beta)
     other_bound = ((const_plus_ups_infl - secant_bound) / a_dx_div_dt[pix])**inv_beta
-    discharge[pix] = (secant_bound + other_bound) / 2
-    error = closureError(discharge[pix], const_plus_ups_infl, a_dx_div_dt[pix], beta)
+    # Iterations on a double precision estimate, stored once in discharge (which may be single precision, see ModelPrecision)
+    estimate = float(discharge[pix])
+    if not (warm_start and min(secant_bound, other_bound) <= estimate <= max(secant_bound, other_bound)):
+        estimate = (secant_bound + other_bound) / 2
+    error = closureError(estimate, const_plus_ups_infl, a_dx_div_dt[pix], beta)
     # Iterations
-    while fabs(error) > NEWTON_TOL and discharge[pix] != previous_estimate and count < MAX_ITERS: # is previous_estimate useful?
-        previous_estimate = discharge[pix]
-        discharge[pix] -= error / (1 + b_a_dx_div_dt[pix] * discharge[pix]**b_minus_1)
-        discharge[pix] = max(discharge[pix], NEWTON_TOL)
-        error = closureError(discharge[pix], const_plus_ups_infl, a_dx_div_dt[pix], beta)
+    while fabs(error) > NEWTON_TOL and estimate != previous_estimate and count < MAX_ITERS: # is previous_estimate useful?
+        previous_estimate = estimate
+        estimate -= error / (1 + b_a_dx_div_dt[pix] * estimate**b_minus_1)
+        estimate = max(estimate, NEWTON_TOL)
+        error = closureError(estimate, const_plus_ups_infl, a_dx_div_dt[pix], beta)
         count += 1
     # If iterations converge to NEWTON_TOL, set value to 0
-    if discharge[pix] == NEWTON_TOL:
-        discharge[pix] = 0
+    if estimate == NEWTON_TOL:
+        estimate = 0.
+    discharge[pix] = estimate
+    iterations[pix] = count
     # to simulate inf or nan: discharge[pix] = 1.0/0.0
     # with gil:
     #    got_valid_value = np.isfinite(discharge[pix])
@@ -93,6 +138,61 @@ def closureError(discharge, upper_bound, a_dx_div_dt, beta):
 
 
 
+@njit(parallel=True, fastmath=False, cache=True)
+def splitSideflow(sideflow, chan_m3, chan2_m3, chan2_m3_start, m3_limit, chan2_q_start, inv_chan_length,\
+                  sideflow1, sideflow2):
+    """Called by kinematic_wave_parallel.splitSideflow: split the channel sideflow between main channel (sideflow1)
+    and floodplains (sideflow2) for split routing, in a single pass and without temporary arrays."""
+    for pix in prange(sideflow.size):
+        total_m3 = chan_m3[pix] + chan2_m3[pix]
+        # Sideflow is split according to the volume ratio if the floodplains are active, and if not too small
+        if total_m3 - chan2_m3_start[pix] > m3_limit[pix] and not fabs(sideflow[pix]) < 1e-7:
+            sideflow1[pix] = (chan_m3[pix] / total_m3 if total_m3 > 0 else 0.0) * sideflow[pix]
+        else:
+            sideflow1[pix] = sideflow[pix]
+        # a constant amount of water (QLimit discharge) is added to the floodplains, as kinematic wave gets slower with less water
+        sideflow2[pix] = sideflow[pix] - sideflow1[pix] + chan2_q_start[pix] * inv_chan_length[pix]
+
+
+
+# -------------------------------------------------------------------------------------------------
+# FLOW NETWORK OPERATIONS
+# -------------------------------------------------------------------------------------------------
+@njit(parallel=True, fastmath=False, cache=True)
+def accumulateFlux(values, upstream_lookup, num_upstream_pixels, ordered_pixels, schedule, accumulated):
+    """Called by flow_network.FlowNetwork.accuflux: sum of values over each pixel and all the pixels upstream of it.
+    Pixels are visited in routing order (see kinematicRouting for the meaning of schedule), so that the
+    accumulated values of the upstream pixels are final when a pixel is reached."""
+    num_blocks = schedule.shape[0]
+    for block in range(num_blocks):
+        first = schedule[block,0]
+        last = schedule[block,1]
+        if schedule[block,2]:
+            for index in prange(first, last):
+                accumulate1Pixel(ordered_pixels[index], values, upstream_lookup, num_upstream_pixels, accumulated)
+        else:
+            for index in range(first, last):
+                accumulate1Pixel(ordered_pixels[index], values, upstream_lookup, num_upstream_pixels, accumulated)
+
+@njit(nogil=True, fastmath=False, cache=True)
+def accumulate1Pixel(pix, values, upstream_lookup, num_upstream_pixels, accumulated):
+    """"""
+    total = values[pix]
+    for ups_ix in range(num_upstream_pixels[pix]):
+        total += accumulated[upstream_lookup[pix,ups_ix]]
+    accumulated[pix] = total
+
+@njit(parallel=True, fastmath=False, cache=True)
+def upstreamTotal(values, upstream_lookup, num_upstream_pixels, total):
+    """Called by flow_network.FlowNetwork.upstream: sum of values over the immediately upstream pixels of each pixel."""
+    for pix in prange(values.size):
+        pix_total = 0.0
+        for ups_ix in range(num_upstream_pixels[pix]):
+            pix_total += values[upstream_lookup[pix,ups_ix]]
+        total[pix] = pix_total
+
+
+
 # -------------------------------------------------------------------------------------------------
 # FLOW DIRECTION MATRIX PRE-PROCESSING FUNCTIONS
 # -------------------------------------------------------------------------------------------------
@@ -108,6 +208,118 @@ def updateUpstreamRouted(pixels_routed, downstream_lookup,\
                 ups_index += 1
             upstream_routed[downs_pix,ups_index] = True
 
+@njit(nogil=True, fastmath=False, cache=True)
+def routingOrders(downstream_lookup, upstream_lookup, num_upstream_pixels):
+    """Called by kinematic_wave_parallel.kinematicWave._setRoutingOrders.
+    Breadth-first traversal of the flow network from the outlets (Kahn ordering of the reversed graph),
+    followed by a counting sort of the pixels by routing order: O(num_pixels).
+    Returns the pixels sorted by routing order (and by index within each order), the [start, stop)
+    slice of each order in that array, and the number of pixels reached from the outlets."""
+    num_pixels = downstream_lookup.size
+    # Topological distance from the outlets (outlets = 0, not reached = -1), in breadth-first order
+    distance = -np.ones(num_pixels, np.int64)
+    queue = np.empty(num_pixels, np.int64)
+    tail = 0
+    for pix in range(num_pixels):
+        if downstream_lookup[pix] == -1:
+            distance[pix] = 0
+            queue[tail] = pix
+            tail += 1
+    head = 0
+    while head < tail:
+        pix = queue[head]
+        head += 1
+        for ups_ix in range(num_upstream_pixels[pix]):
+            ups_pix = upstream_lookup[pix,ups_ix]
+            distance[ups_pix] = distance[pix] + 1
+            queue[tail] = ups_pix
+            tail += 1
+    # Routing order = max distance - distance: counting sort, stable with respect to pixel index
+    max_distance = 0
+    for index in range(tail):
+        max_distance = max(max_distance, distance[queue[index]])
+    num_orders = max_distance + 1
+    start_stop = np.zeros((num_orders, 2), np.int64)
+    for index in range(tail):
+        start_stop[max_distance - distance[queue[index]],1] += 1
+    for order in range(1, num_orders):
+        start_stop[order,0] = start_stop[order-1,1]
+        start_stop[order,1] += start_stop[order,0]
+    ordered_pixels = np.empty(tail, np.int64)
+    position = start_stop[:,0].copy()
+    for pix in range(num_pixels):
+        if distance[pix] != -1:
+            order = max_distance - distance[pix]
+            ordered_pixels[position[order]] = pix
+            position[order] += 1
+    return ordered_pixels, start_stop, tail
+
+@njit(nogil=True, fastmath=False, cache=True)
+def subbasinDecomposition(downstream_lookup, upstream_lookup, num_upstream_pixels, ordered_pixels, subbasin_size):
+    """Called by kinematic_wave_parallel.kinematicWave._setSubbasins.
+    Decompose the flow network into sub-basins of about subbasin_size pixels: going downstream in topological order,
+    a pixel closes a sub-basin when the upstream pixels not yet assigned to other sub-basins are at least subbasin_size,
+    or when it is an outlet. Sub-basins are given a level: 0 for headwater sub-basins, and 1 + the maximum level of the
+    sub-basins draining into it otherwise; sub-basins of the same level are independent of each other.
+    Returns the pixels sorted by sub-basin (in topological order within each sub-basin), the [start, stop) slice of each
+    sub-basin in that array, the sub-basins sorted by level, and the [start, stop) slice of each level in that array."""
+    num_pixels = ordered_pixels.size
+    # Sub-basin outlets
+    unassigned_area = np.ones(num_pixels, np.int64)
+    is_subbasin_outlet = np.zeros(num_pixels, np.bool_)
+    for index in range(num_pixels):
+        pix = ordered_pixels[index]
+        for ups_ix in range(num_upstream_pixels[pix]):
+            ups_pix = upstream_lookup[pix,ups_ix]
+            if not is_subbasin_outlet[ups_pix]:
+                unassigned_area[pix] += unassigned_area[ups_pix]
+        if unassigned_area[pix] >= subbasin_size or downstream_lookup[pix] == -1:
+            is_subbasin_outlet[pix] = True
+    # Sub-basin of each pixel, from the outlets
+    subbasin = np.empty(num_pixels, np.int64)
+    num_subbasins = 0
+    for index in range(num_pixels - 1, -1, -1):
+        pix = ordered_pixels[index]
+        if is_subbasin_outlet[pix]:
+            subbasin[pix] = num_subbasins
+            num_subbasins += 1
+        else:
+            subbasin[pix] = subbasin[int(downstream_lookup[pix])]
+    # Sub-basin levels: upstream sub-basins are complete when their outlet is reached
+    level = np.zeros(num_subbasins, np.int64)
+    for index in range(num_pixels):
+        pix = ordered_pixels[index]
+        for ups_ix in range(num_upstream_pixels[pix]):
+            ups_subbasin = subbasin[upstream_lookup[pix,ups_ix]]
+            if ups_subbasin != subbasin[pix]:
+                level[subbasin[pix]] = max(level[subbasin[pix]], level[ups_subbasin] + 1)
+    # Pixels sorted by sub-basin, and sub-basins sorted by level (counting sorts)
+    subbasin_start_stop = np.zeros((num_subbasins, 2), np.int64)
+    for pix in range(num_pixels):
+        subbasin_start_stop[subbasin[pix],1] += 1
+    for sub in range(1, num_subbasins):
+        subbasin_start_stop[sub,0] = subbasin_start_stop[sub-1,1]
+        subbasin_start_stop[sub,1] += subbasin_start_stop[sub,0]
+    subbasin_pixels = np.empty(num_pixels, np.int64)
+    position = subbasin_start_stop[:,0].copy()
+    for index in range(num_pixels):
+        pix = ordered_pixels[index]
+        subbasin_pixels[position[subbasin[pix]]] = pix
+        position[subbasin[pix]] += 1
+    num_levels = level.max() + 1
+    level_start_stop = np.zeros((num_levels, 2), np.int64)
+    for sub in range(num_subbasins):
+        level_start_stop[level[sub],1] += 1
+    for lev in range(1, num_levels):
+        level_start_stop[lev,0] = level_start_stop[lev-1,1]
+        level_start_stop[lev,1] += level_start_stop[lev,0]
+    subbasins_ordered = np.empty(num_subbasins, np.int64)
+    position = level_start_stop[:,0].copy()
+    for sub in range(num_subbasins):
+        subbasins_ordered[position[level[sub]]] = sub
+        position[level[sub]] += 1
+    return subbasin_pixels, subbasin_start_stop, subbasins_ordered, level_start_stop
+
 @njit(nogil=True, fastmath=False, cache=True)
 def upDownLookups(flow_d8, land_mask, land_points, num_pixs, ix_adds):
     '''Called by catchment.streamLookups'''
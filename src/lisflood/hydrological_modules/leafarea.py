@@ -61,6 +61,8 @@ class leafarea(HydroModule):
             for veg, map_name in self.var.PRESCRIBED_LAI.items():
                 LAIName = generateName(binding[map_name], LAINr[i])
                 self.var.LAIX.loc[i,veg] = loadLAI(binding[map_name], LAIName, i)
+        # values of LAIX (interval, prescribed fraction, pixel), indexed by interval at each step
+        self.LAIXValues = np.ascontiguousarray(self.var.LAIX.values)
         # Calendar day to interval lookup list
         self.var.L1 = []
         j = 0
@@ -79,12 +81,7 @@ class leafarea(HydroModule):
             If EPIC is active, "Rainfed_prescribed" and "Irrigated_prescribed" represent the residuals not modelled by EPIC crops.
         """
         # Set prescribed LAI values ()
-        lai = self.var.LAIX.sel(interval=self.var.L1[self.var.CalendarDay]).copy()
-        ivegvalues = []
-        ivegvaluesx = []
-        for veg in self.var.prescribed_vegetation:
-            ivegvalues.append(self.var.vegetation.index(veg))
-            ivegvaluesx.append(self.var.coord_prescribed_vegetation['vegetation'].index(veg))
-        self.var.LAI.values[ivegvalues] = lai.values[ivegvaluesx]
-        # LAI term used for evapotranspiration calculations
+        lai = self.LAIXValues[self.var.L1[self.var.CalendarDay]]
+        self.var.LAI.values[self.var.vegetation_indexes.prescribed] = lai
+        # LAI term used for evapotranspiration calculations (prescribed fractions)
         self.var.LAITerm = np.exp(-self.var.kgb * lai)
\ No newline at end of file
@@ -173,8 +173,8 @@ class miscInitial(HydroModule):
         self.var.TotlWEI = scalar(0.0)
         self.var.TotCount = scalar(0.0)
 
-        self.var.SumETpot = maskinfo.in_zero()
-        self.var.SumETpotact = maskinfo.in_zero()
+        self.var.SumETpot = maskinfo.in_zero(np.float64)
+        self.var.SumETpotact = maskinfo.in_zero(np.float64)
 
         # Read the latitude (radians) from the template NetCDF file
         lat_deg = netcdf.read_lat_from_template(binding)
@@ -21,6 +21,9 @@ from ..global_modules.add1 import readmapsparse
 from ..global_modules.netcdf import xarray_reader
 
 
+METEO_FORCINGS = ('PrecipitationMaps', 'TavgMaps', 'ET0Maps', 'E0Maps')  # bindings of the meteo forcings read by readmeteo
+
+
 class readmeteo(object):
 
     """
@@ -36,7 +39,7 @@ class readmeteo(object):
         # initialise xarray readers
         if option['readNetcdfStack']:
             self.forcings = {}
-            for data in ['PrecipitationMaps', 'TavgMaps', 'ET0Maps', 'E0Maps']:
+            for data in METEO_FORCINGS:
                 self.forcings[data] = xarray_reader(data)
 
 # --------------------------------------------------------------------------
@@ -78,4 +81,4 @@ class readmeteo(object):
         self.var.ESRef = (self.var.EWRef + self.var.ETRef)/2
 
         if option['TemperatureInKelvin']:
-            self.var.Tavg -= 273.15
+            self.var.Tavg = self.var.Tavg - 273.15  # forcings may be read-only (see ForcingStore)
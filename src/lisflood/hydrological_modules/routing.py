@@ -16,8 +16,8 @@ See the Licence for the specific language governing permissions and limitations
 """
 from __future__ import print_function, absolute_import
 
-from pcraster import lddmask, accuflux, boolean, downstream, pit, path, lddrepair, ifthenelse, cover, nominal, uniqueid, \
-    catchment, upstream
+from pcraster import lddmask, boolean, downstream, pit, path, cover, nominal, uniqueid, \
+    catchment
 
 import numpy as np
 
@@ -26,9 +26,11 @@ from .reservoir import reservoir
 from .polder import polder
 from .inflow import inflow
 from .transmission import transmission
-from .kinematic_wave_parallel import kinematicWave, kwpt
+from .kinematic_wave_parallel import kinematicWave, TopologyCache, PARALLEL_MIN_ORDER_WIDTH, splitSideflow, kwpt
+from .flow_network import FlowNetwork, insertPits
+from .area_aggregator import AreaAggregator
 
-from ..global_modules.settings import LisSettings, MaskInfo
+from ..global_modules.settings import LisSettings, MaskInfo, CutMap
 from ..global_modules.add1 import loadmap, loadmap_base, compressArray, decompress
 from . import HydroModule
 
@@ -62,7 +64,7 @@ class routing(HydroModule):
         """ initial part of the routing module
         """
         maskinfo = MaskInfo.instance()
-        self.var.avgdis = maskinfo.in_zero()
+        self.var.avgdis = maskinfo.in_zero(np.float64)
         self.var.Beta = loadmap('beta')
         self.var.InvBeta = 1 / self.var.Beta
         # Inverse of beta for kinematic wave
@@ -95,7 +97,9 @@ class routing(HydroModule):
         # Needed if we want to calculate average values of variables
         # upstream of gauge locations
 
-        self.var.UpArea = accuflux(self.var.Ldd, self.var.PixelAreaPcr)
+        self.var.LddNetwork = FlowNetwork(compressArray(self.var.Ldd), ~maskinfo.info.mask)
+        # flow network of the Ldd on compressed arrays (Numba replacement of accuflux, upstream and downstream)
+        self.var.UpArea = decompress(self.var.LddNetwork.accuflux(self.var.PixelArea))
         # Upstream contributing area for each pixel
         # Note that you might expext that values of UpArea would be identical to
         # those of variable CatchArea (see below) at the outflow points.
@@ -122,8 +126,9 @@ class routing(HydroModule):
         # (important for correct mass balance check
         # any water generated outside of Ldd won't reach
         # channel anyway)
-        self.var.LddToChan = lddrepair(ifthenelse(self.var.IsChannelPcr, 5, self.var.Ldd))
+        self.var.LddToChan = insertPits(compressArray(self.var.Ldd), self.var.IsChannel)
         # Routing of runoff (incl. ground water)en
+        # (compressed ldd with pits at channel pixels)
         AtOutflow = boolean(pit(self.var.Ldd))
         # find outlet points...
 
@@ -156,19 +161,18 @@ class routing(HydroModule):
             self.var.AtLastPointC = np.bool8(compressArray(self.var.AtLastPoint))
             # assign unique identifier to each of them
         maskinfo = MaskInfo.instance()
-        lddC = compressArray(self.var.LddKinematic)
-        inAr = decompress(np.arange(maskinfo.info.mapC[0], dtype="int32"))
-        # giving a number to each non missing pixel as id
-        self.var.downstruct = (compressArray(downstream(self.var.LddKinematic, inAr))).astype("int32")
+        kinematic_network = FlowNetwork(compressArray(self.var.LddKinematic), ~maskinfo.info.mask)
+        self.var.downstruct = kinematic_network.downstreamIndex(maskinfo.info.mapC[0])
         # each upstream pixel gets the id of the downstream pixel
-        self.var.downstruct[lddC == 5] = maskinfo.info.mapC[0]
         # all pits gets a high number
         # upstream function in numpy
 
         OutflowPoints = nominal(uniqueid(self.var.AtLastPoint))
         # and assign unique identifier to each of them
         self.var.Catchments = (compressArray(catchment(self.var.Ldd, OutflowPoints))).astype(np.int32)
-        CatchArea = np.bincount(self.var.Catchments, weights=self.var.PixelArea)[self.var.Catchments]
+        self.var.CatchmentAggregator = AreaAggregator(self.var.Catchments)
+        # catchment totals (replaces np.take(np.bincount(Catchments, weights=...), Catchments))
+        CatchArea = self.var.CatchmentAggregator.areatotal(self.var.PixelArea)
         # define catchment for each outflow point
         # Compute area of each catchment [m2]
         # Note: in earlier versions this was calculated using the "areaarea" function,
@@ -249,7 +253,7 @@ class routing(HydroModule):
         # Initialise discharge at kinematic wave pixels (note that InvBeta is
         # simply 1/beta, computational efficiency!)
 
-        self.var.CumQ = maskinfo.in_zero()
+        self.var.CumQ = maskinfo.in_zero(np.float64)
         # ininialise sum of discharge to calculate average
 
 # ************************************************************
@@ -331,18 +335,19 @@ class routing(HydroModule):
         # Initialising cumulative output variables
         # These are all needed to compute the cumulative mass balance error
 
-        self.var.DischargeM3Out = maskinfo.in_zero()
+        self.var.DischargeM3Out = maskinfo.in_zero(np.float64)
         # cumulative discharge at outlet [m3]
-        self.var.TotalQInM3 = maskinfo.in_zero()
+        self.var.TotalQInM3 = maskinfo.in_zero(np.float64)
         # cumulative inflow from inflow hydrographs [m3]
-        self.var.sumDis = maskinfo.in_zero()
-        self.var.sumInWB = maskinfo.in_zero()
+        self.var.sumDis = maskinfo.in_zero(np.float64)
+        self.var.sumInWB = maskinfo.in_zero(np.float64)
 
     def initialSecond(self):
         """ initial part of the second channel routing module
         """
         settings = LisSettings.instance()
         option = settings.options
+        binding = settings.binding
         flags = settings.flags
 
 
@@ -384,7 +389,8 @@ class routing(HydroModule):
                 self.var.Chan2M3Start = self.var.ChannelAlpha2 * self.var.ChanLength * (self.var.QLimit ** self.var.Beta)
                 # virtual amount of water in the channel through second line
 
-                self.var.Chan2QStart = self.var.QLimit - compressArray(upstream(self.var.LddKinematic, decompress(self.var.QLimit)))
+                kinematic_network = FlowNetwork(compressArray(self.var.LddKinematic), ~MaskInfo.instance().info.mask)
+                self.var.Chan2QStart = self.var.QLimit - kinematic_network.upstream(self.var.QLimit)
                 # because kinematic routing with a low amount of discharge leads to long travel time:
                 # Starting Q for second line is set to a higher value
 
@@ -396,11 +402,27 @@ class routing(HydroModule):
                 self.var.Chan2QKin = (self.var.Chan2M3Kin * self.var.InvChanLength * self.var.InvChannelAlpha2) ** (self.var.InvBeta)
                 self.var.ChanQKin = (self.var.ChanM3Kin * self.var.InvChanLength * self.var.InvChannelAlpha) ** (self.var.InvBeta)
 
+        # On-disk cache of the routing topology (also used by the overland routers in surface_routing)
+        self.var.RoutingTopologyCache = None
+        if binding.get('RoutingTopologyCache'):
+            cut_window = tuple(CutMap.instance().cuts) if option['readNetcdfStack'] else None
+            self.var.RoutingTopologyCache = TopologyCache(binding['RoutingTopologyCache'], cut_window)
+
         # Initialise parallel kinematic wave router: main channel-only routing if self.var.ChannelAlpha2 is None; else split-routing(main channel + floodplains)
         maskinfo = MaskInfo.instance()
         self.river_router = kinematicWave(compressArray(self.var.LddKinematic), ~maskinfo.info.mask, self.var.ChannelAlpha,
                                           self.var.Beta, self.var.ChanLength, self.var.DtRouting,
-                                          alpha_floodplains=self.var.ChannelAlpha2, flagnancheck=flags['nancheck'])
+                                          alpha_floodplains=self.var.ChannelAlpha2, flagnancheck=flags['nancheck'],
+                                          topology_cache=self.var.RoutingTopologyCache,
+                                          min_parallel_width=int(binding.get('routingOrderWidth_parallelNumba', PARALLEL_MIN_ORDER_WIDTH)),
+                                          engine=binding.get('routingEngine_channel', 'orders'),
+                                          warm_start=binding.get('routingNewtonWarmStart', 'False') == 'True')
+        # Buffers for the channel sideflow, updated in place at each routing sub-step
+        if not option['dynamicWave']:
+            self.sideflow_chan_m3 = maskinfo.in_zero(np.float64)
+            self.sideflow_chan = maskinfo.in_zero(np.float64)
+            self.sideflow2_chan = maskinfo.in_zero(np.float64)
+            self.is_not_channel_kinematic = ~self.var.IsChannelKinematic
         
         if option['InitLisflood'] and option['repMBTs']:          
             self.var.StorageStepINIT= self.var.ChanM3Kin 
@@ -409,7 +431,7 @@ class routing(HydroModule):
                self.var.StorageStepINIT += self.var.ReservoirStorageIniM3  
             if option['simulateLakes']:  
                self.var.StorageStepINIT += self.var.LakeStorageIniM3 
-            self.var.StorageStepINIT = np.take(np.bincount(self.var.Catchments, weights=self.var.StorageStepINIT), self.var.Catchments) 
+            self.var.StorageStepINIT = self.var.CatchmentAggregator.areatotal(self.var.StorageStepINIT) 
                 
         if not option['InitLisflood'] and option['repMBTs']:  
            DisStructure = np.where(self.var.IsUpsOfStructureKinematicC, self.var.ChanQ * self.var.DtRouting, 0) 
@@ -421,14 +443,14 @@ class routing(HydroModule):
             if option['simulateLakes']:  
                self.var.StorageStepINIT += self.var.LakeStorageIniM3 
                DisStructure += np.where(compressArray(self.var.IsUpsOfStructureLake), 0.5 * self.var.ChanQ * self.var.DtRouting, 0) 
-            self.var.DischargeM3StructuresIni = np.take(np.bincount(self.var.Catchments, weights=DisStructure), self.var.Catchments)      
+            self.var.DischargeM3StructuresIni = self.var.CatchmentAggregator.areatotal(DisStructure)      
            else:                             
             self.var.StorageStepINIT= self.var.ChanM3Kin+self.var.Chan2M3Kin-self.var.Chan2M3Start                       
             if option['simulateReservoirs']: 
                self.var.StorageStepINIT += self.var.ReservoirStorageIniM3
             if option['simulateLakes']:   
                self.var.StorageStepINIT += self.var.LakeStorageIniM3
-            self.var.StorageStepINIT = np.take(np.bincount(self.var.Catchments, weights=self.var.StorageStepINIT), self.var.Catchments)    
+            self.var.StorageStepINIT = self.var.CatchmentAggregator.areatotal(self.var.StorageStepINIT)    
 # --------------------------------------------------------------------------
 # --------------------------------------------------------------------------
 
@@ -459,7 +481,8 @@ class routing(HydroModule):
             # ***** SIDEFLOW
             # ************************************************************
 
-            SideflowChanM3 = self.var.ToChanM3RunoffDt.copy()
+            SideflowChanM3 = self.sideflow_chan_m3
+            np.copyto(SideflowChanM3, self.var.ToChanM3RunoffDt)
             if option['openwaterevapo']:
                 SideflowChanM3 -= self.var.EvaAddM3Dt
             if option['wateruse']:
@@ -481,22 +504,21 @@ class routing(HydroModule):
                     
             ### check mass balance within routing ###
             if option['repMBTs']:  
+             AddedTerms, AddedSigns = [self.var.ToChanM3RunoffDt], [1]
+             if option['inflow']:
+                 AddedTerms.append(self.var.QInDt)
+                 AddedSigns.append(1)
+             if option['openwaterevapo']:
+                 AddedTerms.append(self.var.EvaAddM3Dt)
+                 AddedSigns.append(-1)
+             if option['wateruse']:
+                 AddedTerms.append(self.var.WUseAddM3Dt)
+                 AddedSigns.append(-1)
+             # all terms are summed over the catchments in one pass
              if (NoRoutingExecuted<1):
-                 self.var.AddedTRUN = np.take(np.bincount(self.var.Catchments, weights=self.var.ToChanM3RunoffDt.copy()),self.var.Catchments)
-                 if option['inflow']:
-                     self.var.AddedTRUN += np.take(np.bincount(self.var.Catchments, weights=self.var.QInDt),self.var.Catchments)
-                 if option['openwaterevapo']:
-                     self.var.AddedTRUN -= np.take(np.bincount(self.var.Catchments, weights=self.var.EvaAddM3Dt.copy()),self.var.Catchments)
-                 if option['wateruse']:
-                     self.var.AddedTRUN -= np.take(np.bincount(self.var.Catchments, weights=self.var.WUseAddM3Dt.copy()),self.var.Catchments)
+                 self.var.AddedTRUN = self.var.CatchmentAggregator.areatotal(*AddedTerms, coefficients=AddedSigns)
              else:
-                 self.var.AddedTRUN += np.take(np.bincount(self.var.Catchments, weights=self.var.ToChanM3RunoffDt.copy()),self.var.Catchments)
-                 if option['inflow']:
-                     self.var.AddedTRUN += np.take(np.bincount(self.var.Catchments, weights=self.var.QInDt),self.var.Catchments) 
-                 if option['openwaterevapo']:
-                     self.var.AddedTRUN -= np.take(np.bincount(self.var.Catchments, weights=self.var.EvaAddM3Dt.copy()),self.var.Catchments)
-                 if option['wateruse']:
-                     self.var.AddedTRUN -= np.take(np.bincount(self.var.Catchments, weights=self.var.WUseAddM3Dt.copy()),self.var.Catchments)      
+                 self.var.CatchmentAggregator.areatotal(*AddedTerms, coefficients=AddedSigns, add_to=self.var.AddedTRUN)
                                      
             # Runoff (surface runoff + flow out of Upper and Lower Zone), outflow from
             # reservoirs and lakes and inflow from external hydrographs are added to the channel
@@ -509,7 +531,9 @@ class routing(HydroModule):
             # instead of inflow its outflow
 
             
-            SideflowChan = np.where(self.var.IsChannelKinematic, SideflowChanM3 * self.var.InvChanLength * self.var.InvDtRouting,0)
+            SideflowChan = np.multiply(SideflowChanM3, self.var.InvChanLength, out=self.sideflow_chan)
+            SideflowChan *= self.var.InvDtRouting
+            np.copyto(SideflowChan, 0.0, where=self.is_not_channel_kinematic)
 
             # ************************************************************
             # ***** KINEMATIC WAVE                        ****************
@@ -545,29 +569,11 @@ class routing(HydroModule):
                 #  ---- Double Routing ---------------
                 # routing is split in two (virtual) channels)
 
-                # Ad
-                SideflowRatio = np.where((self.var.ChanM3Kin + self.var.Chan2M3Kin) > 0, self.var.ChanM3Kin/(self.var.ChanM3Kin+self.var.Chan2M3Kin), 0.0)
-                
-
-          
-                # CM ##################################
-                # self.var.Sideflow1Chan = np.where(self.var.ChanM3Kin > self.var.M3Limit, SideflowRatio*SideflowChan, SideflowChan)
-                # This is creating instability because ChanM3Kin can be < M3Limit between two routing sub-steps
-                # TO BY REPLACED WITH THE FOLLOWING
-                self.var.Sideflow1Chan = np.where((self.var.ChanM3Kin + self.var.Chan2M3Kin - self.var.Chan2M3Start) > self.var.M3Limit,
-                                                   SideflowRatio*SideflowChan, SideflowChan)
-                #######################################
-                
-                
-
-                self.var.Sideflow1Chan = np.where(np.abs(SideflowChan) < 1e-7, SideflowChan, self.var.Sideflow1Chan)
-                # too small values are avoided
-                Sideflow2Chan = SideflowChan - self.var.Sideflow1Chan
-               
-                Sideflow2Chan = Sideflow2Chan + self.var.Chan2QStart * self.var.InvChanLength   # originale
-                # as kinematic wave gets slower with less water
-                # a constant amount of water has to be added
-                # -> add QLimit discharge
+                # Sideflow to main channel (volume ratio, if floodplains are active and sideflow is not too small) and to floodplains
+                # (remainder, plus a constant QLimit discharge as kinematic wave gets slower with less water)
+                self.var.Sideflow1Chan, Sideflow2Chan = splitSideflow(SideflowChan, self.var.ChanM3Kin, self.var.Chan2M3Kin,
+                                                                      self.var.Chan2M3Start, self.var.M3Limit, self.var.Chan2QStart,
+                                                                      self.var.InvChanLength, out=(self.var.Sideflow1Chan, self.sideflow2_chan))
 
                 # --- Main channel routing ---
                 self.river_router.kinematicWaveRouting(self.var.ChanQKin, self.var.Sideflow1Chan, "main_channel")
@@ -649,7 +655,7 @@ class routing(HydroModule):
                   ChanQAvgSR = self.var.sumDisDay/self.var.NoRoutSteps
                   sum1=ChanQAvgSR.copy()
                   sum1[self.var.AtLastPointC == 0] = 0
-                  OutStep = np.take(np.bincount(self.var.Catchments,weights=sum1 * self.var.DtSec),self.var.Catchments) 
+                  OutStep = self.var.CatchmentAggregator.areatotal(sum1 * self.var.DtSec) 
   
                   StorageStep=[]
                   StorageStep= self.var.ChanM3Kin.copy()+self.var.Chan2M3Kin.copy()-self.var.Chan2M3Start.copy()                
@@ -664,29 +670,27 @@ class routing(HydroModule):
                      sum1 =self.var.ChanQ.copy()
                      StorageStep =  StorageStep + self.var.ReservoirStorageM3.copy()
                      DisStructureSR = np.where(self.var.IsUpsOfStructureKinematicC, sum1 * self.var.DtRouting, 0)
-                     DischargeM3StructuresR = np.take(np.bincount(self.var.Catchments, weights=DisStructureSR), self.var.Catchments)                
+                     DischargeM3StructuresR = self.var.CatchmentAggregator.areatotal(DisStructureSR)
                      DischargeM3StructuresR -= self.var.DischargeM3StructuresIni
                        
                   if option['simulateLakes']:
                      sum1 =self.var.ChanQ.copy()
                      StorageStep =  StorageStep + self.var.LakeStorageM3Balance.copy()
                      DisStructureSR = np.where(self.var.IsUpsOfStructureKinematicC, sum1 * self.var.DtRouting, 0)
-                     DischargeM3StructuresR = np.take(np.bincount(self.var.Catchments, weights=DisStructureSR), self.var.Catchments)               
                      DisLake = maskinfo.in_zero()
                      np.put(DisLake, self.var.LakeIndex, 0.5 * self.var.LakeInflowCC * self.var.DtRouting)
-                     DischargeM3Lake = np.take(np.bincount(self.var.Catchments, weights=DisLake),self.var.Catchments)
-                     DischargeM3StructuresR += DischargeM3Lake
+                     DischargeM3StructuresR = self.var.CatchmentAggregator.areatotal(DisStructureSR, DisLake)
 
                      DischargeM3StructuresR -= self.var.DischargeM3StructuresIni                    
                                         
                   # Mass Balance Error due to the Split Routing module
-                  StorageStep1=np.take(np.bincount(self.var.Catchments, weights=StorageStep), self.var.Catchments)
+                  StorageStep1 = self.var.CatchmentAggregator.areatotal(StorageStep)
                   
                   self.var.MBErrorSplitRoutingM3  = - StorageStep1 + self.var.StorageStepINIT - OutStep  - DischargeM3StructuresR + self.var.AddedTRUN
                   # Discharge error at the outlet pointt [m3/s]
                   QoutCorrection=self.var.MBErrorSplitRoutingM3/self.var.DtRouting                  
                   QoutCorrection[self.var.AtLastPointC == 0] = 0
-                  self.var.OutletDischargeErrorSplitRouting = np.take(np.bincount(self.var.Catchments,weights=QoutCorrection),self.var.Catchments)                  
+                  self.var.OutletDischargeErrorSplitRouting = self.var.CatchmentAggregator.areatotal(QoutCorrection)                  
 
                   self.var.StorageStepINIT= StorageStep1.copy()+DischargeM3StructuresR 
  
@@ -18,6 +18,7 @@ See the Licence for the specific language governing permissions and limitations
 from __future__ import absolute_import, print_function
 
 import numpy as np
+from numba import njit, prange
 
 from ..global_modules.settings import MaskInfo, LisSettings
 from ..global_modules.add1 import loadmap, defsoil
@@ -35,6 +36,29 @@ def pressure2SoilMoistureFun(residual_sm, sat_sm, GenuA, GenuN, GenuM):
     return Mualem
 
 
+@njit(parallel=True, fastmath=False, cache=True)
+def soilPixelAverages(SoilFraction, variables, averages, TASealedAll, EWaterAll, TaInterceptionCUM, TaCUM, ESActCUM):
+    """Pixel averages (weighted sums over the soil fractions, as LisfloodModel_ini.deffraction) of variables,
+    (vegetation, pixel) arrays, written to averages in a single traversal of SoilFraction. The first three variables
+    are TaInterception, Ta and ESAct: TASealedAll (evaporation of intercepted water of sealed areas) is added to the
+    first average and EWaterAll (evaporation from open water) to the third one, and the first three averages are
+    added to the cumulated values TaInterceptionCUM, TaCUM and ESActCUM."""
+    num_vars = len(variables)
+    num_vegs, num_pixs = SoilFraction.shape
+    for pix in prange(num_pixs):
+        for i in range(num_vars):
+            averages[i][pix] = 0.
+        for veg in range(num_vegs):
+            fraction = SoilFraction[veg,pix]
+            for i in range(num_vars):
+                averages[i][pix] += fraction * variables[i][veg,pix]
+        averages[0][pix] += TASealedAll[pix]
+        averages[2][pix] += EWaterAll[pix]
+        TaInterceptionCUM[pix] += averages[0][pix]
+        TaCUM[pix] += averages[1][pix]
+        ESActCUM[pix] += averages[2][pix]
+
+
 class soil(HydroModule):
 
     """
@@ -408,13 +432,19 @@ class soil(HydroModule):
            self.var.CumInterception = self.var.initialiseVariableAllVegetation('CumIntInitValue')
         
         # Initialising cumulative output variables  needed to compute the cumulative mass balance error
-        self.var.TotalPrecipitation =  maskinfo.in_zero() # precipitation [mm]
-        self.var.TaCUM =  maskinfo.in_zero() # Cumulative transpiration [mm]
+        self.var.TotalPrecipitation =  maskinfo.in_zero(np.float64) # precipitation [mm]
+        self.var.TaCUM =  maskinfo.in_zero(np.float64) # Cumulative transpiration [mm]
         self.var.TaWB = maskinfo.in_zero() # Cumulative transpiration [mm] at the end of the computational time step (waterbalance.py)
-        self.var.TaInterceptionCUM =  maskinfo.in_zero() # Cumulative evaporation from interception store [mm]
+        self.var.TaInterceptionCUM =  maskinfo.in_zero(np.float64) # Cumulative evaporation from interception store [mm]
         self.var.TaInterceptionWB =  maskinfo.in_zero() # Evaporation from interception store [mm] at the end of the computational time step (waterbalance.py)
-        self.var.ESActCUM =  maskinfo.in_zero() # Cumulative evaporation [mm]
+        self.var.ESActCUM =  maskinfo.in_zero(np.float64) # Cumulative evaporation [mm]
         self.var.ESActWB = maskinfo.in_zero() # Cumulative evaporation [mm] at the end of the computational time step (waterbalance.py)
+        # Pixel averages of the vegetation fractions, updated in place at each step (see dynamic_perpixel)
+        self.pixel_averages = ('TaInterceptionAll', 'TaPixel', 'ESActPixel', 'PrefFlowPixel', 'InfiltrationPixel',
+                               'SeepTopToSubPixelA', 'SeepTopToSubPixelB', 'SeepSubToGWPixel',
+                               'Theta1aPixel', 'Theta1bPixel', 'Theta2Pixel')
+        for name in self.pixel_averages:
+            setattr(self.var, name, maskinfo.in_zero())
         self.var.SoilMoistureStressDays = self.var.allocateVariableAllVegetation() # number of days in simulation with soil moisture stress (days)
         self.var.Theta1a = self.var.allocateVariableAllVegetation() # Theta values are just allocated here - their values are dynamically compute in soilloop.py
         self.var.Theta1b = self.var.allocateVariableAllVegetation()
@@ -472,43 +502,32 @@ class soil(HydroModule):
         """ dynamic part of the soil module
             Calculation per Pixel
         """
-        self.var.TaInterceptionAll = self.var.deffraction(self.var.TaInterception) + self.var.DirectRunoffFraction * self.var.TASealed
-        self.var.TaInterceptionCUM += self.var.TaInterceptionAll
+        variables = (self.var.TaInterception, self.var.Ta, self.var.ESAct, self.var.PrefFlow, self.var.Infiltration,
+                     self.var.SeepTopToSubA, self.var.SeepTopToSubB, self.var.SeepSubToGW,
+                     self.var.Theta1a, self.var.Theta1b, self.var.Theta2)
+        # a common type, as Numba indexes homogeneous tuples only (states may be float32, see ModelPrecision)
+        dtype = np.result_type(*(variable.values for variable in variables))
+        variables = tuple(np.asarray(variable.values, dtype) for variable in variables)
+        num_pixel = variables[0].shape[1]
+        soilPixelAverages(np.broadcast_to(np.asarray(self.var.SoilFraction), variables[0].shape), variables,
+                          tuple(getattr(self.var, name) for name in self.pixel_averages),
+                          np.broadcast_to(self.var.DirectRunoffFraction * self.var.TASealed, num_pixel),
+                          np.broadcast_to(self.var.WaterFraction * self.var.EWaterAct, num_pixel),
+                          self.var.TaInterceptionCUM, self.var.TaCUM, self.var.ESActCUM)
+        # Pixel averages (weighted by the soil fractions) in [mm] per timestep, computed in one pass (see soilPixelAverages):
+        # evaporation of intercepted water (TaInterceptionAll, including sealed areas), transpiration (TaPixel),
+        # soil evaporation (ESActPixel, including open water), preferential flow (PrefFlowPixel), infiltration
+        # (InfiltrationPixel), seepage (SeepTopToSubPixelA, SeepTopToSubPixelB, SeepSubToGWPixel) and soil moisture
+        # of each layer (Theta1aPixel, Theta1bPixel, Theta2Pixel, to report catchment-averaged soil moisture profiles)
+        # (no transpiration, soil evaporation, preferential flow, infiltration or seepage from direct runoff fraction)
         self.var.TaInterceptionWB = self.var.TaInterceptionAll
-        # Cumulative evaporation of intercepted water [mm]
-
-        self.var.TaPixel = self.var.deffraction(self.var.Ta)
-        # pixel-average transpiration in [mm] per timestep
-        # (no transpiration from direct runoff fraction)
-        self.var.TaCUM += self.var.TaPixel
         self.var.TaWB = self.var.TaPixel
-        self.var.ESActPixel = self.var.deffraction(self.var.ESAct) + self.var.WaterFraction * self.var.EWaterAct
-        # Pixel-average soil evaporation in [mm] per time step
-        # (no evaporation from direct runoff fraction)
-        self.var.ESActCUM += self.var.ESActPixel
         self.var.ESActWB = self.var.ESActPixel
+        # Cumulative evaporation of intercepted water, transpiration and soil evaporation [mm] (TaInterceptionCUM,
+        # TaCUM and ESActCUM), and their values at the end of the computational time step (waterbalance.py)
 
-        self.var.PrefFlowPixel = self.var.deffraction(self.var.PrefFlow)
-        # Pixel-average preferential flow in [mm] per timestep
-        # (no preferential flow from direct runoff fraction)
-        self.var.InfiltrationPixel = self.var.deffraction(self.var.Infiltration)
-        # Pixel-average infiltration in [mm] per timestep
-        # (no infiltration in direct runoff fraction)
         tot_sm = self.var.W1a + self.var.W1b + self.var.W2
-        for landuse, veg_list in self.var.LANDUSE_VEGETATION.items():
-            iveg_list,iveg_list_pres,ilanduse = self.var.get_indexes_from_landuse_and_veg_list_GLOBAL(landuse, veg_list)
+        for iveg_list,iveg_list_pres,ilanduse in self.var.vegetation_indexes.landuse_vegetation:
             self.var.Theta[iveg_list] = self.var.SoilFraction[iveg_list_pres] * tot_sm[iveg_list] / self.var.SoilDepthTotal[ilanduse]
-        ax_veg=self.var.SoilFraction.dims.index("vegetation")
-        soil_fract_sum = np.sum(self.var.SoilFraction,ax_veg)
-        self.var.ThetaAll = np.where(soil_fract_sum > 0, np.sum(self.var.Theta,ax_veg) / soil_fract_sum, 0)
-
-        self.var.SeepTopToSubPixelA = self.var.deffraction(self.var.SeepTopToSubA)
-        self.var.SeepTopToSubPixelB = self.var.deffraction(self.var.SeepTopToSubB)
-        self.var.SeepSubToGWPixel = self.var.deffraction(self.var.SeepSubToGW)
-        # Pixel-average seepage values in [mm] per timestep
-        # (no seepage from direct runoff fraction)
-        
-        # the variables below were added to report catchment-averaged soil moisture profiles
-        self.var.Theta1aPixel = self.var.deffraction(self.var.Theta1a)
-        self.var.Theta1bPixel = self.var.deffraction(self.var.Theta1b)
-        self.var.Theta2Pixel = self.var.deffraction(self.var.Theta2)
+        soil_fract_sum = np.sum(self.var.SoilFraction,0)
+        self.var.ThetaAll = np.where(soil_fract_sum > 0, np.sum(self.var.Theta,0) / soil_fract_sum, 0)
@@ -19,7 +19,7 @@ from nine import range
 
 import numpy as np
 import numexpr as nx
-from numba import njit, prange, vectorize
+from numba import njit, prange, vectorize, get_num_threads
 from builtins import min, max
 # from . import HydroModule
 from ..global_modules.settings import LisSettings, MaskInfo
@@ -75,6 +75,115 @@ def potentialTranspiration(TranspirMax, TaInterception):
     return np.maximum(TranspirMax - TaInterception, 0)
 
 
+@njit(parallel=True, fastmath=False, cache=True)
+def transpiration_water_stress(index_veg, index_landuse, fill_index, stress_days, DtDay, InvDtDay, ETRef, isFrozenSoil,
+                               CropGroupNumber, WFC1, WWP1, WFC1a, WWP1a, WFC1b, WWP1b, WPF3a, WPF3b, potential_transpiration,
+                               RWS, Ta, SoilMoistureStressDays, W1a, W1b, W1, WFilla, WFillb):
+    """Soil water stress and actual transpiration of the prescribed vegetation fractions (index_veg, with land uses
+    index_landuse): RWS, Ta, W1a, W1b and W1 are updated in place. WFilla and WFillb (water use) are computed for the
+    fraction at position fill_index of index_veg (if fill_index >= 0), SoilMoistureStressDays if stress_days is True."""
+    num_pixs = ETRef.size
+    for k in range(index_veg.size):
+        veg = index_veg[k]
+        landuse = index_landuse[k]
+        for pix in prange(num_pixs):
+            ETRefTerm = min(0.1 * ETRef[pix] * InvDtDay, 1.0)
+            CropGroup = CropGroupNumber[landuse,pix]
+            swdf = 1 / (0.76 + 1.5 * ETRefTerm) - 0.10 * (5 - CropGroup)
+            # soil water depletion fraction (easily available soil water)
+            # Van Diepen et al., 1988: WOFOST 6.0, p.87
+            # to avoid a strange behaviour of the p-formula's, ETRef is set to a maximum of
+            # 10 mm/day. Thus, p will range from 0.15 to 0.45 at ETRef eq 10 and
+            # CropGroupNumber 1-5
+            if CropGroup <= 2.5:
+                swdf = swdf + (ETRefTerm - 0.6) / (CropGroup * (CropGroup + 3))
+            # correction for crop groups 1 and 2 (Van Diepen et al, 1988)
+            swdf = max(min(swdf, 1.0), 0)
+            # p is between 0 and 1
+            WCrit1 = ((1 - swdf) * (WFC1[landuse,pix] - WWP1[landuse,pix])) + WWP1[landuse,pix]
+            WCrit1a = ((1 - swdf) * (WFC1a[landuse,pix] - WWP1a[landuse,pix])) + WWP1a[landuse,pix]
+            WCrit1b = ((1 - swdf) * (WFC1b[landuse,pix] - WWP1b[landuse,pix])) + WWP1b[landuse,pix]
+            # critical moisture amount ([mm] water slice) for all layers
+            if k == fill_index:
+                WFilla[pix] = min(WCrit1a, WPF3a[landuse,pix])
+                WFillb[pix] = min(WCrit1b, WPF3b[landuse,pix])
+                # if water use is calculated, get the filling of the soil layer for either pF3 or WCrit1
+                # that is the amount of water the soil gets filled by water from irrigation
+            if (WCrit1 - WWP1[landuse,pix]) > 0:
+                RWS[veg,pix] = max(min((W1[landuse,pix] - WWP1[landuse,pix]) / (WCrit1 - WWP1[landuse,pix]), 1), 0)
+            else:
+                RWS[veg,pix] = 1
+            # Transpiration reduction factor (in case of water stress)
+            # if WCrit1 = WWP1, RWS is zero there is no water stress in that case
+            if stress_days:
+                SoilMoistureStressDays[veg,pix] = DtDay if RWS[veg,pix] < 1 else 0
+                # Count number of days with soil water stress, RWS is between 0 and 1
+                # no reduction of Transpiration at RWS=1, at RWS=0 there is no Transpiration at all
+            if isFrozenSoil[pix]:
+                Ta[veg,pix] = 0
+                # transpiration is 0 when soil is frozen
+            else:
+                Ta[veg,pix] = min(RWS[veg,pix] * potential_transpiration[veg,pix], max(W1[landuse,pix] - WWP1[landuse,pix], 0))
+                # actual transpiration based on both layers 1a and 1b
+            # calculate distribution where to take Ta from:
+            # 1st: above wCrit from layer 1a
+            # 2nd: above Wcrit from layer 1b
+            # 3rd:  distribute take off according to soil moisture availability below wcrit
+            Ta1a = min(Ta[veg,pix], max(W1a[landuse,pix] - WCrit1a, 0))  # from layer 1a (<= unstressed layer 1a availability)
+            restTa = max(Ta[veg,pix] - Ta1a, 0)  # transpiration left after layer 1a unstressed water has been abstracted
+            Ta1b = min(restTa, max(W1b[landuse,pix] - WCrit1b, 0))  # from layer 1b (<= unstressed layer 1b availability)
+            restTa = max(restTa - Ta1b, 0)  # transpiration left after layers 1a and 1b unstressed water have been abstracted
+            stressed_availability_1a = max(W1a[landuse,pix] - Ta1a - WWP1a[landuse,pix], 0)
+            stressed_availability_1b = max(W1b[landuse,pix] - Ta1b - WWP1b[landuse,pix], 0)
+            stressed_availability_tot = stressed_availability_1a + stressed_availability_1b
+            if stressed_availability_tot > 0:
+                # distribution of abstractions of soil moisture below the critical value
+                # proportionally to each root-zone layer (1a and 1b) "stressed" availability
+                Ta1a += stressed_availability_1a / stressed_availability_tot * restTa
+                Ta1b += stressed_availability_1b / stressed_availability_tot * restTa
+            W1a[landuse,pix] -= Ta1a
+            W1b[landuse,pix] -= Ta1b
+            W1[veg,pix] = W1a[landuse,pix] + W1b[landuse,pix]
+
+
+@njit(nogil=True, fastmath=False, cache=True)
+def soilColumnsSchedule(NoSubS, order, num_chunks):
+    """Schedule of the sub-stepping of soilColumnsWaterBalance: flat indexes of the (vegetation, pixel) pairs to simulate
+    (NoSubS > 0) are written to order, binned by decreasing number of sub-steps (powers of 2, stable within each bin),
+    and split into num_chunks contiguous chunks of about the same cost (sub-steps + 1).
+    Returns the number of pairs to simulate and the bounds of the chunks in order."""
+    NoSubS = NoSubS.ravel()
+    num_bins = 64
+    bins = np.zeros(num_bins + 1, np.int64)
+    total_cost = 0
+    for p in range(NoSubS.size):
+        if NoSubS[p] > 0:
+            bins[num_bins - 1 - int(np.log2(NoSubS[p]))] += 1
+            total_cost += NoSubS[p] + 1
+    # start of each bin in order (most sub-steps first)
+    start = 0
+    for b in range(num_bins + 1):
+        count = bins[b]
+        bins[b] = start
+        start += count
+    num_active = start
+    for p in range(NoSubS.size):
+        if NoSubS[p] > 0:
+            b = num_bins - 1 - int(np.log2(NoSubS[p]))
+            order[bins[b]] = p
+            bins[b] += 1
+    chunk_bounds = np.full(num_chunks + 1, num_active, np.int64)
+    chunk_bounds[0] = 0
+    chunk = 1
+    cost = 0
+    for k in range(num_active):
+        while chunk < num_chunks and cost * num_chunks >= chunk * total_cost:
+            chunk_bounds[chunk] = k
+            chunk += 1
+        cost += NoSubS[order[k]] + 1
+    return num_active, chunk_bounds
+
+
 @njit(parallel=True, fastmath=False, cache=True)
 def soilColumnsWaterBalance(index_landuse_all, is_irrigated, is_paddy_irrig, paddy_inactive, DtDay,
                             AvailableWaterForInfiltration, Rain, SnowMelt,
@@ -96,220 +205,222 @@ def soilColumnsWaterBalance(index_landuse_all, is_irrigated, is_paddy_irrig, pad
                             SoilDepth1a, SoilDepth1b, SoilDepth2,
                             WS1a, WS1b, WS1, WS2,
                             UpperZoneK, DrainedFraction, GwPercStep,
-                            UZOutflow, UZ, GwPercUZLZ):
+                            UZOutflow, UZ, GwPercUZLZ,
+                            scratch, NoSubS, order, num_chunks):
+    """Water balance of the soil columns of all vegetation fractions, in two parallel passes over the (vegetation, pixel)
+    pairs: the first one computes the fluxes up to the Courant condition and the number of sub-steps NoSubS of each pair,
+    the second one the seepage between the soil layers in NoSubS sub-steps and the upper zone. Pairs are scheduled in
+    the second pass by soilColumnsSchedule in num_chunks chunks (one per thread) of about the same number of sub-steps.
+    Scratch buffers (preallocated, see soilloop.initial): scratch, (8, vegetation, pixel) float64 array (unsaturated
+    conductivity, available water and capacity of the layers); NoSubS, (vegetation, pixel) int64 array; order,
+    (vegetation * pixel) int64 array."""
     num_vegs, num_pixs = Interception.shape
-    rain_plus_snowmelt = Rain + SnowMelt
+    KUnSat1a, KUnSat1b, KUnSat2 = scratch[0], scratch[1], scratch[2]
+    AvailableWater1a, AvailableWater1b, AvailableWater2 = scratch[3], scratch[4], scratch[5]
+    CapacityLayer1, CapacityLayer2 = scratch[6], scratch[7]
+    # Paddy fractions: only pixels where the paddy is inactive are simulated (row of paddy_inactive, or -2 if none)
+    paddy_row = np.full(num_vegs, -1, np.int64)
     count_paddy_crop = 0
-    
-
-    for veg in range(num_vegs):   
-    
+    for veg in range(num_vegs):
         if is_paddy_irrig[veg]:
-            _inactive_paddy = paddy_inactive[count_paddy_crop]
-            if not _inactive_paddy.any(): # if no paddy is inactive, skip the vegetation fraction 
-                continue
-            is_drained_irrigation = False
-            sim_pixels = np.arange(num_pixs)[_inactive_paddy]
-            count_paddy_crop += 1
-        else:
-            is_drained_irrigation = is_irrigated[veg] and (DrainedFraction > 0)
-            sim_pixels = np.arange(num_pixs)
+            if paddy_inactive[count_paddy_crop].any():
+                paddy_row[veg] = count_paddy_crop
+                count_paddy_crop += 1
+            else:
+                paddy_row[veg] = -2
+
+    for p in prange(num_vegs * num_pixs):
+        veg = p // num_pixs
+        pix = p - veg * num_pixs
+        if paddy_row[veg] == -2 or (paddy_row[veg] >= 0 and not paddy_inactive[paddy_row[veg],pix]):
+            NoSubS[veg,pix] = 0
+            continue
         landuse = index_landuse_all[veg]
-        NoSubS = np.empty(sim_pixels.size, dtype=np.int_)
-        DtSub =  np.empty(sim_pixels.size)   ### merge 3 stef
-        KUnSat1a, KUnSat1b, KUnSat2 = np.empty(sim_pixels.size), np.empty(sim_pixels.size), np.empty(sim_pixels.size)                         #| REMOVE BEFORE NEW
-        AvailableWater1a, AvailableWater1b, AvailableWater2 = np.empty(sim_pixels.size), np.empty(sim_pixels.size), np.empty(sim_pixels.size) #| CALIBRATION
-        CapacityLayer1, CapacityLayer2 = np.empty(sim_pixels.size), np.empty(sim_pixels.size)                                                 #| (SEE [*] BELOW)   Stef WHY??
-        for q in prange(sim_pixels.size):
-            pix = sim_pixels[q]
 
-            # ************************************************************
-            # ***** AVAILABLE WATER FOR INFILTRATION ****************************
-            # ************************************************************
-            # Domain: AvailableWaterForInfiltration only used for permeable fraction
-            # DirectRunoff is total for whole pixel (permeable + direct runoff areas)
-            AvailableWaterForInfiltration[veg,pix] = max(rain_plus_snowmelt[pix] + LeafDrainage[veg,pix] - Interception[veg,pix], 0.)
-            # Water available for infiltration during this timestep [mm]
-            # ************************************************************
-            # ***** ACTUAL BARE SOIL EVAPORATION *************************
-            # ************************************************************
-            # ESActPixel valid for whole pixel
-            if AvailableWaterForInfiltration[veg,pix] > AvWaterThreshold:
-                DSLR[veg,pix] = 1
-            else:
-                DSLR[veg,pix] += DtDay
-            # Days since last rain (minimum value=1)
-            # AvWaterThreshold in mm (Stroosnijder, 1987 in Supit, p. 92)
-            # Note that this equation was originally designed for DAILY time steps
-            # to make it work with ANY time step AvWaterThreshold has to be provided
-            # as an INTENSITY in the binding (AvWaterRateThreshold), which isn't quite
-            # right (possible solution: keep track of total AvailableWaterForInfiltration
-            # during last 24 hrs look at this later)
-            if isFrozenSoil[pix]:
-                ESAct[veg,pix] = 0. # soil evaporation is 0 when soil is frozen
-            else:
-                ESAct[veg,pix] = ESMax[veg,pix] * (np.sqrt(DSLR[veg,pix]) - np.sqrt(DSLR[veg,pix] - 1))
-                # Reduction of actual soil evaporation is assumed to be proportional to the square root of time
-                # ESAct in [mm] per timestep
-                ESAct[veg,pix] = max(min(ESAct[veg,pix], W1[veg,pix] - WRes1[landuse,pix]), 0.)
-                # either ESAct or availabe water from layer 1a and 1b
-                # distributing ESAct over layer 1a and 1b, take the water from 1a first
-                testSupply1a = W1a[veg,pix] - WRes1a[landuse,pix]
-                EsAct1a = min(ESAct[veg,pix], testSupply1a)
-                EsAct1b = max(ESAct[veg,pix] - testSupply1a, 0.)
-                W1a[veg,pix] = max(W1a[veg,pix] - EsAct1a, WRes1a[landuse,pix])
-                W1b[veg,pix] = max(W1b[veg,pix] - EsAct1b, WRes1b[landuse,pix])
-            W1[veg,pix] = W1a[veg,pix] + W1b[veg,pix]
-            # evaporation is subtracted from W1a (top layer) and W1b
-            # ************************************************************
-            # ***** INFILTRATION CAPACITY ********************************
-            # ************************************************************
-            # Domain: permeable fraction of pixel only            
-            RelSat1 = min(W1[veg,pix] / WS1[landuse,pix], 1.0) if PoreSpaceNotZero1a[landuse,pix] else 0.0
-            # Relative saturation term of the first two layers. This will allow to have more infiltration
-            # than the storage capacity of layer 1
-            # Setting this to  a maximum of 1
-            # will prevent MV creation due to small rounding errors
-            # 'if' statement prevents division by zero for zero-depth soils
-
-            SatFraction = 1.0 - (1.0 - RelSat1) ** b_Xinanjiang[pix]
-            # Fraction of pixel that is at saturation as a function of
-            # the ratio Theta1/ThetaS1. Distribution function taken from
-            # Zhao,1977, as cited in Todini, 1996 (JoH 175, 339-382)
-            InfiltrationPot = 0.0 if isFrozenSoil[pix] else StoreMaxPervious[landuse,pix] * (1. - SatFraction) ** PowerInfPot[pix] * DtDay
-            # Potential infiltration per time step [mm], which is the available pore space in the
-            # pervious fraction of each pixel (1-SatFraction) times the depth of the upper soil layer.
-            # For derivation see Appendix A in Todini, 1996
-            # When the soil is frozen (frostindex larger than threshold), potential
-            # infiltration is zero
-            # ************************************************************
-            # ***** PREFERENTIAL FLOW (Rapid bypass soil matrix) *********
-            # ************************************************************
-            # Domain: permeable fraction of pixel only
-            # PrefFlowPixel valid for whole pixel
-            PrefFlow[veg,pix] = (RelSat1 ** PowerPrefFlow[pix]) * AvailableWaterForInfiltration[veg,pix]
-            # Assumption: fraction of available water that bypasses the soil matrix
-            # (added directly to Upper Zone) is power function of the
-            # relative saturation of the topsoil
-            AvailableWaterForInfiltration[veg,pix] -= PrefFlow[veg,pix]
-            # Update water availabe for infiltration
-            # ************************************************************
-            # ***** ACTUAL INFILTRATION AND SURFACE RUNOFF ***************
-            # ************************************************************
-            # Domain: permeable fraction of pixel only
-            # SurfaceRunoff, InfiltrationPixel are valid for whole pixel
-            Infiltration[veg,pix] = max(min(AvailableWaterForInfiltration[veg,pix], InfiltrationPot), 0.)
-            # infiltration in [mm] per timestep
-            # Maximum infiltration is equal to Rainfall-Interception-Snow+Snowmelt
-            # if  +Inflitration is more than the maximum storage capacity of layer 1a, than the rest goes to 1b
-            # could happen because InfiltrationPot is calculated based on layer 1a + 1b
-            testW1a = W1a[veg,pix] + Infiltration[veg,pix]
-               # sum up W1a and inflitration to test if it is > saturated WS1a
-            #self.var.Infiltration[sLoop] = np.where(testW1a > self.var.WS1a[sLoop], self.var.WS1a[sLoop] - self.var.W1a[sLoop] ,self.var.Infiltration[sLoop])
-               # in case we want to put it to runoff
-            W1a[veg,pix] = min(WS1a[landuse,pix], testW1a)
-            W1b[veg,pix] += max(testW1a - WS1a[landuse,pix], 0.)
-            # soil moisture amount is adjusted
-            # ************************************************************
-            # ***** SOIL MOISTURE: FLUXES BETWEEN SOIL LAYERS   **********
-            # ************************************************************
-            # Domain: permeable fraction of pixel only
-            # SeepTopToSubPixel,SeepSubToGWPixel valid for whole pixel
-            # Flow between layer 1 and 2 and seepage out of layer 2: based on Darcy's
-            # equation, assuming seepage is entirely gravity-driven,
-            # so seepage rate equals unsaturated conductivity
-            # The following calculations are performed to determine how many
-            # sub-steps are needed to achieve sufficient numerical stability
-            KUnSat1a[q] = unsaturatedConductivity(W1a[veg,pix], PoreSpaceNotZero1a[landuse,pix], WRes1a[landuse,pix], WS1a[landuse,pix],
+        # ************************************************************
+        # ***** AVAILABLE WATER FOR INFILTRATION ****************************
+        # ************************************************************
+        # Domain: AvailableWaterForInfiltration only used for permeable fraction
+        # DirectRunoff is total for whole pixel (permeable + direct runoff areas)
+        AvailableWaterForInfiltration[veg,pix] = max(Rain[pix] + SnowMelt[pix] + LeafDrainage[veg,pix] - Interception[veg,pix], 0.)
+        # Water available for infiltration during this timestep [mm]
+        # ************************************************************
+        # ***** ACTUAL BARE SOIL EVAPORATION *************************
+        # ************************************************************
+        # ESActPixel valid for whole pixel
+        if AvailableWaterForInfiltration[veg,pix] > AvWaterThreshold:
+            DSLR[veg,pix] = 1
+        else:
+            DSLR[veg,pix] += DtDay
+        # Days since last rain (minimum value=1)
+        # AvWaterThreshold in mm (Stroosnijder, 1987 in Supit, p. 92)
+        # Note that this equation was originally designed for DAILY time steps
+        # to make it work with ANY time step AvWaterThreshold has to be provided
+        # as an INTENSITY in the binding (AvWaterRateThreshold), which isn't quite
+        # right (possible solution: keep track of total AvailableWaterForInfiltration
+        # during last 24 hrs look at this later)
+        if isFrozenSoil[pix]:
+            ESAct[veg,pix] = 0. # soil evaporation is 0 when soil is frozen
+        else:
+            ESAct[veg,pix] = ESMax[veg,pix] * (np.sqrt(DSLR[veg,pix]) - np.sqrt(DSLR[veg,pix] - 1))
+            # Reduction of actual soil evaporation is assumed to be proportional to the square root of time
+            # ESAct in [mm] per timestep
+            ESAct[veg,pix] = max(min(ESAct[veg,pix], W1[veg,pix] - WRes1[landuse,pix]), 0.)
+            # either ESAct or availabe water from layer 1a and 1b
+            # distributing ESAct over layer 1a and 1b, take the water from 1a first
+            testSupply1a = W1a[veg,pix] - WRes1a[landuse,pix]
+            EsAct1a = min(ESAct[veg,pix], testSupply1a)
+            EsAct1b = max(ESAct[veg,pix] - testSupply1a, 0.)
+            W1a[veg,pix] = max(W1a[veg,pix] - EsAct1a, WRes1a[landuse,pix])
+            W1b[veg,pix] = max(W1b[veg,pix] - EsAct1b, WRes1b[landuse,pix])
+        W1[veg,pix] = W1a[veg,pix] + W1b[veg,pix]
+        # evaporation is subtracted from W1a (top layer) and W1b
+        # ************************************************************
+        # ***** INFILTRATION CAPACITY ********************************
+        # ************************************************************
+        # Domain: permeable fraction of pixel only            
+        RelSat1 = min(W1[veg,pix] / WS1[landuse,pix], 1.0) if PoreSpaceNotZero1a[landuse,pix] else 0.0
+        # Relative saturation term of the first two layers. This will allow to have more infiltration
+        # than the storage capacity of layer 1
+        # Setting this to  a maximum of 1
+        # will prevent MV creation due to small rounding errors
+        # 'if' statement prevents division by zero for zero-depth soils
+
+        SatFraction = 1.0 - (1.0 - RelSat1) ** b_Xinanjiang[pix]
+        # Fraction of pixel that is at saturation as a function of
+        # the ratio Theta1/ThetaS1. Distribution function taken from
+        # Zhao,1977, as cited in Todini, 1996 (JoH 175, 339-382)
+        InfiltrationPot = 0.0 if isFrozenSoil[pix] else StoreMaxPervious[landuse,pix] * (1. - SatFraction) ** PowerInfPot[pix] * DtDay
+        # Potential infiltration per time step [mm], which is the available pore space in the
+        # pervious fraction of each pixel (1-SatFraction) times the depth of the upper soil layer.
+        # For derivation see Appendix A in Todini, 1996
+        # When the soil is frozen (frostindex larger than threshold), potential
+        # infiltration is zero
+        # ************************************************************
+        # ***** PREFERENTIAL FLOW (Rapid bypass soil matrix) *********
+        # ************************************************************
+        # Domain: permeable fraction of pixel only
+        # PrefFlowPixel valid for whole pixel
+        PrefFlow[veg,pix] = (RelSat1 ** PowerPrefFlow[pix]) * AvailableWaterForInfiltration[veg,pix]
+        # Assumption: fraction of available water that bypasses the soil matrix
+        # (added directly to Upper Zone) is power function of the
+        # relative saturation of the topsoil
+        AvailableWaterForInfiltration[veg,pix] -= PrefFlow[veg,pix]
+        # Update water availabe for infiltration
+        # ************************************************************
+        # ***** ACTUAL INFILTRATION AND SURFACE RUNOFF ***************
+        # ************************************************************
+        # Domain: permeable fraction of pixel only
+        # SurfaceRunoff, InfiltrationPixel are valid for whole pixel
+        Infiltration[veg,pix] = max(min(AvailableWaterForInfiltration[veg,pix], InfiltrationPot), 0.)
+        # infiltration in [mm] per timestep
+        # Maximum infiltration is equal to Rainfall-Interception-Snow+Snowmelt
+        # if  +Inflitration is more than the maximum storage capacity of layer 1a, than the rest goes to 1b
+        # could happen because InfiltrationPot is calculated based on layer 1a + 1b
+        testW1a = W1a[veg,pix] + Infiltration[veg,pix]
+           # sum up W1a and inflitration to test if it is > saturated WS1a
+        #self.var.Infiltration[sLoop] = np.where(testW1a > self.var.WS1a[sLoop], self.var.WS1a[sLoop] - self.var.W1a[sLoop] ,self.var.Infiltration[sLoop])
+           # in case we want to put it to runoff
+        W1a[veg,pix] = min(WS1a[landuse,pix], testW1a)
+        W1b[veg,pix] += max(testW1a - WS1a[landuse,pix], 0.)
+        # soil moisture amount is adjusted
+        # ************************************************************
+        # ***** SOIL MOISTURE: FLUXES BETWEEN SOIL LAYERS   **********
+        # ************************************************************
+        # Domain: permeable fraction of pixel only
+        # SeepTopToSubPixel,SeepSubToGWPixel valid for whole pixel
+        # Flow between layer 1 and 2 and seepage out of layer 2: based on Darcy's
+        # equation, assuming seepage is entirely gravity-driven,
+        # so seepage rate equals unsaturated conductivity
+        # The following calculations are performed to determine how many
+        # sub-steps are needed to achieve sufficient numerical stability
+        KUnSat1a[veg,pix] = unsaturatedConductivity(W1a[veg,pix], PoreSpaceNotZero1a[landuse,pix], WRes1a[landuse,pix], WS1a[landuse,pix],
                                                     KSat1a[landuse,pix], GenuInvM1a[landuse,pix], GenuM1a[landuse,pix])
-            KUnSat1b[q] = unsaturatedConductivity(W1b[veg,pix], PoreSpaceNotZero1b[landuse,pix], WRes1b[landuse,pix], WS1b[landuse,pix],
+        KUnSat1b[veg,pix] = unsaturatedConductivity(W1b[veg,pix], PoreSpaceNotZero1b[landuse,pix], WRes1b[landuse,pix], WS1b[landuse,pix],
                                                     KSat1b[landuse,pix], GenuInvM1b[landuse,pix], GenuM1b[landuse,pix])
-            KUnSat2[q] = unsaturatedConductivity(W2[veg,pix], PoreSpaceNotZero2[landuse,pix], WRes2[landuse,pix], WS2[landuse,pix],
+        KUnSat2[veg,pix] = unsaturatedConductivity(W2[veg,pix], PoreSpaceNotZero2[landuse,pix], WRes2[landuse,pix], WS2[landuse,pix],
                                                    KSat2[landuse,pix], GenuInvM2[landuse,pix], GenuM2[landuse,pix])
-            # Unsaturated conductivity at the beginning of this time step [mm/day]
-            AvailableWater1a[q] = W1a[veg,pix] - WRes1a[landuse,pix]
-            AvailableWater1b[q] = W1b[veg,pix] - WRes1b[landuse,pix]
-            AvailableWater2[q] = W2[veg,pix] - WRes2[landuse,pix]
-            # Available water in both soil layers [mm] # OPTIMIZE: COMPUTE IT BEFORE unsaturatedConductivity; ALSO COMPUTE SAT-RES AT INITIALISATION
-            CapacityLayer1[q] = WS1b[landuse,pix] - W1b[veg,pix]
-            CapacityLayer2[q] = WS2[landuse,pix] - W2[veg,pix]
-            # Available storage capacity in subsoil
-            CourantTopToSubA = 0. if AvailableWater1a[q] == 0 else KUnSat1a[q] * DtDay / AvailableWater1a[q]
-            CourantTopToSubB = 0. if AvailableWater1b[q] == 0 else KUnSat1b[q] * DtDay / AvailableWater1b[q]
-            CourantSubToGW = 0. if AvailableWater2[q] == 0 else KUnSat2[q] * DtDay / AvailableWater2[q]
-            # Courant condition for computed soil moisture fluxes:
-            # if Courant gt CourantCrit: sub-steps needed for required numerical accuracy
-            # 'If'-statement prevents division by zero when available water equals zero:
-            # in that case the unsaturated conductivity is zero as well, so
-            # solution will be stable.
-            CourantSoil = max(CourantTopToSubA, CourantTopToSubB, CourantSubToGW)
-            # Both flow between soil layers and flow out of layer two
-            # need to be numerically stable, so number of sub-steps is
-            # based on process with largest Courant number
-            NoSubS[q] = max(1, np.ceil(CourantSoil / CourantCrit))
-            
-
-            
-            
-        ### NoSubSteps = int(np.nanmax(NoSubS)) # merge3                      #| [*] UNINDENTED CODE BLOCK KEPT FOR CONSISTENCY: IT SHOULD BE REMOVED
-        # Number of sub-steps needed for required numerical       #| WHEN A NEW CALIBRATION IS PERFORMED AS NOW THE NUMBER OF SUB-TIME-STEPS
-        # accuracy. Always greater than or equal to 1             #| CAN BE SET INDEPENDENTLY FOR EACH PIXEL (BEFORE IT COULD NOT BE DONE
-        # (otherwise division by zero!)                           #| BECAUSE OF VECTORIZATION)
-        ### DtSub = DtDay / NoSubSteps    #merge3                             #|
-        # DtSub=spatial(DtDay)/mapmaximum(NoSubSteps)             #|
-        # Corresponding sub-timestep [days]                       #|
-        # Soil loop is looping for the maximum of NoSubsteps      #|
-        # therefore DtSub is calculated as part of the timestep   #|
-        # according to the maximum of NoSubsteps                  #|              
-        ### for q in prange(sim_pixels.size):   merge3                      #|
-            pix = sim_pixels[q]
+        # Unsaturated conductivity at the beginning of this time step [mm/day]
+        AvailableWater1a[veg,pix] = W1a[veg,pix] - WRes1a[landuse,pix]
+        AvailableWater1b[veg,pix] = W1b[veg,pix] - WRes1b[landuse,pix]
+        AvailableWater2[veg,pix] = W2[veg,pix] - WRes2[landuse,pix]
+        # Available water in both soil layers [mm] # OPTIMIZE: COMPUTE IT BEFORE unsaturatedConductivity; ALSO COMPUTE SAT-RES AT INITIALISATION
+        CapacityLayer1[veg,pix] = WS1b[landuse,pix] - W1b[veg,pix]
+        CapacityLayer2[veg,pix] = WS2[landuse,pix] - W2[veg,pix]
+        # Available storage capacity in subsoil
+        CourantTopToSubA = 0. if AvailableWater1a[veg,pix] == 0 else KUnSat1a[veg,pix] * DtDay / AvailableWater1a[veg,pix]
+        CourantTopToSubB = 0. if AvailableWater1b[veg,pix] == 0 else KUnSat1b[veg,pix] * DtDay / AvailableWater1b[veg,pix]
+        CourantSubToGW = 0. if AvailableWater2[veg,pix] == 0 else KUnSat2[veg,pix] * DtDay / AvailableWater2[veg,pix]
+        # Courant condition for computed soil moisture fluxes:
+        # if Courant gt CourantCrit: sub-steps needed for required numerical accuracy
+        # 'If'-statement prevents division by zero when available water equals zero:
+        # in that case the unsaturated conductivity is zero as well, so
+        # solution will be stable.
+        CourantSoil = max(CourantTopToSubA, CourantTopToSubB, CourantSubToGW)
+        # Both flow between soil layers and flow out of layer two
+        # need to be numerically stable, so number of sub-steps is
+        # based on process with largest Courant number
+        NoSubS[veg,pix] = max(1, np.ceil(CourantSoil / CourantCrit))
+        # Number of sub-steps needed for required numerical accuracy, set independently for each pixel.
+        # Always greater than or equal to 1 (otherwise division by zero!)
+
+    # Pixels with many sub-steps are spread over the threads (see soilColumnsSchedule)
+    _, chunk_bounds = soilColumnsSchedule(NoSubS, order, num_chunks)
+    for chunk in prange(num_chunks):
+        for k in range(chunk_bounds[chunk], chunk_bounds[chunk+1]):
+            veg = order[k] // num_pixs
+            pix = order[k] - veg * num_pixs
+            landuse = index_landuse_all[veg]
             WTemp1a = W1a[veg,pix]
             WTemp1b = W1b[veg,pix]
             WTemp2 = W2[veg,pix]
             # Copy current value of W1 and W2 to temporary variables,
             # because computed fluxes may need correction for storage
             # capacity of subsoil and in case soil is frozen (after loop)
-            SeepTopToSubA[veg,pix] = 0.
-            SeepTopToSubB[veg,pix] = 0.
-            # Initialize top- to subsoil flux (accumulated value for all sub-steps)
-            SeepSubToGW[veg,pix] = 0.
-            # Initialize fluxes out of subsoil (accumulated value for all sub-steps)
             # Start iterating
-            DtSub[q] = DtDay / NoSubS[q] ###  merge 3 (NoSubSteps)  
-            for i in range(NoSubS[q]):  ### merge 3 (NoSubSteps)
+            DtSub = DtDay / NoSubS[veg,pix]
+            KUnSat1a, KUnSat1b, KUnSat2 = scratch[0,veg,pix], scratch[1,veg,pix], scratch[2,veg,pix]
+            AvailableWater1a, AvailableWater1b, AvailableWater2 = scratch[3,veg,pix], scratch[4,veg,pix], scratch[5,veg,pix]
+            CapacityLayer1, CapacityLayer2 = scratch[6,veg,pix], scratch[7,veg,pix]
+            SeepTopToSubA_, SeepTopToSubB_, SeepSubToGW_ = 0., 0., 0.
+            # Initialize top- to subsoil flux and fluxes out of subsoil (accumulated value for all sub-steps)
+            # Sub-steps on local copies of the scratch values and fluxes (same operations, kept in registers)
+            for i in range(NoSubS[veg,pix]):
                 if i > 0:
-                    KUnSat1a[q] = unsaturatedConductivity(WTemp1a, PoreSpaceNotZero1a[landuse,pix], WRes1a[landuse,pix], WS1a[landuse,pix],
-                                                            KSat1a[landuse,pix], GenuInvM1a[landuse,pix], GenuM1a[landuse,pix])
-                    KUnSat1b[q] = unsaturatedConductivity(WTemp1b, PoreSpaceNotZero1b[landuse,pix], WRes1b[landuse,pix], WS1b[landuse,pix],
-                                                            KSat1b[landuse,pix], GenuInvM1b[landuse,pix], GenuM1b[landuse,pix])
-                    KUnSat2[q] = unsaturatedConductivity(WTemp2, PoreSpaceNotZero2[landuse,pix], WRes2[landuse,pix], WS2[landuse,pix],
-                                                           KSat2[landuse,pix], GenuInvM2[landuse,pix], GenuM2[landuse,pix])
+                    KUnSat1a = unsaturatedConductivity(WTemp1a, PoreSpaceNotZero1a[landuse,pix], WRes1a[landuse,pix], WS1a[landuse,pix],
+                                                       KSat1a[landuse,pix], GenuInvM1a[landuse,pix], GenuM1a[landuse,pix])
+                    KUnSat1b = unsaturatedConductivity(WTemp1b, PoreSpaceNotZero1b[landuse,pix], WRes1b[landuse,pix], WS1b[landuse,pix],
+                                                       KSat1b[landuse,pix], GenuInvM1b[landuse,pix], GenuM1b[landuse,pix])
+                    KUnSat2 = unsaturatedConductivity(WTemp2, PoreSpaceNotZero2[landuse,pix], WRes2[landuse,pix], WS2[landuse,pix],
+                                                      KSat2[landuse,pix], GenuInvM2[landuse,pix], GenuM2[landuse,pix])
                     # Unsaturated conductivity [mm/day]
-                SeepTopToSubSubStepA = min(KUnSat1a[q] * DtSub[q], CapacityLayer1[q])
-                SeepTopToSubSubStepB = min(KUnSat1b[q] * DtSub[q], CapacityLayer2[q])
-                
+                SeepTopToSubSubStepA = min(KUnSat1a * DtSub, CapacityLayer1)
+                SeepTopToSubSubStepB = min(KUnSat1b * DtSub, CapacityLayer2)
                 # Flux from top- to subsoil (cannot exceed storage capacity
                 # of layer 2)
-                SeepSubToGWSubStep = min(KUnSat2[q] * DtSub[q], AvailableWater2[q])
+                SeepSubToGWSubStep = min(KUnSat2 * DtSub, AvailableWater2)
                 # Flux out of soil [mm]
                 # Minimise statement needed for exceptional cases
                 # when Theta2 becomes lt 0 (possible due to small precision errors)
-                AvailableWater1a[q] -= SeepTopToSubSubStepA
-                AvailableWater1b[q] += SeepTopToSubSubStepA - SeepTopToSubSubStepB
-                AvailableWater2[q] += SeepTopToSubSubStepB - SeepSubToGWSubStep
+                AvailableWater1a -= SeepTopToSubSubStepA
+                AvailableWater1b += SeepTopToSubSubStepA - SeepTopToSubSubStepB
+                AvailableWater2 += SeepTopToSubSubStepB - SeepSubToGWSubStep
                 # Update water balance for layers 1 and 2
-                WTemp1a = AvailableWater1a[q] + WRes1a[landuse,pix]
-                WTemp1b = AvailableWater1b[q] + WRes1b[landuse,pix]
-                WTemp2 = AvailableWater2[q] + WRes2[landuse,pix]
+                WTemp1a = AvailableWater1a + WRes1a[landuse,pix]
+                WTemp1b = AvailableWater1b + WRes1b[landuse,pix]
+                WTemp2 = AvailableWater2 + WRes2[landuse,pix]
                 # Update WTemp1 and WTemp2
-                CapacityLayer1[q] = WS1b[landuse,pix] - WTemp1b
-                CapacityLayer2[q] = WS2[landuse,pix] - WTemp2
+                CapacityLayer1 = WS1b[landuse,pix] - WTemp1b
+                CapacityLayer2 = WS2[landuse,pix] - WTemp2
                 # Update available storage capacity in layer 2
-                SeepTopToSubA[veg,pix] += SeepTopToSubSubStepA
-                SeepTopToSubB[veg,pix] += SeepTopToSubSubStepB
+                SeepTopToSubA_ += SeepTopToSubSubStepA
+                SeepTopToSubB_ += SeepTopToSubSubStepB
                 # Update total top- to subsoil flux for this step
-                SeepSubToGW[veg,pix] += SeepSubToGWSubStep
+                SeepSubToGW_ += SeepSubToGWSubStep
                 # Update total flux out of subsoil for this step
+            SeepTopToSubA[veg,pix] = SeepTopToSubA_
+            SeepTopToSubB[veg,pix] = SeepTopToSubB_
+            SeepSubToGW[veg,pix] = SeepSubToGW_
             if isFrozenSoil[pix]:
                 SeepTopToSubA[veg,pix] = 0.
                 SeepTopToSubB[veg,pix] = 0.
@@ -340,7 +451,7 @@ def soilColumnsWaterBalance(index_landuse_all, is_irrigated, is_paddy_irrig, pad
             UZOutflow[veg,pix] = min(UpperZoneK[pix] * UZ[veg,pix], UZ[veg,pix])
             # Outflow out of upper zone [mm]
             UZ[veg,pix] = max(UZ[veg,pix] - UZOutflow[veg,pix], 0.)
-            if is_drained_irrigation:
+            if is_irrigated[veg] and (DrainedFraction > 0) and not is_paddy_irrig[veg]:
                 UZOutflow[veg,pix] += DrainedFraction * SeepSubToGW[veg,pix]
                 UZ[veg,pix] += (1 - DrainedFraction) * SeepSubToGW[veg,pix] + PrefFlow[veg,pix]
                 # use map of drainage systems, to determine return flow (if drained, all percolation to channel within day; if not, all normal soil processes)
@@ -353,8 +464,6 @@ def soilColumnsWaterBalance(index_landuse_all, is_irrigated, is_paddy_irrig, pad
             # GwPercValue*DtDay)
             UZ[veg,pix] = max(UZ[veg,pix] - GwPercUZLZ[veg,pix], 0.)
             # (ground)water in upper response box [mm]
-          
-        
 
 
 @njit(nogil=True, fastmath=False, cache=True)
@@ -471,6 +580,20 @@ class soilloop(HydroModule):
         else: #######################
             self.is_paddy_irrig = np.zeros(len(self.var.vegetation), bool) #######################
 
+        # prescribed fractions of the canopy processes (see transpiration_water_stress): vegetation and land use indexes,
+        # position of the irrigated fraction (the soil filling of irrigation is computed for the last one), -1 if none
+        canopy_indexes = [self.var.get_landuse_and_indexes_from_vegetation_epic(veg) for veg in self.var.prescribed_vegetation]
+        self.index_veg_canopy = np.array([iveg for iveg, _, _ in canopy_indexes], dtype=np.int64)
+        self.index_landuse_canopy = np.array([ilanduse for _, ilanduse, _ in canopy_indexes], dtype=np.int64)
+        irrigated = [k for k, (_, _, landuse) in enumerate(canopy_indexes) if landuse == "Irrigated"]
+        self.canopy_fill_index = irrigated[-1] if irrigated else -1
+
+        # scratch buffers of soilColumnsWaterBalance, allocated once (float64 as the sub-stepping, see ModelPrecision)
+        num_vegs = len(self.var.vegetation)
+        self.soil_columns_scratch = np.empty((8, num_vegs, self.var.num_pixel))
+        self.soil_columns_substeps = np.empty((num_vegs, self.var.num_pixel), np.int64)
+        self.soil_columns_order = np.empty(num_vegs * self.var.num_pixel, np.int64)
+
 
 
     def backup(self, variables):
@@ -528,7 +651,7 @@ class soilloop(HydroModule):
         # ***********************************************************************************************************************
         # ***** POTENTIAL INTERCEPTION EVAPORATION ******************************************************************************
         # ***********************************************************************************************************************
-        one_minus_LAITerm = nx.evaluate('1. - LAITerm', local_dict={'LAITerm': self.var.LAITerm.sel(vegetation=self.var.prescribed_vegetation).values})
+        one_minus_LAITerm = nx.evaluate('1. - LAITerm', local_dict={'LAITerm': self.var.LAITerm})
         TaInterceptionMax = nx.evaluate('EWRef * one_minus_LAITerm', global_dict={'EWRef': self.var.EWRef[None]})
         ## SG if self.settings.option.get('cropsEPIC'):
         if option['cropsEPIC']:
@@ -561,70 +684,24 @@ class soilloop(HydroModule):
         # *****************************************************************************************************************************
         # ***** SOIL WATER STRESS AND ACTUAL TRANSPIRATION FOR LISFLOOD PRESCRIBED FRACTIONS (EPIC IS USED FOR INTERACTIVE CROPS) *****
         # *****************************************************************************************************************************
-        for veg in self.var.prescribed_vegetation:
-            iveg, ilanduse, landuse = self.var.get_landuse_and_indexes_from_vegetation_epic(veg)
-
-            swdf = 1 / (0.76 + 1.5 * np.minimum(0.1 * self.var.ETRef * self.var.InvDtDay, 1.0)) - 0.10 * (5 - self.var.CropGroupNumber.values[ilanduse])
-            # soil water depletion fraction (easily available soil water)
-            # Van Diepen et al., 1988: WOFOST 6.0, p.87
-            # to avoid a strange behaviour of the p-formula's, ETRef is set to a maximum of
-            # 10 mm/day. Thus, p will range from 0.15 to 0.45 at ETRef eq 10 and
-            # CropGroupNumber 1-5
-            swdf = np.where(self.var.CropGroupNumber.values[ilanduse] <= 2.5, swdf + (np.minimum(0.1 * self.var.ETRef * self.var.InvDtDay, 1.0) - 0.6) / (
-                self.var.CropGroupNumber.values[ilanduse] * (self.var.CropGroupNumber.values[ilanduse] + 3)), swdf)
-            # correction for crop groups 1 and 2 (Van Diepen et al, 1988)
-            swdf = np.maximum(np.minimum(swdf, 1.0), 0)
-            # p is between 0 and 1
-            WCrit1 = ((1 - swdf) * (self.var.WFC1.values[ilanduse] - self.var.WWP1.values[ilanduse])) + self.var.WWP1.values[ilanduse]
-            WCrit1a = ((1 - swdf) * (self.var.WFC1a.values[ilanduse] - self.var.WWP1a.values[ilanduse])) + self.var.WWP1a.values[ilanduse]
-            WCrit1b = ((1 - swdf) * (self.var.WFC1b.values[ilanduse] - self.var.WWP1b.values[ilanduse])) + self.var.WWP1b.values[ilanduse]
-            # critical moisture amount ([mm] water slice) for all layers
-            if option['wateruse']:
-                if landuse == "Irrigated":
-                    #CR: using the original xarray variables WPF3a and WPF3a to keep WFilla and WFillb as xarrays
-                    #N.B: WPF3a and WPF3b values are not changed in this function, so I can use the original
-                    self.var.WFilla = np.minimum(WCrit1a, self.var.WPF3a.values[ilanduse])
-                    self.var.WFillb = np.minimum(WCrit1b, self.var.WPF3b.values[ilanduse])
-                    # if water use is calculated, get the filling of the soil layer for either pF3 or WCrit1
-                    # that is the amount of water the soil gets filled by water from irrigation
-               #  bc the divisor can have 0 -> this calculation is done first and raise a warning - zero encountered - even if it is catched afterwards
-            self.var.RWS.values[iveg] = np.where((WCrit1 - self.var.WWP1.values[ilanduse]) > 0,\
-                                             (self.var.W1.values[ilanduse] - self.var.WWP1.values[ilanduse]) / (WCrit1 - self.var.WWP1.values[ilanduse]), 1)
-            # Transpiration reduction factor (in case of water stress)
-            # if WCrit1 = WWP1, RWS is zero there is no water stress in that case
-            self.var.RWS.values[iveg] = np.maximum(np.minimum(self.var.RWS.values[iveg], 1), 0)
-            # Transpiration reduction factor (in case of water stress)
-            if option['repStressDays']:
-                self.var.SoilMoistureStressDays.values[iveg] = np.where(self.var.RWS.values[iveg] < 1, self.var.DtDay, 0)
-                # Count number of days with soil water stress, RWS is between 0 and 1
-                # no reduction of Transpiration at RWS=1, at RWS=0 there is no Transpiration at all
-
-            transpirable_water = np.maximum(self.var.W1.values[ilanduse] - self.var.WWP1.values[ilanduse], 0)
-            self.var.Ta.values[iveg] = np.minimum(self.var.RWS.values[iveg] * self.var.potential_transpiration[iveg], transpirable_water)
-            # actual transpiration based on both layers 1a and 1b
-            self.var.Ta.values[iveg] = np.where(self.var.isFrozenSoil, 0, self.var.Ta.values[iveg])
-            # transpiration is 0 when soil is frozen
-            # calculate distribution where to take Ta from:
-            # 1st: above wCrit from layer 1a
-            # 2nd: above Wcrit from layer 1b
-            # 3rd:  distribute take off according to soil moisture availability below wcrit
-            wc1a = np.maximum(self.var.W1a.values[ilanduse] - WCrit1a, 0) # unstressed water availability from layer 1a without stress (above critical soil moisture)
-            wc1b = np.maximum(self.var.W1b.values[ilanduse] - WCrit1b, 0) # (same as above but for layer 1b)
-            Ta1a = np.minimum(self.var.Ta.values[iveg], wc1a)         # temporary transpiration from layer 1a (<= unstressed layer 1a availability)
-            restTa = np.maximum(self.var.Ta.values[iveg] - Ta1a, 0)   # transpiration left after layer 1a unstressed water has been abstracted
-            Ta1b = np.minimum(restTa, wc1b)                       # temporary transpiration from layer 1b (<= unstressed layer 1b availability)
-            restTa = np.maximum(restTa - Ta1b, 0)                 # transpiration left after layers 1a and 1b unstressed water have been abstracted
-            stressed_availability_1a = np.maximum(self.var.W1a.values[ilanduse] - Ta1a - self.var.WWP1a.values[ilanduse], 0) #|
-            stressed_availability_1b = np.maximum(self.var.W1b.values[ilanduse] - Ta1b - self.var.WWP1b.values[ilanduse], 0) #|
-            stressed_availability_tot = stressed_availability_1a + stressed_availability_1b                      #|> distribution of abstractions of
-            available = stressed_availability_tot > 0                                                            #|> soil moisture below the critical value
-            fraction_rest_1a = np.where(available, stressed_availability_1a / stressed_availability_tot, 0)      #|> proportionally to each root-zone layer (1a and 1b)
-            fraction_rest_1b = np.where(available, stressed_availability_1b / stressed_availability_tot, 0)      #|> "stressed" availability
-            Ta1a += fraction_rest_1a * restTa                                                                    #|
-            Ta1b += fraction_rest_1b * restTa                                                                    #|
-            self.var.W1a.values[ilanduse] -= Ta1a
-            self.var.W1b.values[ilanduse] -= Ta1b
-            self.var.W1.values[iveg] = self.var.W1a.values[ilanduse] + self.var.W1b.values[ilanduse]
+        if option['wateruse'] and self.canopy_fill_index >= 0:
+            self.var.WFilla = np.empty(self.var.num_pixel)
+            self.var.WFillb = np.empty(self.var.num_pixel)
+            WFilla, WFillb = self.var.WFilla, self.var.WFillb
+        else:
+            WFilla = WFillb = np.empty(0)
+        transpiration_water_stress(self.index_veg_canopy, self.index_landuse_canopy,
+                                   self.canopy_fill_index if option['wateruse'] else -1, bool(option['repStressDays']),
+                                   self.var.DtDay, self.var.InvDtDay, np.asarray(self.var.ETRef), self.var.isFrozenSoil,
+                                   self.var.CropGroupNumber.values, self.var.WFC1.values, self.var.WWP1.values,
+                                   self.var.WFC1a.values, self.var.WWP1a.values, self.var.WFC1b.values, self.var.WWP1b.values,
+                                   self.var.WPF3a.values, self.var.WPF3b.values, np.asarray(self.var.potential_transpiration),
+                                   self.var.RWS.values, self.var.Ta.values, self.var.SoilMoistureStressDays.values,
+                                   self.var.W1a.values, self.var.W1b.values, self.var.W1.values, WFilla, WFillb)
+        # soil water stress (RWS) and actual transpiration (Ta) of each prescribed fraction, taken from layers 1a and 1b:
+        # 1st: above the critical soil moisture from layer 1a, 2nd: above the critical soil moisture from layer 1b,
+        # 3rd: below the critical soil moisture, proportionally to the availability of each layer
+        # (see transpiration_water_stress)
 
 
     def dynamic_soil(self):
@@ -635,7 +712,7 @@ class soilloop(HydroModule):
         """ Dynamic part of the soil/vegetation loop describing soil processes (after canopy ones have been processed):
             """
         # Maximum evaporation from a shaded soil surface in [mm] per time step
-        ESMax = nx.evaluate('ESRef * LAITerm', local_dict={'ESRef': self.var.ESRef[None], 'LAITerm': self.var.LAITerm.sel(vegetation=self.var.prescribed_vegetation).values})
+        ESMax = nx.evaluate('ESRef * LAITerm', local_dict={'ESRef': self.var.ESRef[None], 'LAITerm': self.var.LAITerm})
         ### SG if self.settings.option.get('cropsEPIC'):
         if option['cropsEPIC']:
             ESMax = np.vstack((ESMax, self.var.crop_module.potential_undercanopy_evaporation.values))
@@ -662,7 +739,8 @@ class soilloop(HydroModule):
                                 self.var.SoilDepth1a.values, self.var.SoilDepth1b.values, self.var.SoilDepth2.values,
                                 self.var.WS1a.values, self.var.WS1b.values, self.var.WS1.values, self.var.WS2.values,
                                 self.var.UpperZoneK, self.var.DrainedFraction, self.var.GwPercStep,
-                                self.var.UZOutflow.values, self.var.UZ.values, self.var.GwPercUZLZ.values)
+                                self.var.UZOutflow.values, self.var.UZ.values, self.var.GwPercUZLZ.values,
+                                self.soil_columns_scratch, self.soil_columns_substeps, self.soil_columns_order, get_num_threads())
                    
                                 
                                 
@@ -20,7 +20,7 @@ import numpy as np
 
 from ..global_modules.add1 import loadmap, makenumpy, compressArray
 from ..global_modules.settings import MaskInfo, LisSettings
-from .kinematic_wave_parallel import kinematicWave
+from .kinematic_wave_parallel import kinematicWave, PARALLEL_MIN_ORDER_WIDTH
 from . import HydroModule
 
 
@@ -50,6 +50,8 @@ class surface_routing(HydroModule):
         OFM3ForestInit = loadmap('OFForestInitValue')
         OFM3DirectInit = loadmap('OFDirectInitValue')
         self.var.WaterDepth = maskinfo.in_zero()
+        # surface runoff of each land use [mm], updated in place at each step
+        self.var.SurfaceRunSoil = self.var.allocateDataArray([self.var.dim_landuse, self.var.dim_pixel])
 
         # self.var.WaterDepthInit =loadmap('WaterDepthInitValue')
         # self.var.WaterDepthInit = makenumpy(self.var.WaterDepthInit)
@@ -79,7 +81,7 @@ class surface_routing(HydroModule):
         # 2 times fixed reference depth
         # (Note that using grid size as flow width is a bit odd, as results will depend on cell size!)
 
-        self.var.OFAlpha = (((self.var.NManning / np.sqrt(Grad)) ** self.var.Beta) * (OFWettedPerimeter ** self.var.AlpPow)).astype(float)
+        self.var.OFAlpha = (((self.var.NManning / np.sqrt(Grad)) ** self.var.Beta) * (OFWettedPerimeter ** self.var.AlpPow)).astype(maskinfo.dtype)
         self.var.InvOFAlpha  = 1 / self.var.OFAlpha
         # Alpha to separate int 3 different overland routing: forest, water and sealed area, remaining area
         # overland flow Alpha for kinematic wave
@@ -90,9 +92,9 @@ class surface_routing(HydroModule):
         # self.var.OFM3=[cover(OFM3all*self.var.OtherFraction,scalar(0.0)),cover(OFM3all*self.var.ForestFraction,scalar(0.0)),cover(OFM3all*(self.var.DirectRunoffFraction+self.var.WaterFraction),scalar(0.0))]
 
         # Initial overland discharge [m3 s-1]
-        self.var.OFQDirect = ((self.var.OFM3Direct * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Direct')])**(self.var.InvBeta)).astype(float)
-        self.var.OFQOther = ((self.var.OFM3Other * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Other')])**(self.var.InvBeta)).astype(float)
-        self.var.OFQForest = ((self.var.OFM3Forest * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Forest')])**(self.var.InvBeta)).astype(float)
+        self.var.OFQDirect = ((self.var.OFM3Direct * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Direct')])**(self.var.InvBeta)).astype(maskinfo.dtype)
+        self.var.OFQOther = ((self.var.OFM3Other * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Other')])**(self.var.InvBeta)).astype(maskinfo.dtype)
+        self.var.OFQForest = ((self.var.OFM3Forest * self.var.InvPixelLength * self.var.InvOFAlpha.values[self.var.dim_runoff[1].index('Forest')])**(self.var.InvBeta)).astype(maskinfo.dtype)
 
     def initialSecond(self):
         """ 2nd initialisation part of the surface routing module:
@@ -103,15 +105,21 @@ class surface_routing(HydroModule):
         maskinfo = MaskInfo.instance()
         land_mask = ~maskinfo.info.mask
         settings = LisSettings.instance()
+        binding = settings.binding
         flags = settings.flags
+        min_parallel_width = int(binding.get('routingOrderWidth_parallelNumba', PARALLEL_MIN_ORDER_WIDTH))
+        engine = binding.get('routingEngine_overland', 'orders')
+        warm_start = binding.get('routingNewtonWarmStart', 'False') == 'True'
+
+        # The three overland flow components (direct, other, forest) are routed together on the same flow network
+        runoff_index = [self.var.dim_runoff[1].index(runoff) for runoff in ('Direct', 'Other', 'Forest')]
+        self.var.OFQ = np.stack([self.var.OFQDirect, self.var.OFQOther, self.var.OFQForest])
+        self.var.OFQDirect, self.var.OFQOther, self.var.OFQForest = self.var.OFQ # views: updated by the surface router
+        self.surface_router = kinematicWave(self.var.LddToChan, land_mask, self.var.OFAlpha.values[runoff_index], self.var.Beta,\
+                                            self.var.PixelLength, dt_surf_routing, flagnancheck=flags['nancheck'],
+                                            topology_cache=self.var.RoutingTopologyCache, min_parallel_width=min_parallel_width,
+                                            engine=engine, warm_start=warm_start)
 
-        self.direct_surface_router = kinematicWave(compressArray(self.var.LddToChan), land_mask, self.var.OFAlpha.values[self.var.dim_runoff[1].index('Direct')], self.var.Beta,\
-                                                   self.var.PixelLength, dt_surf_routing, flagnancheck=flags['nancheck'])
-        self.other_surface_router = kinematicWave(compressArray(self.var.LddToChan), land_mask, self.var.OFAlpha.values[self.var.dim_runoff[1].index('Other')], self.var.Beta,\
-                                                  self.var.PixelLength, dt_surf_routing, flagnancheck=flags['nancheck'])
-        self.forest_surface_router = kinematicWave(compressArray(self.var.LddToChan), land_mask, self.var.OFAlpha.values[self.var.dim_runoff[1].index('Forest')], self.var.Beta,\
-                                                   self.var.PixelLength, dt_surf_routing, flagnancheck=flags['nancheck'])        
-        
     def dynamic(self):
         """ dynamic part of the surface routing module
         """
@@ -119,13 +127,12 @@ class surface_routing(HydroModule):
         # ***** COMPONENTS OF RUNOFF                               ***
         # ************************************************************
 
-        self.var.SurfaceRunSoil = self.var.allocateDataArray([self.var.dim_landuse, self.var.dim_pixel])
-        for landuse, veg_list in self.var.LANDUSE_VEGETATION.items():
-            iveg_list,iveg_list_pres,ilanduse = self.var.get_indexes_from_landuse_and_veg_list_GLOBAL(landuse, veg_list)
-            self.var.SurfaceRunSoil.values[ilanduse] = np.sum((self.var.SoilFraction.values[iveg_list_pres] * \
-                    np.maximum(self.var.AvailableWaterForInfiltration.values[iveg_list] - self.var.Infiltration.values[iveg_list],0)),self.var.SoilFraction.dims.index("vegetation"))
+        SurfaceRunSoil = self.var.SurfaceRunSoil.values
+        for iveg_list,iveg_list_pres,ilanduse in self.var.vegetation_indexes.landuse_vegetation:
+            SurfaceRunSoil[ilanduse] = np.sum((self.var.SoilFraction.values[iveg_list_pres] * \
+                    np.maximum(self.var.AvailableWaterForInfiltration.values[iveg_list] - self.var.Infiltration.values[iveg_list],0)),0)
 
-        self.var.SurfaceRunoff = self.var.DirectRunoff + np.sum(self.var.SurfaceRunSoil.values,self.var.SurfaceRunSoil.dims.index("landuse"))
+        self.var.SurfaceRunoff = self.var.DirectRunoff + np.sum(SurfaceRunSoil,0)
         
         # Surface runoff for this time step (mm)
         # Note that SurfaceRunoff ONLY includes surface runoff generated during current time
@@ -141,17 +148,12 @@ class surface_routing(HydroModule):
         # Routing of overland flow to channel using kinematic wave
         # Note that all 'new' water is added as side-flow
         SideflowDirect = self.var.DirectRunoff * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec
-        ilusevalues = []
-        for luse in ["Rainfed","Irrigated"]:
-            ilusevalues.append(self.var.epic_settings.soil_uses.index(luse))
-
-        SideflowOther = np.sum(self.var.SurfaceRunSoil.values[ilusevalues],self.var.SurfaceRunSoil.dims.index("landuse")) * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec
-        SideflowForest = self.var.SurfaceRunSoil.values[self.var.epic_settings.soil_uses.index('Forest')] * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec
+        landuse = self.var.vegetation_indexes.landuse
+        SideflowOther = np.sum(SurfaceRunSoil[[landuse["Rainfed"], landuse["Irrigated"]]],0) * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec
+        SideflowForest = SurfaceRunSoil[landuse['Forest']] * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec
         # All surface runoff that is generated during current time step added as side flow [m3/s/m pixel-length]
-        self.direct_surface_router.kinematicWaveRouting(self.var.OFQDirect, SideflowDirect)
-        self.other_surface_router.kinematicWaveRouting(self.var.OFQOther, SideflowOther)
-        self.forest_surface_router.kinematicWaveRouting(self.var.OFQForest, SideflowForest)
-        
+        self.surface_router.kinematicWaveRouting(self.var.OFQ, np.stack([SideflowDirect, SideflowOther, SideflowForest]))
+
 # to PCRASTER
 
         #SideflowDirect =  decompress(self.var.DirectRunoff * self.var.MMtoM3 * self.var.InvPixelLength * self.var.InvDtSec)
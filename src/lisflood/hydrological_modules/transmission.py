@@ -59,7 +59,7 @@ class transmission(HydroModule):
             self.var.TransPower2 = 1.0 / self.var.TransPower1
             # transmission loss function
             maskinfo = MaskInfo.instance()
-            self.var.TransCum = maskinfo.in_zero()
+            self.var.TransCum = maskinfo.in_zero(np.float64)
         # Cumulative transmission loss
         # self.var.TransLossM3Dt = maskinfo.in_zero()
         # substep amount of transmission loss
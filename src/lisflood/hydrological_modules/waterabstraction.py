@@ -13,7 +13,7 @@ from __future__ import absolute_import, print_function
 import warnings
 
 from pcraster import boolean, nominal, ifthen, defined, areamaximum, downstream, cover, lddrepair, ifthenelse, upstream, \
-    scalar, accuflux, celllength, windowtotal, areaaverage
+    scalar, celllength, windowtotal, areaaverage
 from pcraster.operators import pcrDiv
 import numpy as np
 from netCDF4 import Dataset
@@ -21,6 +21,8 @@ from netCDF4 import Dataset
 from ..global_modules.add1 import loadmap, decompress, compressArray, readnetcdf, readmapsparse
 from ..global_modules.settings import get_calendar_type, calendar_inconsistency_warning, LisSettings, MaskInfo
 from . import HydroModule
+from .flow_network import FlowNetwork
+from .area_aggregator import AreaAggregator
 from ..global_modules.netcdf import xarray_reader
 from ..global_modules.errors import LisfloodError
 
@@ -83,6 +85,8 @@ class waterabstraction(HydroModule):
             # EFlowThreshold is map with m3/s discharge, e.g. the 10th percentile discharge of the baseline run
 
             self.var.WUseRegionC = loadmap('WUseRegion').astype(int)
+            self.var.WUseRegionAggregator = AreaAggregator(self.var.WUseRegionC)
+            # water region totals (replaces np.take(np.bincount(WUseRegionC, weights=...), WUseRegionC))
             self.var.IrrigationMult = loadmap('IrrigationMult')
             
             # ************************************************************
@@ -169,12 +173,9 @@ class waterabstraction(HydroModule):
                 LddWaterRegion = lddrepair(ifthenelse(pitWuse == 0, self.var.LddStructuresKinematic, 5))
                 # create a Ldd with pits at every water region outlet
                 # this results in a interrupted ldd, so water cannot be transfered to the next water region
-                lddC = compressArray(LddWaterRegion)
-                inAr = decompress(np.arange(maskinfo.info.mapC[0], dtype="int32"))
-                # giving a number to each non missing pixel as id
-                self.var.downWRegion = (compressArray(downstream(LddWaterRegion, inAr))).astype(np.int32)
+                water_region_network = FlowNetwork(compressArray(LddWaterRegion), ~maskinfo.info.mask)
+                self.var.downWRegion = water_region_network.downstreamIndex(maskinfo.info.mapC[0])
                 # each upstream pixel gets the id of the downstream pixel
-                self.var.downWRegion[lddC == 5] = maskinfo.info.mapC[0]
                 # all pits gets a high number
 
                 # ************************************************************
@@ -199,11 +200,11 @@ class waterabstraction(HydroModule):
 
             # These are all needed to compute the cumulative mass balance error         
         
-            self.var.wateruseCum = maskinfo.in_zero()   
+            self.var.wateruseCum = maskinfo.in_zero(np.float64)   
             # water use cumulated amount
-            abstractionCUM = maskinfo.in_zero()  
+            abstractionCUM = maskinfo.in_zero(np.float64)  
             IrrigationWaterDemand = maskinfo.in_zero()  
-            self.var.IrriLossCUM = maskinfo.in_zero()
+            self.var.IrriLossCUM = maskinfo.in_zero(np.float64)
             self.var.cumulated_CH_withdrawal = maskinfo.in_zero() 
             # Cumulative irrigation loss [mm]
             # Cumulative abstraction from surface water [mm]
@@ -216,13 +217,8 @@ class waterabstraction(HydroModule):
             self.var.ConveyanceEfficiency = loadmap('ConveyanceEfficiency')
             self.efficiency_irrigation = self.var.IrrigationEfficiency * self.var.ConveyanceEfficiency
 
-            self.var.GroundwaterRegionPixels = np.take(
-                np.bincount(self.var.WUseRegionC, weights=self.var.GroundwaterBodies),
-                self.var.WUseRegionC
-            )
-            self.var.AllRegionPixels = np.take(
-                np.bincount(self.var.WUseRegionC, weights=self.var.GroundwaterBodies * 0.0 + 1.0),
-                self.var.WUseRegionC
+            self.var.GroundwaterRegionPixels, self.var.AllRegionPixels = self.var.WUseRegionAggregator.areatotals(
+                self.var.GroundwaterBodies, self.var.GroundwaterBodies * 0.0 + 1.0
             )
             self.var.RatioGroundWaterUse = self.var.AllRegionPixels / (self.var.GroundwaterRegionPixels + 0.01)
             self.var.FractionGroundwaterUsed = np.minimum(
@@ -395,7 +391,7 @@ class waterabstraction(HydroModule):
             self.var.consumption_SwGw_required_M3 = (consumption_GW_required_irrigation_MM + consumption_SW_required_irrigation_MM) * self.var.MMtoM3 +self.var.PaddyRiceWaterAbstractionFromSurfaceWaterM3 + consumption_GW_noReturn_M3 + consumption_SW_required_noReturn_M3 
             # 7.3 Withdrawal (abstraction minus instanteneous return flow) required from surface water bodies
             withdrawal_SW_required = consumption_SW_required_noReturn_M3 + abstraction_SW_required_irrigation_M3 + self.var.PaddyRiceWaterAbstractionFromSurfaceWaterM3  
-            areatotal_withdrawal_SW_required = np.take(np.bincount(self.var.WUseRegionC, weights=withdrawal_SW_required), self.var.WUseRegionC) 
+            areatotal_withdrawal_SW_required = self.var.WUseRegionAggregator.areatotal(withdrawal_SW_required)
             is_SW_withdrawal_required_WUR = areatotal_withdrawal_SW_required > 0  
             
             # ***********************************************************************
@@ -441,9 +437,8 @@ class waterabstraction(HydroModule):
                 PotentialAbstractionFromLakesAndReservoirsM3 = maskinfo.in_zero()
 
             
-            AreatotalPotentialAbstractionFromLakesAndReservoirsM3 = np.take(
-                np.bincount(self.var.WUseRegionC, weights=PotentialAbstractionFromLakesAndReservoirsM3),
-                self.var.WUseRegionC)
+            AreatotalPotentialAbstractionFromLakesAndReservoirsM3 = self.var.WUseRegionAggregator.areatotal(
+                PotentialAbstractionFromLakesAndReservoirsM3)
             # 9.2 Water regions' required and actual abstraction from lakes (Lak) and reservoirs (Res)
             areatotal_withdrawal_LakRes_required_M3 = self.var.FractionLakeReservoirWaterUsed * areatotal_withdrawal_SW_required
             
@@ -481,8 +476,7 @@ class waterabstraction(HydroModule):
             PixelAvailableWaterFromChannelsM3 = np.maximum(
                 self.var.ChanM3Kin - self.var.EFlowThreshold * self.var.DtSec, maskinfo.in_zero()) ### QUESTION! # * (1 - self.var.WUsePercRemain) THIS BIT IS COMMENTED FOR CONSISTENCY WITH EPIC, UNCOMMENT BEFORE THE FINAL MERGE 
             self.var.AreaTotalAvailableWaterFromChannelsM3 = np.maximum(
-                np.take(np.bincount(self.var.WUseRegionC, weights=PixelAvailableWaterFromChannelsM3),
-                        self.var.WUseRegionC),maskinfo.in_zero())
+                self.var.WUseRegionAggregator.areatotal(PixelAvailableWaterFromChannelsM3), maskinfo.in_zero())
             # 10.3 Actual channel withdrawal            
             self.var.areatotal_withdrawal_CH_actual_M3 = np.minimum(self.var.AreaTotalAvailableWaterFromChannelsM3,
                                                               areatotal_withdrawal_CH_required_M3)         
@@ -490,7 +484,7 @@ class waterabstraction(HydroModule):
                 self.var.areatotal_withdrawal_CH_actual_M3 / self.var.AreaTotalAvailableWaterFromChannelsM3, 1), 0)
             self.var.withdrawal_CH_actual_M3 = self.var.FractionAbstractedFromChannels * PixelAvailableWaterFromChannelsM3 # daily channel abstraction   
             self.var.withdrawal_CH_actual_M3_routStep = self.var.withdrawal_CH_actual_M3 * self.var.InvNoRoutSteps # channel abstraction per routing time step  
-            self.var.withdrawal_CH_actual_Region_M3 = np.take(np.bincount(self.var.WUseRegionC, weights=self.var.withdrawal_CH_actual_M3),self.var.WUseRegionC)  ## QUESTION! ## ONLY FOR REPORTING?
+            self.var.withdrawal_CH_actual_Region_M3 = self.var.WUseRegionAggregator.areatotal(self.var.withdrawal_CH_actual_M3)  ## QUESTION! ## ONLY FOR REPORTING?
             
             self.var.wateruseCum += self.var.withdrawal_CH_actual_M3 # summing up for water balance calculation
 
@@ -503,22 +497,23 @@ class waterabstraction(HydroModule):
             # 11. Total actual abstractions from surface water bodies
             # ************************************************************
             self.var.withdrawal_SW_actual_M3 = self.var.withdrawal_CH_actual_M3 + self.var.LakeAbstractionM3 + self.var.ReservoirAbstractionM3
-            self.var.areatotal_withdrawal_SW_actual_M3 = np.take(np.bincount(self.var.WUseRegionC, weights=self.var.withdrawal_SW_actual_M3), self.var.WUseRegionC)
             
             # ************************************************************
             # 12. Channel water allocation handling scarcity  
             # ************************************************************
             # 12.1 In regions with water shortage, reduce irrigation first (CHECK: allocation to perscribed paddy rice is not reduced)
             abstraction_CH_required_irrigation_M3 = abstraction_SW_required_irrigation_M3 * (1 - FractionAbstractedByLakesReservoirs)                      
-            areatotal_abstraction_CH_required_irrigation_M3 = np.take(np.bincount(self.var.WUseRegionC, weights= abstraction_CH_required_irrigation_M3), self.var.WUseRegionC)
+            withdrawal_CH_required_noReturn_M3 = consumption_SW_required_noReturn_M3 * (1 - FractionAbstractedByLakesReservoirs)
+            self.var.areatotal_withdrawal_SW_actual_M3, areatotal_abstraction_CH_required_irrigation_M3, areatotal_withdrawal_CH_required_noReturn_M3 = \
+                self.var.WUseRegionAggregator.areatotals(self.var.withdrawal_SW_actual_M3, abstraction_CH_required_irrigation_M3,
+                                                         withdrawal_CH_required_noReturn_M3)
+            # water region totals of 11. and 12. in one pass
             irrabs_minus_shortage_ATCHM3 = areatotal_abstraction_CH_required_irrigation_M3 - self.var.areatotal_shortage_SW_M3
             areatotal_abstraction_CH_actual_irrigation_M3 = np.maximum(irrabs_minus_shortage_ATCHM3, 0.)
             fraction_met_CH_irrigation = np.minimum(np.where(areatotal_abstraction_CH_required_irrigation_M3 > 0,
                                                          areatotal_abstraction_CH_actual_irrigation_M3 / areatotal_abstraction_CH_required_irrigation_M3, 0.), 1.)
             abstraction_CH_actual_irrigation_M3 = abstraction_CH_required_irrigation_M3 * fraction_met_CH_irrigation
             # 12.2 Actual channel abstractions for the sectors without return flows (ene, dom, liv, ind), accounting for shortage where needed
-            withdrawal_CH_required_noReturn_M3 = consumption_SW_required_noReturn_M3 * (1 - FractionAbstractedByLakesReservoirs)
-            areatotal_withdrawal_CH_required_noReturn_M3 = np.take(np.bincount(self.var.WUseRegionC, weights=withdrawal_CH_required_noReturn_M3), self.var.WUseRegionC)
             areatotal_shortage_CH_beyondIrrigation_M3 = np.maximum(-irrabs_minus_shortage_ATCHM3, 0.)
             areatotal_withdrawal_CH_actual_noReturn_M3 = np.maximum(areatotal_withdrawal_CH_required_noReturn_M3 - areatotal_shortage_CH_beyondIrrigation_M3, 0.)
             fraction_met_CH_noReturn = np.minimum(np.where(areatotal_withdrawal_CH_required_noReturn_M3 > 0,
@@ -530,14 +525,14 @@ class waterabstraction(HydroModule):
             # 12.4 Bookkeeping for over-all water balance, and repwateruseGauges and repwateruseSites
             self.var.cumulated_CH_withdrawal += self.var.withdrawal_CH_actual_M3 # bookkeeping for over-all water balance
             if (option['repwateruseGauges']) or (option['repwateruseSites']):
-                self.var.WUseSumM3 = accuflux(self.var.Ldd, decompress(self.var.withdrawal_CH_actual_M3)*self.var.InvDtSec)
+                self.var.WUseSumM3 = decompress(self.var.LddNetwork.accuflux(self.var.withdrawal_CH_actual_M3 * self.var.InvDtSec))
                 
             # ********************************************************************************************
             # 13. Actual surface water abstractions (except prescribed paddy rice)
             # ********************************************************************************************
             # 13.1 Irrigation
             abstraction_SW_actual_irrigation_M3 = abstraction_SW_required_irrigation_M3 * FractionAbstractedByLakesReservoirs + abstraction_CH_actual_irrigation_M3
-            self.var.areatotal_abstraction_SW_actual_irrigation_M3 = np.take(np.bincount(self.var.WUseRegionC, weights=abstraction_SW_actual_irrigation_M3), self.var.WUseRegionC)
+            self.var.areatotal_abstraction_SW_actual_irrigation_M3 = self.var.WUseRegionAggregator.areatotal(abstraction_SW_actual_irrigation_M3)
             fraction_met_SW_irrigation = np.minimum(FractionAbstractedByLakesReservoirs + fraction_met_CH_irrigation * (1 - FractionAbstractedByLakesReservoirs), 1.)
             # 13.2 Other uses for which return flows are not simulated
             fraction_met_SW_noReturn = np.minimum(FractionAbstractedByLakesReservoirs + fraction_met_CH_noReturn * (1 - FractionAbstractedByLakesReservoirs), 1.)
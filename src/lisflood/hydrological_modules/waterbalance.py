@@ -65,8 +65,7 @@ class waterbalance(object):
                 if option['simulatePolders']:
                     ChannelInitM3 += self.var.PolderStorageIniM3
 
-            ax_veg=self.var.SoilFraction.dims.index("vegetation")        
-            Hill1 = np.sum(self.var.SoilFraction * (self.var.CumInterception + self.var.W1 + self.var.W2 + self.var.UZ),ax_veg)
+            Hill1 = np.sum(self.var.SoilFraction * (self.var.CumInterception + self.var.W1 + self.var.W2 + self.var.UZ),0)
             Hill1 += self.var.LZ            
             
             OverlandInitM3 = self.var.OFM3Other + self.var.OFM3Forest + self.var.OFM3Direct
@@ -80,8 +79,7 @@ class waterbalance(object):
             # MMtoM3 equals MMtoM*PixelArea, which may (or may not) be
             # spatially variable
 
-            self.var.WaterInit = np.take(np.bincount(self.var.Catchments, weights=ChannelInitM3), self.var.Catchments)
-            self.var.WaterInit += np.take(np.bincount(self.var.Catchments, weights=HillslopeInitM3), self.var.Catchments)
+            self.var.WaterInit = self.var.CatchmentAggregator.areatotal(ChannelInitM3, HillslopeInitM3)
 
             # Initial water stored [m3]
             # Inclusion of DischargeM3Structures: adding this corrects a (relatively small) offset that occurs otherwise
@@ -106,7 +104,7 @@ class waterbalance(object):
                 # because Modified Puls Method is use, some additional offset
                 # has to be added
             
-            self.var.DischargeM3StructuresIni = np.take(np.bincount(self.var.Catchments, weights=DisStructure), self.var.Catchments)
+            self.var.DischargeM3StructuresIni = self.var.CatchmentAggregator.areatotal(DisStructure)
 
 # --------------------------------------------------------------------------
 # -------------------------------------------------------------------------
@@ -122,8 +120,7 @@ class waterbalance(object):
         return ChannelStoredM3
 
     def storage_hillslope(self):
-        ax_veg = self.var.SoilFraction.dims.index("vegetation")
-        Hill1 = self.var.LZ + np.sum(self.var.SoilFraction * (self.var.CumInterception + self.var.W1 + self.var.W2 + self.var.UZ), ax_veg)
+        Hill1 = self.var.LZ + np.sum(self.var.SoilFraction * (self.var.CumInterception + self.var.W1 + self.var.W2 + self.var.UZ), 0)
         HillslopeStoredMM = self.var.WaterDepth + self.var.SnowCover + Hill1 + self.var.DirectRunoffFraction * self.var.CumInterSealed
         return HillslopeStoredMM * self.var.MMtoM3
 
@@ -157,8 +154,7 @@ class waterbalance(object):
             #    decompress(self.var.TotalPrecipitation) * self.var.MMtoM3, catch)
         
             self.var.sumInWB[np.isnan(self.var.sumInWB)] = 0
-            WaterIn = np.take(np.bincount(self.var.Catchments, weights=self.var.sumInWB),self.var.Catchments)
-            WaterIn += np.take(np.bincount(self.var.Catchments, weights=self.var.TotalPrecipitationWB*self.var.MMtoM3), self.var.Catchments)
+            WaterInTerms = [self.var.sumInWB, self.var.TotalPrecipitationWB*self.var.MMtoM3]
                # Accumulated incoming water [cu m]
             # NOTE: It is NOT possible to nest all terms into one areatotal statement because channel-related maps have MV for non-channel
             # pixels, resulting in MV creation when adding directly!!
@@ -180,8 +176,7 @@ class waterbalance(object):
             # OverlandM3 = self.var.OFM3Other + self.var.OFM3Forest + self.var.OFM3Direct
 
             #WaterStored = areatotal(decompress(ChannelStoredM3), catch) + areatotal(decompress(HillslopeStoredM3), catch)
-            WaterStored = np.take(np.bincount(self.var.Catchments,weights=ChannelStoredM3),self.var.Catchments)
-            WaterStored += np.take(np.bincount(self.var.Catchments,weights=HillslopeStoredM3),self.var.Catchments)
+            WaterStoredTerms = [ChannelStoredM3, HillslopeStoredM3]
 
             if option['TransientLandUseChange'] and (self.var.DynamicLandCoverDelta > 0.0):
                  self.var.ForestFraction = self.var.ForestFraction_nextstep        
@@ -198,8 +193,7 @@ class waterbalance(object):
                     self.var.SoilFraction.values[self.var.vegetation.index('Rainfed_prescribed')] += self.var.RiceFraction
 
                  HillslopeStoredM3 = self.storage_hillslope()
-                 WaterStored_nextstep =np.take(np.bincount(self.var.Catchments,weights=ChannelStoredM3),self.var.Catchments)
-                 WaterStored_nextstep += np.take(np.bincount(self.var.Catchments,weights=HillslopeStoredM3),self.var.Catchments)
+                 WaterStored_nextstep = self.var.CatchmentAggregator.areatotal(ChannelStoredM3, HillslopeStoredM3)
 
             # Total water stored [m3]
             # This goes out:
@@ -210,22 +204,21 @@ class waterbalance(object):
             ##sum1 = self.var.sumDis.copy()
             sum1 = self.var.ChanQAvg.copy()
             sum1[self.var.AtLastPointC == 0] = 0
-            WaterOut = np.take(np.bincount(self.var.Catchments,weights=sum1 * self.var.DtSec),self.var.Catchments)
-            WaterOut += np.take(np.bincount(self.var.Catchments,weights=HillslopeOutM3),self.var.Catchments)
+            WaterOutTerms = [sum1 * self.var.DtSec, HillslopeOutM3]
 
             #WaterOut = areatotal(cover(ifthen(
             #    self.var.AtLastPoint, self.var.sumDis * self.var.DtRouting), scalar(0.0)), catch)
             #WaterOut += areatotal(decompress(HillslopeOutM3), catch)
             if option['simulateLakes']:
-                WaterOut += np.take(np.bincount(self.var.Catchments, weights=self.var.EWLakeWBM3),self.var.Catchments)  #### EWLakeCUMM3 is not updated! Always = 0!!
+                WaterOutTerms.append(self.var.EWLakeWBM3)  #### EWLakeCUMM3 is not updated! Always = 0!!
             if option['openwaterevapo']:
-                WaterOut += np.take(np.bincount(self.var.Catchments, weights=self.var.EvaWBM3),self.var.Catchments)
+                WaterOutTerms.append(self.var.EvaWBM3)
             if option['TransLoss']:
-                WaterOut += np.take(np.bincount(self.var.Catchments, weights=self.var.TransCum),self.var.Catchments)
+                WaterOutTerms.append(self.var.TransCum)
             if option['wateruse']:
                 print('WARNING: the water balance module has NOT been verified yet when the option wateruse is ON!')
-                WaterOut += np.take(np.bincount(self.var.Catchments, weights=self.var.IrriLossCUM),self.var.Catchments)
-                WaterOut += np.take(np.bincount(self.var.Catchments, weights=self.var.wateruseCum),self.var.Catchments)
+                WaterOutTerms.append(self.var.IrriLossCUM)
+                WaterOutTerms.append(self.var.wateruseCum)
             # Accumulated outgoing water [cu m]
             # Inclusion of DischargeM3Structures is because at structure locations the water in the channel is added to the structure
             # (i.e. storage at reservoirs/lakes is accounted for twice). Of course this is not really a 'loss', but merely a correction
@@ -233,7 +226,7 @@ class waterbalance(object):
             # new 12.11.09 PB
             # added cumulative transmission loss
             DisStru = np.where(self.var.IsUpsOfStructureKinematicC, self.var.ChanQ * self.var.DtRouting, 0)
-            DischargeM3Structures = np.take(np.bincount(self.var.Catchments, weights=DisStru), self.var.Catchments)
+            DischargeM3StructuresTerms = [DisStru]
 
             # on the last time step lakes and reservoirs calculated with the previous routing results
             # so the last (now routed) discharge has to be added to the mass balance
@@ -242,16 +235,21 @@ class waterbalance(object):
             if option['simulateLakes']:
                 DisLake = maskinfo.in_zero()
                 np.put(DisLake, self.var.LakeIndex, 0.5 * self.var.LakeInflowCC * self.var.DtRouting)
-                DischargeM3Lake = np.take(np.bincount(self.var.Catchments, weights=DisLake),self.var.Catchments)
+                DischargeM3StructuresTerms.append(DisLake)
                 #DischargeM3Lake = areatotal(cover(0.5 * self.var.LakeInflow * self.var.DtRouting, scalar(0.0)), catch)
                 # because Modified Puls Method is using QIn=(Qin1+Qin2)/2, we need a correction
                 #  DisStr=Disstr+0.5*LakeInflow - 0.5 * LakeInit
                 #  0.5 * LakeInit: is already done in DischargeM3StructuresIni
-                DischargeM3Structures += DischargeM3Lake
                 # Discharge just upstream of structure locations (coded as pits) in [cu m / time step]
                 # Needed for mass balance error calculations, because of double counting of structure
                 # storage and water in the channel.
 
+            sumFractionsa11 = self.var.ForestFraction + self.var.DirectRunoffFraction  + self.var.WaterFraction  + self.var.IrrigationFraction + self.var.OtherFraction  
+            # self.var.RiceFraction is already included in self.var.OtherFraction
+            WaterIn, WaterStored, WaterOut, DischargeM3Structures, CatchArea, SumFractions, numpixels = self.var.CatchmentAggregator.areatotals(
+                WaterInTerms, WaterStoredTerms, WaterOutTerms, DischargeM3StructuresTerms, self.var.PixelArea, sumFractionsa11, 1.0)
+            # all catchment totals in one pass
+
             DischargeM3Structures -= self.var.DischargeM3StructuresIni  
             # minus the initial DischargeStructure
             # Old: DischargeM3Structures=areatotal(cover(ifthen(self.var.IsUpsOfStructureKinematic,self.var.ChanQ*self.var.DtSec),null),self.var.Catchments)
@@ -262,7 +260,6 @@ class waterbalance(object):
             self.var.MBError = self.var.WaterInit + WaterIn - WaterStored - WaterOut - DischargeM3Structures
             # Totl mass balance error per catchment [cu m]. Mass balance error is computed for each computational time step.
   
-            CatchArea = np.take(np.bincount(self.var.Catchments, weights=self.var.PixelArea),self.var.Catchments)
             self.var.MBErrorMM = self.var.MtoMM * self.var.MBError / CatchArea
             # Mass balance error per unit area of the catchment [mm water slice]. Mass balance error is computed for each computational time step.
             
@@ -274,15 +271,5 @@ class waterbalance(object):
             
             # the lines below compute the ratio between the total mass balance error and the water storage [m3/m3] and the average sum of the fractions for each catchemnt. 
             # MBErrorStorage and  AverageFractions are useful to analyse the mass balance error values.
-            sumFractionsa11 = []
-            SumFractions = []
-            numpixels = []
-            self.var.MBErrorStorage = []
-            self.var.AverageFractions = []
-            sumFractionsa11 = self.var.ForestFraction + self.var.DirectRunoffFraction  + self.var.WaterFraction  + self.var.IrrigationFraction + self.var.OtherFraction  
-            # self.var.RiceFraction is already included in self.var.OtherFraction
-            SumFractions = np.take(np.bincount(self.var.Catchments, weights=sumFractionsa11),self.var.Catchments)
-            ones = maskinfo.in_zero() + 1.0
-            numpixels = np.take(np.bincount(self.var.Catchments, weights=ones),self.var.Catchments) 
             self.var.MBErrorStorage = self.var.MBError/(self.var.WaterInit)  
             self.var.AverageFractions = SumFractions/numpixels
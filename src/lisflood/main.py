@@ -37,6 +37,7 @@ from .Lisflood_initial import LisfloodModel_ini
 from .Lisflood_monteCarlo import LisfloodModel_monteCarlo
 from .global_modules.settings import LisSettings, CDFFlags
 from .global_modules.errors import LisfloodError
+from .global_modules.decorators import Cache
 from lisflood.global_modules.settings import LisfloodRunInfo
 from .global_modules.settings import calendar, inttodate
 from . import __authors__, __version__, __date__, __status__
@@ -81,6 +82,12 @@ def lisfloodexe(lissettings=None):
     # read the settingsfile with all information about the catchments(s)
     # and the choosen option for mdelling and output
 
+    if binding.get('MapsCaching') == 'True':
+        # memory limit of cached maps (see Cache)
+        max_bytes = int(binding.get('MapsCachingMemoryMB', '0')) * 1024**2
+        Cache.configure(max_bytes if max_bytes > 0 else None, binding.get('MapsCachingSpillDir') or None,
+                        binding.get('MapsCachingSharedDir') or None)
+
     # remove steps from ReportSteps that are not included in simulation period
     for key in report_steps:
         report_steps[key] = [x for x in report_steps[key] if model_steps[0] <= x <= model_steps[1]]
@@ -0,0 +1,85 @@
+"""
+
+Copyright 2019 European Union
+
+Licensed under the EUPL, Version 1.2 or as soon they will be approved by the European Commission  subsequent versions of the EUPL (the "Licence");
+
+You may not use this work except in compliance with the Licence.
+You may obtain a copy of the Licence at:
+
+https://joinup.ec.europa.eu/sites/default/files/inline-files/EUPL%20v1_2%20EN(1).txt
+
+Unless required by applicable law or agreed to in writing, software distributed under the Licence is distributed on an "AS IS" basis,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the Licence for the specific language governing permissions and limitations under the Licence.
+
+Pre-processing of the forcings of a LISFLOOD settings file: each forcing is compressed once to the pixels of
+the mask map and written to the forcing store (ForcingStore binding), from which later runs with the same
+mask map read it with no flipping, cutting or masking (see global_modules.netcdf.ForcingStore).
+"""
+
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import sys
+import time
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+if os.path.exists(src_dir):
+    sys.path.append(src_dir)
+
+from .global_modules.settings import LisSettings, CutMap
+from .global_modules.add1 import loadsetclone, mapattrNetCDF
+from .global_modules.netcdf import ForcingStore
+from .global_modules.errors import LisfloodError
+from .hydrological_modules.readmeteo import METEO_FORCINGS
+
+
+def preprocess(lissettings, forcings=METEO_FORCINGS, time_chunk='auto'):
+    """ Write forcings (bindings of netcdf time series) of lissettings (LisSettings or path of the settings file)
+    to the forcing store, reading time_chunk steps at a time. Returns the paths of the stored forcings.
+    """
+    if isinstance(lissettings, str):
+        lissettings = LisSettings(lissettings)
+    binding = lissettings.binding
+    if not binding.get('ForcingStore'):
+        raise LisfloodError('ForcingStore must be set in the settings file to pre-process forcings')
+
+    # mask map and its cut window in the forcings, as in LisfloodModel_ini
+    loadsetclone('MaskMap')
+    CutMap(*mapattrNetCDF(binding['netCDFtemplate']))
+
+    store = ForcingStore(binding['ForcingStore'])
+    entries = []
+    for dataname in forcings:
+        start = time.time()
+        entries.append(store.write(dataname, binding[dataname], time_chunk))
+        if not lissettings.flags['veryquiet']:
+            print('{} -> {} ({:.1f} s)'.format(binding[dataname], entries[-1], time.time() - start))
+    return entries
+
+
+def main(*args):
+
+    parser = argparse.ArgumentParser(prog='lisflood-preprocess',
+                                     description='Compress the forcings of a LISFLOOD settings file to its mask map '
+                                                 'and write them to the forcing store (ForcingStore)')
+    parser.add_argument('settings', help='LISFLOOD settings file')
+    parser.add_argument('-f', '--forcings', nargs='+', default=list(METEO_FORCINGS),
+                        help='bindings of the forcings to pre-process (default: {})'.format(' '.join(METEO_FORCINGS)))
+    parser.add_argument('-t', '--timechunks', default='auto',
+                        help='number of steps read at a time (default: auto, to let xarray decide)')
+    parser.add_argument('-s', '--skipvalreplace', action='store_true',
+                        help='skip replacement of invalid values (as the same option of lisflood)')
+    parser.add_argument('-v', '--veryquiet', action='store_true', help='no output')
+    options = parser.parse_args(args if len(args) > 0 else sys.argv[1:])
+
+    sys_args = [flag for flag, is_set in (('-s', options.skipvalreplace), ('-v', options.veryquiet)) if is_set]
+    time_chunk = options.timechunks if options.timechunks == 'auto' else int(options.timechunks)
+    try:
+        preprocess(LisSettings(options.settings, sys_args), options.forcings, time_chunk)
+    except LisfloodError as e:
+        print(e)
+        return 1
+    return 0
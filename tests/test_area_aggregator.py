@@ -0,0 +1,45 @@
+from __future__ import absolute_import, print_function
+
+import numpy as np
+
+from lisflood.hydrological_modules.area_aggregator import AreaAggregator
+
+
+def bincount_total(zones, weights):
+    return np.take(np.bincount(zones, weights=weights), zones)
+
+
+class TestAreaAggregator(object):
+
+    def setup_method(self):
+        rng = np.random.RandomState(0)
+        self.zones = rng.choice(np.array([0, 2, 3, 7]), size=5000).astype(np.int32)
+        self.weights = [rng.rand(self.zones.size) * 1e3 for _ in range(3)]
+        self.aggregator = AreaAggregator(self.zones)
+
+    def test_same_as_bincount(self):
+        a, b, c = self.weights
+        expected = bincount_total(self.zones, a)
+        expected += bincount_total(self.zones, b)
+        expected -= bincount_total(self.zones, c)
+        assert np.array_equal(self.aggregator.areatotal(a, b, c, coefficients=(1, 1, -1)), expected)
+        assert np.array_equal(self.aggregator.areatotal(2.), bincount_total(self.zones, np.full(self.zones.size, 2.)))
+
+    def test_add_to(self):
+        a, b, _ = self.weights
+        total = self.aggregator.areatotal(b)
+        expected = total.copy()
+        expected += bincount_total(self.zones, a)
+        expected -= bincount_total(self.zones, b)
+        result = self.aggregator.areatotal(a, b, coefficients=(1, -1), add_to=total)
+        assert result is total
+        assert np.array_equal(total, expected)
+
+    def test_areatotals(self):
+        a, b, c = self.weights
+        c[10] = np.nan
+        sum_ab, total_c, total_a = self.aggregator.areatotals((a, b), c, a)
+        assert np.array_equal(sum_ab, bincount_total(self.zones, a) + bincount_total(self.zones, b))
+        assert np.array_equal(total_a, bincount_total(self.zones, a))
+        # missing values only spread within their own total
+        assert np.array_equal(np.isnan(total_c), self.zones == self.zones[10])
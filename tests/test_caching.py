@@ -4,11 +4,14 @@ import datetime
 import shutil
 import pytest
 
+import numpy as np
+
 from lisfloodutilities.compare.nc import NetCDFComparator
 
 from lisflood.main import lisfloodexe
 from lisflood.global_modules.decorators import Cache
-from lisflood.global_modules.settings import LisSettings
+from lisflood.global_modules.settings import LisSettings, CutMap
+from lisflood.global_modules.add1 import loadsetclone, mapattrNetCDF, loadmap_stored, MapsStore
 
 from .test_utils import setoptions, mk_path_out, ETRS89TestCase
 
@@ -21,6 +24,8 @@ class TestCaching(ETRS89TestCase):
         os.mkdir(path_out)
     out_dir_a = os.path.join(case_dir, 'out', 'a')
     out_dir_b = os.path.join(case_dir, 'out', 'b')
+    spill_dir = os.path.join(case_dir, 'out', 'spill')
+    shared_dir = os.path.join(case_dir, 'out', 'shared')
 
     def test_caching_24h(self):
       dt_sec = 86400
@@ -34,6 +39,47 @@ class TestCaching(ETRS89TestCase):
       dt_sec = 86400
       self.run_lisflood_caching(dt_sec, test_extract=True)
 
+    def test_cache_limit(self):
+      settings_a = setoptions(self.settings_file,
+                              vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00',
+                                           'DtSec': 86400, 'PathOut': '$(PathRoot)/out/a'})
+      mk_path_out(self.out_dir_a)
+      lisfloodexe(settings_a)
+
+      # cached maps limited to 1 MB, evicted maps spilled to disk
+      vars_to_set = {'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00', 'DtSec': 86400,
+                     'PathOut': '$(PathRoot)/out/b', 'MapsCaching': 'True', 'MapsCachingMemoryMB': '1',
+                     'MapsCachingSpillDir': self.spill_dir}
+      mk_path_out(self.out_dir_b)
+      for _ in range(2):
+          lisfloodexe(setoptions(self.settings_file, vars_to_set=vars_to_set))
+          info = Cache.info()
+          assert info['nbytes'] <= 1024**2 or info['items'] == 1
+
+      assert info['evicted'] > 0 and info['spilled'] > 0 and info['spilled_found'] > 0
+      comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+      comparator.compare_dirs(self.out_dir_b, self.out_dir_a)
+
+    def test_cache_shared(self):
+      settings_a = setoptions(self.settings_file,
+                              vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00',
+                                           'DtSec': 86400, 'PathOut': '$(PathRoot)/out/a'})
+      mk_path_out(self.out_dir_a)
+      lisfloodexe(settings_a)
+
+      # maps shared through a folder, with reservoirs (their sites map is changed in place)
+      vars_to_set = {'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00', 'DtSec': 86400,
+                     'PathOut': '$(PathRoot)/out/b', 'MapsCaching': 'True', 'MapsCachingSharedDir': self.shared_dir}
+      mk_path_out(self.out_dir_b)
+      for _ in range(2):
+          # second run: another process, attaching the maps written to the shared folder by the first
+          Cache.clear()
+          lisfloodexe(setoptions(self.settings_file, opts_to_set=('simulateReservoirs',), vars_to_set=vars_to_set))
+
+      assert Cache.info()['shared_found'] > 0
+      comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+      comparator.compare_dirs(self.out_dir_b, self.out_dir_a)
+
     def run_lisflood_caching(self, dt_sec, test_extract=False):
         
         settings_a = setoptions(self.settings_file,
@@ -82,6 +128,162 @@ class TestCaching(ETRS89TestCase):
         shutil.rmtree(self.out_dir_a, ignore_errors=True)
         shutil.rmtree(self.out_dir_b, ignore_errors=True)
         Cache.clear()
+        Cache.configure()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+
+class TestCacheLimit(object):
+    spill_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase', 'out', 'spill')
+    shared_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase', 'out', 'shared')
+
+    def test_lru_eviction(self):
+        @Cache
+        def read_map(value):
+            return np.full(1000, float(value))
+
+        Cache.configure(2 * 8000, self.spill_dir)
+        for value in range(3):
+            read_map(value)
+        read_map(1)  # most recently used
+        read_map(3)
+        info = Cache.info()
+        assert info['items'] == 2 and info['nbytes'] == 2 * 8000
+        assert info['evicted'] == 2 and info['spilled'] == 2
+        assert list(Cache.cache) == ['read_map, (1,), {}', 'read_map, (3,), {}']
+        # evicted maps are read back from the spill folder
+        assert np.array_equal(read_map(0), np.zeros(1000))
+        assert Cache.info()['spilled_found'] == 1
+        assert Cache.values_found() == 2 and Cache.size() == 4
+
+    def test_shared(self):
+        calls = []
+
+        @Cache
+        def read_map(value):
+            calls.append(value)
+            return np.full(1000, float(value))
+
+        Cache.configure(shared_dir=self.shared_dir)
+        first = read_map(1)
+        # another process: nothing in its own cache, the map is attached from the shared folder
+        Cache.clear()
+        second = read_map(1)
+        assert calls == [1]
+        assert isinstance(second, np.memmap) and second.mode == 'c'
+        assert np.array_equal(first, second)
+        assert Cache.info()['shared_found'] == 1 and Cache.info()['nbytes'] == 0
+        # maps changed in place (e.g. reservoir sites) are copy-on-write: the shared file is unchanged
+        second[:] = 0
+        Cache.clear()
+        assert np.array_equal(read_map(1), np.ones(1000))
+        Cache.clear_shared()
+        assert os.listdir(self.shared_dir) == []
+
+    def teardown_method(self):
+        Cache.clear()
+        Cache.configure()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+
+class TestRoutingTopologyCaching(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+    topology_dir = os.path.join(case_dir, 'out', 'topology')
+
+    def test_routing_topology_cache(self):
+        settings_a = setoptions(self.settings_file,
+                                vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00',
+                                             'PathOut': '$(PathRoot)/out/a',
+                                             'RoutingTopologyCache': self.topology_dir})
+        mk_path_out(self.out_dir_a)
+        lisfloodexe(settings_a)
+
+        # one entry for the channel network (LddKinematic) and one for the overland network (LddToChan)
+        entries = sorted(os.listdir(self.topology_dir))
+        assert len(entries) == 2
+        mtimes = [os.path.getmtime(os.path.join(self.topology_dir, entry)) for entry in entries]
+
+        settings_b = setoptions(self.settings_file,
+                                vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00',
+                                             'PathOut': '$(PathRoot)/out/b',
+                                             'RoutingTopologyCache': self.topology_dir})
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+
+        assert sorted(os.listdir(self.topology_dir)) == entries
+        assert [os.path.getmtime(os.path.join(self.topology_dir, entry)) for entry in entries] == mtimes
+
+        comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+        comparator.compare_dirs(self.out_dir_b, self.out_dir_a)
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
+        shutil.rmtree(self.topology_dir, ignore_errors=True)
+
+
+class TestMapsStore(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+    store_dir = os.path.join(case_dir, 'out', 'maps_store')
+
+    def settings(self, path_out, maps_store=''):
+        return setoptions(self.settings_file,
+                          vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/08/2016 06:00',
+                                       'PathOut': path_out, 'MapsStore': maps_store})
+
+    def test_same_results(self):
+        settings_a = self.settings('$(PathRoot)/out/a')
+        mk_path_out(self.out_dir_a)
+        lisfloodexe(settings_a)
+
+        # first run writes the maps to the store, second run reads them from there
+        settings_b = self.settings('$(PathRoot)/out/b', self.store_dir)
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+        entries = sorted(os.listdir(self.store_dir))
+        assert entries and all(entry.endswith('.npy') for entry in entries)
+        mtimes = [os.path.getmtime(os.path.join(self.store_dir, entry)) for entry in entries]
+        comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+        comparator.compare_dirs(self.out_dir_b, self.out_dir_a)
+
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
+        settings_b = self.settings('$(PathRoot)/out/b', self.store_dir)
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+        assert sorted(os.listdir(self.store_dir)) == entries
+        assert [os.path.getmtime(os.path.join(self.store_dir, entry)) for entry in entries] == mtimes
+        comparator.compare_dirs(self.out_dir_b, self.out_dir_a)
+
+    def test_modified_map(self):
+        settings = self.settings('$(PathRoot)/out/a', self.store_dir)
+        loadsetclone('MaskMap')
+        CutMap(*mapattrNetCDF(settings.binding['netCDFtemplate']))
+        mk_path_out(self.out_dir_a)
+        map_path = os.path.join(self.out_dir_a, 'lzavin.nc')
+        shutil.copy(settings.binding['LZAvInflowMap'], map_path)
+
+        data = loadmap_stored('LZAvInflowMap', value=map_path)
+        assert np.array_equal(MapsStore(self.store_dir).read(MapsStore.key(MapsStore.source(map_path))), data)
+        # a modified file is read again
+        stat = os.stat(map_path)
+        os.utime(map_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert MapsStore(self.store_dir).read(MapsStore.key(MapsStore.source(map_path))) is None
+        assert np.array_equal(loadmap_stored('LZAvInflowMap', value=map_path), data)
+        assert len(os.listdir(self.store_dir)) == 2
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
+        shutil.rmtree(self.store_dir, ignore_errors=True)
 
 
 @pytest.mark.slow
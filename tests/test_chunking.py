@@ -2,12 +2,16 @@ from __future__ import absolute_import
 import os
 import datetime
 import shutil
+import time
+import numpy as np
 import pytest
 
 from lisfloodutilities.compare.nc import NetCDFComparator
 
 from lisflood.main import lisfloodexe
-from lisflood.global_modules.settings import LisSettings
+from lisflood.global_modules.settings import LisSettings, CutMap
+from lisflood.global_modules.add1 import loadsetclone, mapattrNetCDF
+from lisflood.global_modules.netcdf import xarray_reader
 
 from .test_utils import setoptions, mk_path_out, ETRS89TestCase
 
@@ -72,3 +76,46 @@ class TestChunking(ETRS89TestCase):
         shutil.rmtree(self.out_dir_b, ignore_errors=True)
         shutil.rmtree(self.out_dir_c, ignore_errors=True)
         shutil.rmtree(self.out_dir_d, ignore_errors=True)
+
+
+class TestPrefetch(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    forcings = ('PrecipitationMaps', 'TavgMaps', 'ET0Maps', 'E0Maps')
+
+    def readers(self, prefetch, time_chunks='10'):
+        settings = setoptions(self.settings_file,
+                              vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00', 'DtSec': '86400',
+                                           'NetCDFTimeChunks': time_chunks, 'NetCDFTimeChunksPrefetch': str(prefetch)})
+        loadsetclone('MaskMap')
+        CutMap(*mapattrNetCDF(settings.binding['netCDFtemplate']))
+        return {data: xarray_reader(data) for data in self.forcings}
+
+    def test_prefetch_same_data(self):
+        readers = self.readers(prefetch=0)
+        readers_prefetch = self.readers(prefetch=2)
+        assert all(reader.prefetch == 2 for reader in readers_prefetch.values())
+        for data in self.forcings:
+            for step in range(len(readers[data].index_map)):
+                assert np.array_equal(readers[data][step], readers_prefetch[data][step])
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize('compute_time', [0.01, 0.05])
+    def test_benchmark(self, compute_time):
+        """Time spent waiting for forcings at each daily step, with and without prefetching
+        (compute_time is the simulated model time per step)"""
+        wait_times = []
+        for prefetch in (0, 1, 2):
+            readers = self.readers(prefetch, time_chunks='5')
+            num_steps = len(readers[self.forcings[0]].index_map)
+            start = time.perf_counter()
+            for step in range(num_steps):
+                for reader in readers.values():
+                    reader[step]
+                time.sleep(compute_time)
+            elapsed = time.perf_counter() - start
+            wait_time = sum(reader.wait_time for reader in readers.values())
+            wait_times.append(wait_time)
+            print('prefetch {}: {:.2f} ms/step waiting for forcings, {:.2f} ms/step in total'.format(
+                prefetch, 1e3 * wait_time / num_steps, 1e3 * elapsed / num_steps))
+        assert wait_times[1] < wait_times[0]
@@ -0,0 +1,91 @@
+from __future__ import absolute_import, print_function
+
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+import pcraster
+
+from lisflood.hydrological_modules.flow_network import FlowNetwork, insertPits
+
+from .test_kinematic_wave import synthetic_ldd
+
+
+LDD_MAPS = [
+    ('LF_ETRS89_UseCase/maps/ec_ldd.nc', 'ec_ldd_repaired'),
+    ('LF_lat_lon_UseCase/maps/ldd.nc', 'ldd1'),
+]
+
+
+def pcraster_ldd(path, varname):
+    """LDD of a test catchment as PCRaster map (repaired as in LISFLOOD), and its land mask"""
+    with Dataset(os.path.join(os.path.dirname(__file__), 'data', path)) as nc:
+        values = np.ma.filled(nc.variables[varname][:].astype(float), np.nan)
+    pcraster.setclone(values.shape[0], values.shape[1], 1., 0., 0.)
+    encoded = np.where(np.isnan(values), 255, values).astype(np.uint8)
+    ldd = pcraster.lddrepair(pcraster.numpy2pcr(pcraster.Ldd, encoded, 255))
+    return ldd, ~np.isnan(values)
+
+
+def compressed(pcr_map, land_mask):
+    return pcraster.pcr2numpy(pcr_map, np.nan).astype(float)[land_mask]
+
+
+@pytest.mark.parametrize('path, varname', LDD_MAPS)
+class TestSameAsPcraster(object):
+
+    def setup_ldd(self, path, varname):
+        self.ldd, self.land_mask = pcraster_ldd(path, varname)
+        self.network = FlowNetwork(compressed(self.ldd, self.land_mask), self.land_mask, min_parallel_width=10)
+        self.values = np.random.RandomState(0).rand(self.land_mask.sum())
+        self.pcr_values = pcraster.numpy2pcr(pcraster.Scalar, self._decompressed(self.values), -9999)
+
+    def _decompressed(self, values):
+        full = -9999 * np.ones(self.land_mask.shape)
+        full[self.land_mask] = values
+        return full
+
+    def test_accuflux(self, path, varname):
+        self.setup_ldd(path, varname)
+        expected = compressed(pcraster.accuflux(self.ldd, self.pcr_values), self.land_mask)
+        assert np.allclose(self.network.accuflux(self.values), expected, rtol=1e-6)
+
+    def test_upstream(self, path, varname):
+        self.setup_ldd(path, varname)
+        expected = compressed(pcraster.upstream(self.ldd, self.pcr_values), self.land_mask)
+        assert np.allclose(self.network.upstream(self.values), expected, rtol=1e-6)
+
+    def test_downstream(self, path, varname):
+        self.setup_ldd(path, varname)
+        expected = compressed(pcraster.downstream(self.ldd, self.pcr_values), self.land_mask)
+        assert np.allclose(self.network.downstream(self.values), expected, rtol=1e-6)
+
+    def test_insert_pits(self, path, varname):
+        self.setup_ldd(path, varname)
+        is_pit = self.values > 0.8
+        pcr_is_pit = pcraster.numpy2pcr(pcraster.Boolean, np.where(self.land_mask, self._decompressed(is_pit), 0).astype(np.uint8), 255)
+        expected = compressed(pcraster.lddrepair(pcraster.ifthenelse(pcr_is_pit, pcraster.ldd(5), self.ldd)), self.land_mask)
+        assert np.array_equal(insertPits(compressed(self.ldd, self.land_mask), is_pit), expected)
+
+
+class TestMissingValues(object):
+
+    def test_undefined_pixels_are_missing(self):
+        compressed_ldd, land_mask = synthetic_ldd(40, 30)
+        undefined = np.random.RandomState(1).rand(compressed_ldd.size) < 0.2
+        network = FlowNetwork(np.where(undefined, np.nan, compressed_ldd), land_mask)
+        for result in (network.accuflux(1.), network.upstream(1.), network.downstream(1.)):
+            assert np.all(np.isnan(result[undefined]))
+            assert not np.any(np.isnan(result[~undefined]))
+        # pixels draining into undefined pixels are pits: nothing flows into undefined pixels
+        assert np.all(network.num_upstream_pixels[undefined] == 0)
+        assert np.all(network.downstreamIndex(-1)[undefined] == -1)
+
+    def test_accuflux_is_upstream_area(self):
+        compressed_ldd, land_mask = synthetic_ldd(40, 30, holes=0)
+        network = FlowNetwork(compressed_ldd, land_mask, min_parallel_width=5)
+        upstream_area = network.accuflux(1.)
+        # pits (last row) collect the pixels of their catchments
+        assert upstream_area[network.downstreamIndex(-1) == -1].sum() == compressed_ldd.size
+        assert np.array_equal(upstream_area - 1, network.upstream(upstream_area))
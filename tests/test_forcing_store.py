@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+import os
+import shutil
+
+import numpy as np
+
+from lisfloodutilities.compare.nc import NetCDFComparator
+
+from lisflood.main import lisfloodexe
+from lisflood.preprocess import preprocess
+from lisflood.global_modules.settings import CutMap
+from lisflood.global_modules.add1 import loadsetclone, mapattrNetCDF
+from lisflood.global_modules.netcdf import xarray_reader, ForcingStoreReader, XarrayChunked
+from lisflood.hydrological_modules.readmeteo import METEO_FORCINGS
+
+from .test_utils import setoptions, mk_path_out, ETRS89TestCase
+
+
+class TestForcingStore(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    store_dir = os.path.join(case_dir, 'out', 'forcing_store')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+
+    def settings(self, path_out='$(PathRoot)/out', forcing_store=''):
+        return setoptions(self.settings_file,
+                          vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00',
+                                       'DtSec': '86400', 'PathOut': path_out, 'NetCDFTimeChunks': '10',
+                                       'ForcingStore': forcing_store})
+
+    def readers(self, forcing_store=''):
+        settings = self.settings(forcing_store=forcing_store)
+        loadsetclone('MaskMap')
+        CutMap(*mapattrNetCDF(settings.binding['netCDFtemplate']))
+        return {data: xarray_reader(data) for data in METEO_FORCINGS}
+
+    def test_same_data(self):
+        preprocess(self.settings(forcing_store=self.store_dir), time_chunk=7)
+        readers = self.readers()
+        stored_readers = self.readers(self.store_dir)
+        for data in METEO_FORCINGS:
+            assert isinstance(readers[data], XarrayChunked)
+            assert isinstance(stored_readers[data], ForcingStoreReader)
+            for step in range(len(readers[data].index_map)):
+                assert np.array_equal(readers[data][step], stored_readers[data][step])
+
+    def test_same_results(self):
+        settings_a = self.settings('$(PathRoot)/out/a')
+        mk_path_out(self.out_dir_a)
+        lisfloodexe(settings_a)
+
+        preprocess(self.settings(forcing_store=self.store_dir))
+        settings_b = self.settings('$(PathRoot)/out/b', forcing_store=self.store_dir)
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+
+        comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+        comparator.compare_dirs(settings_a.output_dir, settings_b.output_dir)
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
@@ -0,0 +1,247 @@
+from __future__ import absolute_import, print_function
+
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lisflood.hydrological_modules.kinematic_wave_parallel import kinematicWave, decodeFlowMatrix, rebuildFlowMatrix, streamLookups, \
+    routingSchedule, splitSideflow
+from lisflood.hydrological_modules import kinematic_wave_parallel_tools as kwpt
+
+
+def synthetic_ldd(num_rows, num_cols, holes=0.05, seed=0):
+    """Random D8 flow direction grid draining southwards (LISFLOOD encoding, pits on the last row),
+    with a fraction of masked out pixels. Returns compressed LDD and land mask."""
+    rng = np.random.RandomState(seed)
+    ldd = rng.choice(np.array([1., 2., 3.]), size=(num_rows, num_cols))
+    ldd[:, 0][ldd[:, 0] == 1] = 2
+    ldd[:, -1][ldd[:, -1] == 3] = 2
+    ldd[-1, :] = 5
+    land_mask = rng.rand(num_rows, num_cols) >= holes
+    return ldd[land_mask], land_mask
+
+
+def legacy_routing_orders(downstream_lookup, upstream_lookup):
+    """Routing orders as computed up to LISFLOOD 4.1 (level-by-level scan and pandas sort), used as reference."""
+    num_pixels = downstream_lookup.size
+    topological_distance = - np.ones(num_pixels, int)
+    is_outlet = np.zeros(num_pixels, bool)
+    is_outlet[downstream_lookup == -1] = True
+    distance = 1
+    while (topological_distance == -1).any():
+        to_track = np.logical_and(is_outlet, topological_distance == -1)
+        topological_distance[to_track] = distance
+        next_ups = np.unique(upstream_lookup[to_track])
+        next_ups = next_ups[next_ups != -1]
+        is_outlet[next_ups] = True
+        distance += 1
+    routing_order = topological_distance.max() - topological_distance
+    pixels_ordered = pd.DataFrame({"pixels": np.arange(routing_order.size), "order": routing_order})
+    pixels_ordered = pixels_ordered.sort_values(["order", "pixels"]).set_index("order").squeeze()
+    stop = pixels_ordered.groupby(pixels_ordered.index).count().cumsum()
+    order_start_stop = np.column_stack((np.append(0, stop[:-1]), stop)).astype(int)
+    return pixels_ordered.values.astype(int), order_start_stop
+
+
+def lookups(compressed_ldd, land_mask):
+    flow_dir = decodeFlowMatrix(rebuildFlowMatrix(compressed_ldd, land_mask))
+    downstream_lookup, upstream_lookup = streamLookups(flow_dir, land_mask)
+    num_upstream_pixels = (upstream_lookup != -1).sum(1).astype(int)
+    return downstream_lookup, upstream_lookup, num_upstream_pixels
+
+
+class TestRoutingOrders(object):
+
+    def test_same_as_legacy(self):
+        downstream_lookup, upstream_lookup, num_upstream_pixels = lookups(*synthetic_ldd(120, 90))
+        pixels_ordered, order_start_stop, num_reached = kwpt.routingOrders(downstream_lookup, upstream_lookup, num_upstream_pixels)
+        legacy_pixels_ordered, legacy_order_start_stop = legacy_routing_orders(downstream_lookup, upstream_lookup)
+        assert num_reached == downstream_lookup.size
+        assert np.array_equal(pixels_ordered, legacy_pixels_ordered)
+        assert np.array_equal(order_start_stop, legacy_order_start_stop)
+
+    def test_routing_steady_state(self):
+        compressed_ldd, land_mask = synthetic_ldd(60, 40)
+        num_pixels = compressed_ldd.size
+        space_delta = np.full(num_pixels, 1000.)
+        router = kinematicWave(compressed_ldd, land_mask, np.full(num_pixels, 2.), 0.6, space_delta, 3600.)
+        discharge = np.zeros(num_pixels)
+        specific_lateral_inflow = np.full(num_pixels, 1e-3)
+        for _ in range(300):
+            router.kinematicWaveRouting(discharge, specific_lateral_inflow)
+        # at steady state, the outlets discharge all the lateral inflow
+        outlets = router.downstream_lookup == -1
+        assert np.isclose(discharge[outlets].sum(), (specific_lateral_inflow * space_delta).sum(), rtol=1e-9)
+
+
+class TestRoutingSchedule(object):
+
+    def test_schedule(self):
+        order_start_stop = np.array([[0, 600], [600, 601], [601, 603], [603, 1203], [1203, 1204]])
+        schedule = routingSchedule(order_start_stop, 500)
+        assert np.array_equal(schedule, [[0, 600, 1], [600, 603, 0], [603, 1203, 1], [1203, 1204, 0]])
+        assert np.array_equal(routingSchedule(order_start_stop, 0)[:, :2], order_start_stop)
+        assert np.array_equal(routingSchedule(order_start_stop, 10 ** 6), [[0, 1204, 0]])
+
+    def test_same_discharge(self):
+        compressed_ldd, land_mask = synthetic_ldd(300, 200)
+        num_pixels = compressed_ldd.size
+        discharges = []
+        for min_parallel_width in (0, 50, num_pixels + 1):
+            router = kinematicWave(compressed_ldd, land_mask, np.full(num_pixels, 2.), 0.6, np.full(num_pixels, 1000.), 3600.,
+                                   min_parallel_width=min_parallel_width)
+            discharge = np.ones(num_pixels)
+            for _ in range(5):
+                router.kinematicWaveRouting(discharge, np.full(num_pixels, 1e-3))
+            discharges.append(discharge)
+        assert np.array_equal(discharges[0], discharges[1])
+        assert np.array_equal(discharges[0], discharges[2])
+
+
+class TestSubbasinEngine(object):
+
+    @pytest.mark.parametrize('holes', [0., 0.05])
+    def test_subbasins(self, holes):
+        downstream_lookup, upstream_lookup, num_upstream_pixels = lookups(*synthetic_ldd(200, 150, holes=holes))
+        pixels_ordered, _, _ = kwpt.routingOrders(downstream_lookup, upstream_lookup, num_upstream_pixels)
+        subbasin_pixels, subbasin_start_stop, subbasins_ordered, level_start_stop = kwpt.subbasinDecomposition(
+            downstream_lookup, upstream_lookup, num_upstream_pixels, pixels_ordered, 500)
+        # every pixel is routed once, after its upstream pixels
+        assert np.array_equal(np.sort(subbasin_pixels), np.arange(downstream_lookup.size))
+        routed_at_level = -np.ones(downstream_lookup.size, int)
+        for level, (start, stop) in enumerate(level_start_stop):
+            for subbasin in subbasins_ordered[start:stop]:
+                routed = set()
+                for pix in subbasin_pixels[subbasin_start_stop[subbasin, 0]:subbasin_start_stop[subbasin, 1]]:
+                    for ups_pix in upstream_lookup[pix, :num_upstream_pixels[pix]]:
+                        assert ups_pix in routed or 0 <= routed_at_level[ups_pix] < level
+                    routed.add(pix)
+                routed_at_level[list(routed)] = level
+
+    @pytest.mark.parametrize('holes', [0., 0.05])
+    def test_same_discharge(self, holes):
+        compressed_ldd, land_mask = synthetic_ldd(300, 200, holes=holes)
+        num_pixels = compressed_ldd.size
+        rng = np.random.RandomState(1)
+        alpha = rng.uniform(0.5, 5., num_pixels)
+        specific_lateral_inflow = rng.uniform(0., 1e-2, num_pixels)
+        discharges = []
+        for engine in ('orders', 'subbasins'):
+            router = kinematicWave(compressed_ldd, land_mask, alpha, 0.6, np.full(num_pixels, 1000.), 3600., engine=engine)
+            discharge = np.ones(num_pixels)
+            for _ in range(5):
+                router.kinematicWaveRouting(discharge, specific_lateral_inflow)
+            discharges.append(discharge)
+        assert np.array_equal(discharges[0], discharges[1])
+
+
+class TestBatchRouting(object):
+
+    @pytest.mark.parametrize('engine', ['orders', 'subbasins'])
+    def test_same_as_separate_routers(self, engine):
+        compressed_ldd, land_mask = synthetic_ldd(300, 200)
+        num_pixels = compressed_ldd.size
+        rng = np.random.RandomState(1)
+        alpha = rng.uniform(0.5, 5., (3, num_pixels))
+        specific_lateral_inflow = rng.uniform(0., 1e-2, (3, num_pixels))
+        space_delta = np.full(num_pixels, 1000.)
+        batch_router = kinematicWave(compressed_ldd, land_mask, alpha, 0.6, space_delta, 3600., engine=engine)
+        batch_discharge = np.ones((3, num_pixels))
+        for _ in range(5):
+            batch_router.kinematicWaveRouting(batch_discharge, specific_lateral_inflow)
+        for field in range(3):
+            router = kinematicWave(compressed_ldd, land_mask, alpha[field], 0.6, space_delta, 3600., engine=engine)
+            discharge = np.ones(num_pixels)
+            for _ in range(5):
+                router.kinematicWaveRouting(discharge, specific_lateral_inflow[field])
+            assert np.array_equal(batch_discharge[field], discharge)
+
+    def test_float32(self):
+        # overland flow with ModelPrecision float32: single precision states, same discharge as in double precision
+        compressed_ldd, land_mask = synthetic_ldd(300, 200)
+        num_pixels = compressed_ldd.size
+        rng = np.random.RandomState(1)
+        alpha = rng.uniform(0.5, 5., (3, num_pixels))
+        specific_lateral_inflow = rng.uniform(0., 1e-2, (3, num_pixels))
+        discharges = []
+        for dtype in (np.float64, np.float32):
+            router = kinematicWave(compressed_ldd, land_mask, alpha.astype(dtype), 0.6, np.full(num_pixels, 1000., dtype), 3600.)
+            assert router.space_delta.dtype == dtype and router.a_dx_div_dt_channel.dtype == dtype
+            discharge = np.ones((3, num_pixels), dtype)
+            for _ in range(5):
+                router.kinematicWaveRouting(discharge, specific_lateral_inflow.astype(dtype))
+            assert discharge.dtype == dtype
+            discharges.append(discharge)
+        assert np.allclose(discharges[1], discharges[0], rtol=1e-5, atol=1e-9)
+
+
+class TestSplitSideflow(object):
+
+    def test_same_as_numpy(self):
+        num_pixels = 10000
+        rng = np.random.RandomState(1)
+        sideflow = rng.normal(0., 1e-3, num_pixels)
+        sideflow[::7] = 1e-8
+        chan_m3 = rng.uniform(0., 10., num_pixels)
+        chan2_m3 = rng.uniform(0., 10., num_pixels)
+        chan_m3[::5] = chan2_m3[::5] = 0.
+        chan2_m3_start = rng.uniform(0., 3., num_pixels)
+        m3_limit = rng.uniform(0., 8., num_pixels)
+        chan2_q_start = rng.uniform(0., 1., num_pixels)
+        inv_chan_length = 1. / rng.uniform(500., 1500., num_pixels)
+        # split routing sideflow as computed in routing.dynamic up to LISFLOOD 4.1
+        ratio = np.where((chan_m3 + chan2_m3) > 0, chan_m3 / (chan_m3 + chan2_m3), 0.0)
+        sideflow1 = np.where((chan_m3 + chan2_m3 - chan2_m3_start) > m3_limit, ratio * sideflow, sideflow)
+        sideflow1 = np.where(np.abs(sideflow) < 1e-7, sideflow, sideflow1)
+        sideflow2 = sideflow - sideflow1 + chan2_q_start * inv_chan_length
+        out = (np.empty(num_pixels), np.empty(num_pixels))
+        result = splitSideflow(sideflow, chan_m3, chan2_m3, chan2_m3_start, m3_limit, chan2_q_start, inv_chan_length, out=out)
+        assert result[0] is out[0] and result[1] is out[1]
+        assert np.array_equal(out[0], sideflow1)
+        assert np.array_equal(out[1], sideflow2)
+
+
+class TestNewtonWarmStart(object):
+
+    def test_warm_start(self):
+        compressed_ldd, land_mask = synthetic_ldd(300, 200)
+        num_pixels = compressed_ldd.size
+        alpha = np.random.RandomState(1).uniform(0.5, 5., num_pixels)
+        discharges = []
+        iterations = []
+        for warm_start in (False, True):
+            router = kinematicWave(compressed_ldd, land_mask, alpha, 0.6, np.full(num_pixels, 1000.), 3600., warm_start=warm_start)
+            discharge = np.ones(num_pixels)
+            num_iterations = 0
+            for step in range(24):
+                router.kinematicWaveRouting(discharge, np.full(num_pixels, 1e-3 * (1 + 0.1 * np.sin(step / 4.))))
+                num_iterations += router.newton_iterations['main_channel'].sum()
+            discharges.append(discharge)
+            iterations.append(num_iterations)
+        assert iterations[1] < iterations[0]
+        assert np.allclose(discharges[1], discharges[0], rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.slow
+class TestRoutingOrdersBenchmark(object):
+
+    @pytest.mark.parametrize('num_rows,num_cols', [(316, 316), (1000, 1000), (3162, 3162)])
+    def test_benchmark(self, num_rows, num_cols):
+        # no masked pixels: rivers as long as the number of rows
+        downstream_lookup, upstream_lookup, num_upstream_pixels = lookups(*synthetic_ldd(num_rows, num_cols, holes=0.))
+        kwpt.routingOrders(*lookups(*synthetic_ldd(5, 5)))  # compilation
+
+        start = time.time()
+        pixels_ordered, order_start_stop, _ = kwpt.routingOrders(downstream_lookup, upstream_lookup, num_upstream_pixels)
+        elapsed = time.time() - start
+
+        start = time.time()
+        legacy_pixels_ordered, legacy_order_start_stop = legacy_routing_orders(downstream_lookup, upstream_lookup)
+        elapsed_legacy = time.time() - start
+
+        print('{} cells, {} orders: routingOrders {:.3f} s, legacy {:.3f} s (x{:.0f})'.format(
+            num_rows * num_cols, order_start_stop.shape[0], elapsed, elapsed_legacy, elapsed_legacy / elapsed))
+        assert np.array_equal(pixels_ordered, legacy_pixels_ordered)
+        assert np.array_equal(order_start_stop, legacy_order_start_stop)
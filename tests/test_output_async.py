@@ -0,0 +1,122 @@
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+from lisfloodutilities.compare.nc import NetCDFComparator
+
+from lisflood.main import lisfloodexe
+from lisflood.global_modules.output import OutputMapsFactory, OutputMapsFactoryAsync, WriteJob
+
+from .test_utils import setoptions, mk_path_out, ETRS89TestCase
+
+
+class FakeOutput(object):
+    """ Output map writing its steps to a list, failing at step fail_step """
+
+    def __init__(self, written, fail_step=None, nbytes=8, delay=0.):
+        self.written = written
+        self.fail_step = fail_step
+        self.nbytes = nbytes
+        self.delay = delay
+        self.step = 0
+        self.writer = SimpleNamespace(threadsafe=True)
+        self.closed = False
+
+    def stage(self):
+        self.step += 1
+
+    def write_step(self, step):
+        time.sleep(self.delay)
+        if step == self.fail_step:
+            raise IOError('disk full')
+        self.written.append((self, step, threading.current_thread().name))
+
+    def take(self):
+        return WriteJob(partial(self.write_step, self.step), self.nbytes)
+
+    def close(self):
+        self.closed = True
+
+
+class TestOutputMapsFactoryAsync(object):
+
+    def factory(self, mocker, outputs, max_memory=1024):
+        mocker.patch.object(OutputMapsFactory, '__init__', return_value=None)
+        factory = OutputMapsFactoryAsync(None, max_memory)
+        factory.output_maps = outputs
+        return factory
+
+    def test_order(self, mocker):
+        written = []
+        outputs = [FakeOutput(written, delay=0.001), FakeOutput(written)]
+        factory = self.factory(mocker, outputs, max_memory=16)
+        for _ in range(20):
+            factory.write()
+        factory.close()
+        assert written == [(out, step, 'lisflood-output') for step in range(1, 21) for out in outputs]
+        assert all(out.closed for out in outputs)
+        assert factory.pending_bytes == 0
+
+    def test_error(self, mocker):
+        written = []
+        factory = self.factory(mocker, [FakeOutput(written, fail_step=3)])
+        with pytest.raises(IOError):
+            for _ in range(100):
+                factory.write()
+                time.sleep(0.001)
+            factory.close()
+        assert [step for _, step, _ in written] == [1, 2]
+        assert factory.thread is None
+
+
+class TestOutputWriterThread(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+
+    def settings(self, path_out, **writer):
+        vars_to_set = {'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00', 'DtSec': '86400', 'PathOut': path_out}
+        vars_to_set.update(writer)
+        return setoptions(self.settings_file, opts_to_set=('repStateMaps', 'repEndMaps', 'repDischargeMaps'),
+                          vars_to_set=vars_to_set)
+
+    def run(self, settings, out_dir):
+        mk_path_out(out_dir)
+        start = time.perf_counter()
+        lisfloodexe(settings)
+        return time.perf_counter() - start
+
+    def test_same_results(self):
+        settings_a = self.settings('$(PathRoot)/out/a')
+        self.run(settings_a, self.out_dir_a)
+        # a small memory budget, so that the model waits for the writer thread
+        settings_b = self.settings('$(PathRoot)/out/b', OutputMapsWriter='thread', OutputMapsWriterMemoryMB='1',
+                                   OutputMapsChunks='3')
+        self.run(settings_b, self.out_dir_b)
+
+        comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+        comparator.compare_dirs(settings_a.output_dir, settings_b.output_dir)
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize('output_chunks', ['1', '10'])
+    def test_benchmark(self, output_chunks):
+        elapsed = {}
+        for output_writer, path_out, out_dir in (('sync', '$(PathRoot)/out/a', self.out_dir_a),
+                                                 ('thread', '$(PathRoot)/out/b', self.out_dir_b)):
+            settings = self.settings(path_out, OutputMapsWriter=output_writer, OutputMapsChunks=output_chunks)
+            elapsed[output_writer] = self.run(settings, out_dir)
+        num_maps = len([f for f in os.listdir(self.out_dir_a) if f.endswith('.nc')])
+        print('{} map stacks written every {} steps: sync {:.2f} s, thread {:.2f} s'.format(
+            num_maps, output_chunks, elapsed['sync'], elapsed['thread']))
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+import os
+import shutil
+import time
+import uuid
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from lisfloodutilities.compare.nc import NetCDFComparator
+
+from lisflood.main import lisfloodexe
+from lisflood.global_modules.settings import CutMap, NetCDFMetadata, MaskInfo, calendar
+from lisflood.global_modules.add1 import loadsetclone, mapattrNetCDF, loadmap_base
+from lisflood.global_modules.errors import LisfloodError
+from lisflood.global_modules.netcdf import output_encoding, open_forcing, compress_forcing
+from lisflood.global_modules.output import NetcdfStepsWriter
+
+from .test_utils import setoptions, mk_path_out, ETRS89TestCase
+
+
+class TestOutputEncoding(object):
+
+    def test_defaults(self):
+        assert output_encoding({}) == {'chunk_shape': (1, -1, -1), 'compression': 'zlib', 'complevel': 4, 'shuffle': True,
+                                       'landpoints': False}
+
+    def test_map_stack_settings(self):
+        binding = {'OutputMapsChunkShape': '10,64,64', 'OutputMapsCompression': 'zlib',
+                   'DischargeMapsCompression': 'none', 'DischargeMapsShuffle': 'False', 'DischargeMapsLandPoints': 'True'}
+        assert output_encoding(binding, 'DischargeMaps') == {'chunk_shape': (10, 64, 64), 'compression': 'none',
+                                                             'complevel': 4, 'shuffle': False, 'landpoints': True}
+        assert output_encoding(binding, 'TavgMaps')['compression'] == 'zlib'
+
+    @pytest.mark.parametrize('binding', [{'OutputMapsChunkShape': '1,-1'}, {'OutputMapsChunkShape': '0,-1,-1'},
+                                         {'OutputMapsCompression': 'gzip'}, {'OutputMapsCompressionLevel': 'high'}])
+    def test_wrong_settings(self, binding):
+        with pytest.raises(LisfloodError):
+            output_encoding(binding)
+
+
+class TestOutputLayout(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+
+    def settings(self, path_out, **layout):
+        vars_to_set = {'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00', 'DtSec': '86400', 'PathOut': path_out}
+        vars_to_set.update(layout)
+        return setoptions(self.settings_file, opts_to_set=('repDischargeMaps',), vars_to_set=vars_to_set)
+
+    def test_tiled_layout(self):
+        settings_a = self.settings('$(PathRoot)/out/a')
+        mk_path_out(self.out_dir_a)
+        lisfloodexe(settings_a)
+
+        settings_b = self.settings('$(PathRoot)/out/b', OutputMapsChunkShape='10,16,16', OutputMapsChunks='10',
+                                   OutputMapsCompressionLevel='1')
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+
+        with Dataset(os.path.join(self.out_dir_b, 'dis.nc')) as nc:
+            dis = nc.variables['dis']
+            assert dis.chunking() == [10, min(16, dis.shape[1]), min(16, dis.shape[2])]
+            assert dis.filters()['complevel'] == 1
+        comparator = NetCDFComparator(settings_a.maskpath, array_equal=True)
+        comparator.compare_dirs(settings_a.output_dir, settings_b.output_dir)
+
+    def test_landpoints(self):
+        settings_a = self.settings('$(PathRoot)/out/a')
+        mk_path_out(self.out_dir_a)
+        lisfloodexe(settings_a)
+
+        settings_b = self.settings('$(PathRoot)/out/b', OutputMapsLandPoints='True')
+        mk_path_out(self.out_dir_b)
+        lisfloodexe(settings_b)
+
+        with Dataset(os.path.join(self.out_dir_b, 'dis.nc')) as nc:
+            assert nc.variables['dis'].dimensions == ('time', 'landpoint')
+            assert nc.variables['landpoint'].compress == 'y x'
+            assert nc.variables['landpoint'].size == MaskInfo.instance().info.mapC[0]
+        # end maps (warm start) and map stacks (chained runs) are read back as full maps
+        for filename in sorted(os.listdir(self.out_dir_a)):
+            if not filename.endswith('.nc'):
+                continue
+            path_a, path_b = os.path.join(self.out_dir_a, filename), os.path.join(self.out_dir_b, filename)
+            if filename == 'dis.nc':
+                forcing_a = compress_forcing(*open_forcing(path_a, 'auto'))
+                forcing_b = compress_forcing(*open_forcing(path_b, 'auto'))
+                assert np.array_equal(forcing_a.values, forcing_b.values, equal_nan=True)
+            else:
+                assert np.array_equal(loadmap_base(filename, value=path_a), loadmap_base(filename, value=path_b),
+                                      equal_nan=True)
+
+    def test_persistent_handle(self):
+        settings = setoptions(self.settings_file, vars_to_set={'OutputMapsChunks': '2'})
+        loadsetclone('MaskMap')
+        CutMap(*mapattrNetCDF(settings.binding['netCDFtemplate']))
+        NetCDFMetadata(uuid.uuid4())
+        mk_path_out(self.out_dir_a)
+        num_steps = 5
+        var = SimpleNamespace(DtDay=1., step=0)
+        var.currentTimeStep = lambda: var.step
+        map_value = SimpleNamespace(output_var='Discharge', unit='m3/s')
+        writer = NetcdfStepsWriter(var, 'DischargeMaps', map_value, os.path.join(self.out_dir_a, 'dis'), 'all', 'steps',
+                                   num_steps)
+        rng = np.random.RandomState(0)
+        maps = rng.rand(num_steps, MaskInfo.instance().info.mapC[0])
+        rep_steps = list(range(1, num_steps + 1))
+        start_date = calendar(settings.binding['CalendarDayStart'], settings.binding['calendar_type'])
+        handles = []
+        for step in rep_steps:
+            var.step = step
+            writer.step_range.append(step - 1)
+            writer.data_steps.append(maps[step - 1])
+            writer.write(start_date, rep_steps)
+            handles.append(writer.nf1)
+        # the file is opened once and closed at the last step
+        assert handles[0] is not None and all(handle is handles[0] for handle in handles[:-1])
+        assert handles[-1] is None
+        with Dataset(writer.map_path) as nc:
+            dis = nc.variables['dis'][:]
+        assert np.array_equal(dis[:, ~MaskInfo.instance().info.mask], maps)
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
+
+
+@pytest.mark.slow
+class TestOutputLayoutBenchmark(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir = os.path.join(case_dir, 'out', 'layout')
+    num_steps = 365
+
+    def write_stack(self, chunk_shape, compression, output_chunks):
+        """Write num_steps maps with NetcdfStepsWriter, output_chunks steps at a time: time per step"""
+        settings = setoptions(self.settings_file,
+                              vars_to_set={'OutputMapsChunkShape': chunk_shape, 'OutputMapsCompression': compression,
+                                           'OutputMapsChunks': str(output_chunks)})
+        loadsetclone('MaskMap')
+        CutMap(*mapattrNetCDF(settings.binding['netCDFtemplate']))
+        NetCDFMetadata(uuid.uuid4())
+        var = SimpleNamespace(DtDay=1., step=0)
+        var.currentTimeStep = lambda: var.step
+        map_value = SimpleNamespace(output_var='Discharge', unit='m3/s')
+        writer = NetcdfStepsWriter(var, 'DischargeMaps', map_value, os.path.join(self.out_dir, 'dis'), 'all', 'steps',
+                                   self.num_steps)
+        num_pixels = MaskInfo.instance().info.mapC[0]
+        rng = np.random.RandomState(0)
+        rep_steps = list(range(1, self.num_steps + 1))
+        start_date = calendar(settings.binding['CalendarDayStart'], settings.binding['calendar_type'])
+        elapsed = 0.
+        for step in rep_steps:
+            var.step = step
+            writer.step_range.append(step - 1)
+            writer.data_steps.append(rng.rand(num_pixels))
+            start = time.perf_counter()
+            writer.write(start_date, rep_steps)
+            elapsed += time.perf_counter() - start
+        return elapsed / self.num_steps
+
+    def read_time_series(self, num_points=50):
+        """Time to read the time series of a pixel"""
+        with Dataset(os.path.join(self.out_dir, 'dis.nc')) as nc:
+            dis = nc.variables['dis']
+            rng = np.random.RandomState(1)
+            start = time.perf_counter()
+            for _ in range(num_points):
+                dis[:, rng.randint(dis.shape[1]), rng.randint(dis.shape[2])]
+            return (time.perf_counter() - start) / num_points
+
+    @pytest.mark.parametrize('chunk_shape, compression, output_chunks', [
+        ('1,-1,-1', 'zlib', 1),
+        ('1,-1,-1', 'none', 1),
+        ('30,16,16', 'zlib', 30),
+        ('30,16,16', 'zlib', 1),
+        ('365,8,8', 'zlib', 365),
+    ])
+    def test_benchmark(self, chunk_shape, compression, output_chunks):
+        mk_path_out(self.out_dir)
+        write_time = self.write_stack(chunk_shape, compression, output_chunks)
+        read_time = self.read_time_series()
+        size = os.path.getsize(os.path.join(self.out_dir, 'dis.nc'))
+        print('chunks {} {} (written every {} steps): write {:.2f} ms/step, read {:.2f} ms/pixel time series, {:.1f} MB'.format(
+            chunk_shape, compression, output_chunks, 1e3 * write_time, 1e3 * read_time, size / 1024**2))
+
+    def teardown_method(self):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
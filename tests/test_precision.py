@@ -0,0 +1,85 @@
+from __future__ import absolute_import, print_function
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from lisflood.main import lisfloodexe, LisfloodModel
+from lisflood.global_modules.errors import LisfloodError
+from lisflood.global_modules.settings import model_precision
+
+from .test_utils import setoptions, mk_path_out, ETRS89TestCase
+
+
+def read_tss(path):
+    """Values of a time series file: (steps, points) array, missing values as NaN"""
+    with open(path) as tss_file:
+        lines = tss_file.readlines()
+    num_points = int(lines[1]) - 1
+    tss = np.loadtxt(lines[3 + num_points:], ndmin=2)[:, 1:]
+    tss[tss == 1e31] = np.nan
+    return tss
+
+
+def precision_report(out_dir_double, out_dir_single):
+    """Differences of discharge (relative to the peak discharge of each point) and of the mass balance
+    errors (mm) of the runs in float32 (out_dir_single) and float64 (out_dir_double)"""
+    dis_double, dis_single = (read_tss(os.path.join(out_dir, 'disWin.tss')) for out_dir in (out_dir_double, out_dir_single))
+    mb_double, mb_single = (read_tss(os.path.join(out_dir, 'mbErrorMm.tss')) for out_dir in (out_dir_double, out_dir_single))
+    peak = np.nanmax(np.abs(dis_double), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dis_diff = np.where(peak > 0, np.abs(dis_single - dis_double) / peak, 0)
+    return {'discharge_max_rel_diff': np.nanmax(dis_diff), 'discharge_mean_rel_diff': np.nanmean(dis_diff),
+            'mb_error_mm_double': np.nanmax(np.abs(mb_double)), 'mb_error_mm_single': np.nanmax(np.abs(mb_single))}
+
+
+class TestModelPrecisionSetting(object):
+
+    def test_default(self):
+        assert model_precision({}) == np.float64
+        assert model_precision({'ModelPrecision': 'float32'}) == np.float32
+
+    def test_wrong_setting(self):
+        with pytest.raises(LisfloodError):
+            model_precision({'ModelPrecision': 'float16'})
+
+
+# main soil, snow, groundwater and overland flow states, computed in the model precision
+PRECISION_STATES = ('W1a', 'SnowCover', 'LZ', 'OFQ')
+
+
+class TestModelPrecision(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+
+    def run(self, path_out, out_dir, precision, dynamic):
+        settings = setoptions(self.settings_file, opts_to_set=('repDischargeTs', 'repMBTs'),
+                              vars_to_set={'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00',
+                                           'DtSec': '86400', 'PathOut': path_out, 'ModelPrecision': precision})
+        mk_path_out(out_dir)
+        lisfloodexe(settings)
+        # states at the end of the run (model of the last call to LisfloodModel.dynamic)
+        model = dynamic.call_args[0][0]
+        for name in PRECISION_STATES:
+            assert getattr(model, name).dtype == np.dtype(precision), name
+
+    def test_float32(self, mocker):
+        dynamic = mocker.spy(LisfloodModel, 'dynamic')
+        self.run('$(PathRoot)/out/a', self.out_dir_a, 'float64', dynamic)
+        self.run('$(PathRoot)/out/b', self.out_dir_b, 'float32', dynamic)
+
+        report = precision_report(self.out_dir_a, self.out_dir_b)
+        print('float32 vs float64: discharge max {discharge_max_rel_diff:.2e} mean {discharge_mean_rel_diff:.2e} '
+              '(relative to peak), mass balance error {mb_error_mm_single:.2e} mm ({mb_error_mm_double:.2e} mm '
+              'in float64)'.format(**report))
+        # about the accuracy of the forcings (3 significant digits)
+        assert report['discharge_max_rel_diff'] < 1e-3
+        assert report['mb_error_mm_single'] < 1e-2
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)
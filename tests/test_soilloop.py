@@ -0,0 +1,275 @@
+from __future__ import absolute_import, print_function
+
+import os
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from numba import get_num_threads
+
+from lisflood.Lisflood_initial import _vegSum, LisfloodModel_ini, VegetationIndexes
+from lisflood.hydrological_modules.soil import soilPixelAverages
+from lisflood.hydrological_modules.soilloop import transpiration_water_stress, soilColumnsWaterBalance, soilColumnsSchedule
+
+
+REFERENCE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'soilloop_reference')
+
+
+def assert_same_as_reference(name, outputs):
+    """Compare outputs (dict of arrays) with the reference outputs REFERENCE_DIR/<name>.npz, computed on the same
+    synthetic inputs by the code of LISFLOOD 4.1 (numpy expressions and the serial soil columns kernel)"""
+    with np.load(os.path.join(REFERENCE_DIR, name + '.npz')) as reference:
+        assert sorted(outputs) == sorted(reference.files)
+        for key in reference.files:
+            np.testing.assert_allclose(outputs[key], reference[key], rtol=1e-12, atol=1e-12, err_msg=key)
+
+
+def time_per_step(function, num_steps):
+    """Average time (ms) of num_steps calls of function, after a first call (compilation)"""
+    function()
+    start = time.time()
+    for _ in range(num_steps):
+        function()
+    return 1e3 * (time.time() - start) / num_steps
+
+
+def synthetic_soil(num_pixels, seed=0):
+    """Random soil states and parameters of 3 prescribed fractions (Rainfed, Forest, Irrigated),
+    with some frozen pixels and some pixels below the wilting point or with WCrit1 = WWP1"""
+    rng = np.random.RandomState(seed)
+    num_fractions = 3
+    shape = (num_fractions, num_pixels)
+    WWP1a = rng.uniform(5, 20, shape)
+    WWP1b = rng.uniform(5, 20, shape)
+    WFC1a = WWP1a + rng.uniform(0, 40, shape)
+    WFC1b = WWP1b + rng.uniform(0, 40, shape)
+    WFC1a[:, ::17] = WWP1a[:, ::17]
+    WFC1b[:, ::17] = WWP1b[:, ::17]
+    soil = {
+        'DtDay': 1., 'InvDtDay': 1.,
+        'ETRef': rng.uniform(0, 12, num_pixels),
+        'isFrozenSoil': rng.rand(num_pixels) < 0.1,
+        'CropGroupNumber': rng.choice(np.array([1., 2., 2.5, 3., 4.5, 5.]), shape),
+        'WWP1a': WWP1a, 'WWP1b': WWP1b, 'WWP1': WWP1a + WWP1b,
+        'WFC1a': WFC1a, 'WFC1b': WFC1b, 'WFC1': WFC1a + WFC1b,
+        'WPF3a': WWP1a + rng.uniform(0, 20, shape),
+        'WPF3b': WWP1b + rng.uniform(0, 20, shape),
+        'potential_transpiration': rng.uniform(0, 8, shape),
+        'W1a': rng.uniform(0.5, 1.2, shape) * WFC1a,
+        'W1b': rng.uniform(0.5, 1.2, shape) * WFC1b,
+    }
+    soil['W1'] = soil['W1a'] + soil['W1b']
+    return soil
+
+
+def kernel_transpiration(soil, landuses, wateruse=True, stress_days=True):
+    num_pixels = soil['ETRef'].size
+    out = {'RWS': np.zeros((len(landuses), num_pixels)), 'Ta': np.zeros((len(landuses), num_pixels)),
+           'SoilMoistureStressDays': np.zeros((len(landuses), num_pixels)),
+           'W1a': soil['W1a'].copy(), 'W1b': soil['W1b'].copy(), 'W1': soil['W1'].copy(),
+           'WFilla': np.empty(num_pixels), 'WFillb': np.empty(num_pixels)}
+    indexes = np.arange(len(landuses))
+    fill_index = landuses.index('Irrigated') if wateruse else -1
+    transpiration_water_stress(indexes, indexes, fill_index, stress_days, soil['DtDay'], soil['InvDtDay'], soil['ETRef'],
+                               soil['isFrozenSoil'], soil['CropGroupNumber'], soil['WFC1'], soil['WWP1'],
+                               soil['WFC1a'], soil['WWP1a'], soil['WFC1b'], soil['WWP1b'], soil['WPF3a'], soil['WPF3b'],
+                               soil['potential_transpiration'], out['RWS'], out['Ta'], out['SoilMoistureStressDays'],
+                               out['W1a'], out['W1b'], out['W1'], out['WFilla'], out['WFillb'])
+    return out
+
+
+LANDUSES = ['Rainfed', 'Forest', 'Irrigated']
+
+
+class TestTranspirationWaterStress(object):
+
+    @pytest.mark.parametrize('wateruse,stress_days', [(True, True), (False, False)])
+    def test_same_as_reference(self, wateruse, stress_days):
+        soil = synthetic_soil(1000)
+        kernel = kernel_transpiration(soil, LANDUSES, wateruse, stress_days)
+        if not wateruse:
+            del kernel['WFilla'], kernel['WFillb']
+        assert_same_as_reference('transpiration_{}_{}'.format('wateruse' if wateruse else 'nowateruse',
+                                                               'stressdays' if stress_days else 'nostressdays'), kernel)
+        # transpiration only from water above the wilting point, none from frozen soils
+        assert (kernel['Ta'][:, soil['isFrozenSoil']] == 0).all()
+        assert np.allclose(soil['W1'] - kernel['W1'], kernel['Ta'])
+
+
+@pytest.mark.slow
+class TestTranspirationWaterStressBenchmark(object):
+
+    @pytest.mark.parametrize('num_pixels', [10**5, 10**6])
+    def test_benchmark(self, num_pixels, num_steps=10):
+        soil = synthetic_soil(num_pixels)
+        elapsed = time_per_step(lambda: kernel_transpiration(soil, LANDUSES), num_steps)
+        print('{} pixels: transpiration_water_stress {:.1f} ms/step'.format(num_pixels, elapsed))
+
+
+def pixel_averages(SoilFraction, variables, TASealedAll, EWaterAll, cumulated):
+    num_pixels = SoilFraction.shape[1]
+    averages = tuple(np.zeros(num_pixels) for _ in variables)
+    soilPixelAverages(np.broadcast_to(SoilFraction, variables[0].shape), variables, averages,
+                      np.broadcast_to(TASealedAll, num_pixels), np.broadcast_to(EWaterAll, num_pixels), *cumulated)
+    return averages
+
+
+class TestSoilPixelAverages(object):
+
+    def test_same_as_reference(self):
+        rng = np.random.RandomState(0)
+        num_pixels = 1000
+        # soil fractions as read by landusechange (transposed DataFrame values, not C-contiguous)
+        SoilFraction = rng.rand(num_pixels, 3).T
+        variables = tuple(rng.rand(3, num_pixels) for _ in range(11))
+        TASealedAll, EWaterAll = rng.rand(num_pixels), 0.
+        cumulated = [rng.rand(num_pixels) for _ in range(3)]
+        averages = pixel_averages(SoilFraction, variables, TASealedAll, EWaterAll, cumulated)
+        assert_same_as_reference('pixel_averages', {'averages': np.array(averages), 'cumulated': np.array(cumulated)})
+
+    def test_total_soil_fraction(self):
+        # one soil fraction per pixel (total of the fractions, variable water fraction)
+        rng = np.random.RandomState(1)
+        num_pixels = 100
+        SoilFraction = rng.rand(num_pixels)
+        variables = tuple(rng.rand(3, num_pixels) for _ in range(11))
+        cumulated = [np.zeros(num_pixels) for _ in range(3)]
+        averages = pixel_averages(SoilFraction[None], variables, 0., 0., cumulated)
+        assert np.array_equal(averages[4], _vegSum(0, variables[4], SoilFraction))
+
+
+SOIL_COLUMNS_ARGS = ['index_landuse_all', 'is_irrigated', 'is_paddy_irrig', 'paddy_inactive', 'DtDay',
+                     'AvailableWaterForInfiltration', 'Rain', 'SnowMelt', 'LeafDrainage', 'Interception', 'DSLR',
+                     'AvWaterThreshold', 'ESAct', 'ESMax', 'isFrozenSoil', 'b_Xinanjiang', 'StoreMaxPervious', 'PowerInfPot',
+                     'PrefFlow', 'PowerPrefFlow', 'Infiltration', 'CourantCrit',
+                     'PoreSpaceNotZero1a', 'PoreSpaceNotZero1b', 'PoreSpaceNotZero2', 'KSat1a', 'KSat1b', 'KSat2',
+                     'GenuInvM1a', 'GenuInvM1b', 'GenuInvM2', 'GenuM1a', 'GenuM1b', 'GenuM2',
+                     'W1a', 'W1b', 'W1', 'W2', 'Theta1a', 'Theta1b', 'Theta2', 'Sat1a', 'Sat1b', 'Sat1', 'Sat2',
+                     'SeepTopToSubA', 'SeepTopToSubB', 'SeepSubToGW', 'WRes1a', 'WRes1b', 'WRes1', 'WRes2',
+                     'WWP1a', 'WWP1b', 'WWP1', 'WWP2', 'WFC1a', 'WFC1b', 'WFC1', 'WFC2',
+                     'SoilDepth1a', 'SoilDepth1b', 'SoilDepth2', 'WS1a', 'WS1b', 'WS1', 'WS2',
+                     'UpperZoneK', 'DrainedFraction', 'GwPercStep', 'UZOutflow', 'UZ', 'GwPercUZLZ']
+SOIL_COLUMNS_STATES = ['AvailableWaterForInfiltration', 'DSLR', 'ESAct', 'PrefFlow', 'Infiltration', 'W1a', 'W1b', 'W1', 'W2',
+                       'Theta1a', 'Theta1b', 'Theta2', 'Sat1a', 'Sat1b', 'Sat1', 'Sat2',
+                       'SeepTopToSubA', 'SeepTopToSubB', 'SeepSubToGW', 'UZOutflow', 'UZ', 'GwPercUZLZ']
+
+
+def synthetic_soil_columns(num_pixels, wet=True, paddy=False, seed=0):
+    """Random soil columns of the Rainfed, Forest and Irrigated fractions (and two paddy rice fractions if paddy, the first
+    one inactive on part of the pixels, the second one active everywhere). On wet days soils are close to saturation
+    and it rains: pixels with high conductivity need many sub-steps. On dry days soils are close to the wilting point."""
+    rng = np.random.RandomState(seed)
+    num_landuses = 3
+    num_vegs = 5 if paddy else 3
+    landuse_shape, veg_shape = (num_landuses, num_pixels), (num_vegs, num_pixels)
+    soil = {'index_landuse_all': np.array([0, 1, 2, 2, 2][:num_vegs]), 'is_irrigated': np.array([False, False, True, True, True][:num_vegs]),
+            'is_paddy_irrig': np.array([False, False, False, True, True][:num_vegs]), 'DtDay': 1., 'AvWaterThreshold': 5.,
+            'CourantCrit': 0.4, 'DrainedFraction': 0.3}
+    inactive = rng.rand(num_pixels) < 0.5
+    soil['paddy_inactive'] = np.array([inactive, np.zeros(num_pixels, bool)]) if paddy else np.zeros((1, num_pixels), bool)
+    for layer, depth in (('1a', 50.), ('1b', 250.), ('2', 1000.)):
+        soil['SoilDepth' + layer] = depth * rng.uniform(0.5, 1.5, landuse_shape)
+        soil['WS' + layer] = rng.uniform(0.4, 0.5, landuse_shape) * soil['SoilDepth' + layer]
+        soil['WRes' + layer] = rng.uniform(0.02, 0.08, landuse_shape) * soil['SoilDepth' + layer]
+        soil['WFC' + layer] = rng.uniform(0.25, 0.35, landuse_shape) * soil['SoilDepth' + layer]
+        soil['WWP' + layer] = rng.uniform(0.1, 0.15, landuse_shape) * soil['SoilDepth' + layer]
+        soil['PoreSpaceNotZero' + layer] = rng.rand(*landuse_shape) > 0.01
+        soil['KSat' + layer] = 10 ** rng.uniform(0.5, 3, landuse_shape)
+        soil['GenuM' + layer] = rng.uniform(0.15, 0.5, landuse_shape)
+        soil['GenuInvM' + layer] = 1 / soil['GenuM' + layer]
+        low, high = (soil['WFC' + layer], soil['WS' + layer]) if wet else (soil['WRes' + layer], soil['WWP' + layer])
+        soil['W' + layer] = (low + rng.rand(*landuse_shape) * (high - low))[soil['index_landuse_all']]
+    for name in ('WS', 'WRes', 'WFC', 'WWP'):
+        soil[name + '1'] = soil[name + '1a'] + soil[name + '1b']
+    soil['W1'] = soil['W1a'] + soil['W1b']
+    soil['StoreMaxPervious'] = soil['WS1'] - soil['WRes1']
+    soil['Rain'] = rng.uniform(0, 60, num_pixels) if wet else np.zeros(num_pixels)
+    soil['SnowMelt'] = np.zeros(num_pixels)
+    soil['LeafDrainage'], soil['Interception'] = rng.uniform(0, 2, veg_shape), rng.uniform(0, 2, veg_shape)
+    soil['DSLR'] = rng.uniform(1, 10, veg_shape)
+    soil['ESMax'] = rng.uniform(0, 4, veg_shape)
+    soil['isFrozenSoil'] = rng.rand(num_pixels) < 0.05
+    soil['b_Xinanjiang'], soil['PowerInfPot'], soil['PowerPrefFlow'] = rng.uniform(0.1, 0.5, num_pixels), np.full(num_pixels, 2.), np.full(num_pixels, 3.)
+    soil['UpperZoneK'], soil['GwPercStep'] = rng.uniform(0.01, 0.5, num_pixels), rng.uniform(0.1, 2, num_pixels)
+    soil['UZ'] = rng.uniform(0, 20, veg_shape)
+    for name in SOIL_COLUMNS_STATES:
+        if name not in soil:
+            soil[name] = np.zeros(veg_shape)
+    return soil
+
+
+def soil_columns(soil, scratch=None):
+    """Run soilColumnsWaterBalance on a copy of soil: new states"""
+    soil = dict((name, value.copy() if name in SOIL_COLUMNS_STATES else value) for name, value in soil.items())
+    num_vegs, num_pixels = soil['W1a'].shape
+    if scratch is None:
+        scratch = (np.empty((8, num_vegs, num_pixels)), np.empty((num_vegs, num_pixels), np.int64),
+                   np.empty(num_vegs * num_pixels, np.int64))
+    soilColumnsWaterBalance(*([soil[name] for name in SOIL_COLUMNS_ARGS] + list(scratch) + [get_num_threads()]))
+    return soil
+
+
+class TestSoilColumnsWaterBalance(object):
+
+    @pytest.mark.parametrize('wet,paddy', [(True, False), (False, False), (True, True)])
+    def test_same_as_reference(self, wet, paddy):
+        soil = synthetic_soil_columns(500, wet, paddy)
+        kernel = soil_columns(soil)
+        assert_same_as_reference('soil_columns_{}{}'.format('wet' if wet else 'dry', '_paddy' if paddy else ''),
+                                 dict((name, kernel[name]) for name in SOIL_COLUMNS_STATES))
+        if paddy:
+            # active paddy pixels are not simulated
+            assert np.array_equal(kernel['W1a'][3, ~soil['paddy_inactive'][0]], soil['W1a'][3, ~soil['paddy_inactive'][0]])
+            assert np.array_equal(kernel['W1a'][4], soil['W1a'][4])
+
+    def test_schedule(self):
+        rng = np.random.RandomState(0)
+        NoSubS = np.where(rng.rand(3, 1000) < 0.9, 1, rng.randint(0, 200, (3, 1000)))
+        order = np.empty(NoSubS.size, np.int64)
+        num_active, chunk_bounds = soilColumnsSchedule(NoSubS, order, 4)
+        active = np.flatnonzero(NoSubS.ravel())
+        assert num_active == active.size
+        assert np.array_equal(np.sort(order[:num_active]), active)
+        # pairs binned by decreasing number of sub-steps, chunks of about the same cost
+        bins = np.log2(NoSubS.ravel()[order[:num_active]]).astype(int)
+        assert (np.diff(bins) <= 0).all()
+        assert chunk_bounds[0] == 0 and chunk_bounds[-1] == num_active and (np.diff(chunk_bounds) >= 0).all()
+        cost = np.array([(NoSubS.ravel()[order[start:stop]] + 1).sum() for start, stop in zip(chunk_bounds[:-1], chunk_bounds[1:])])
+        assert cost.max() - cost.min() <= 2 * (NoSubS.max() + 1)
+
+
+@pytest.mark.slow
+class TestSoilColumnsWaterBalanceBenchmark(object):
+
+    @pytest.mark.parametrize('wet', [True, False])
+    @pytest.mark.parametrize('num_pixels', [10**5, 10**6])
+    def test_benchmark(self, num_pixels, wet, num_steps=5):
+        soil = synthetic_soil_columns(num_pixels, wet)
+        num_vegs = soil['W1a'].shape[0]
+        scratch = (np.empty((8, num_vegs, num_pixels)), np.empty((num_vegs, num_pixels), np.int64),
+                   np.empty(num_vegs * num_pixels, np.int64))
+        elapsed = time_per_step(lambda: soil_columns(soil, scratch), num_steps)
+        NoSubS = scratch[1]
+        print('{} pixels, {} day (sub-steps: mean {:.1f}, max {}): soilColumnsWaterBalance {:.1f} ms/step ({} threads)'.format(
+            num_pixels, 'wet' if wet else 'dry', NoSubS.mean(), NoSubS.max(), elapsed, get_num_threads()))
+
+
+class TestVegetationIndexes(object):
+
+    def test_same_as_labels(self):
+        # vegetation fractions in a different order than the land uses, as with interactive crops
+        model = SimpleNamespace(SOIL_USES=['Rainfed', 'Forest', 'Irrigated'],
+                                PRESCRIBED_VEGETATION=['Rainfed_prescribed', 'Forest_prescribed', 'Irrigated_prescribed'],
+                                prescribed_vegetation=['Rainfed_prescribed', 'Forest_prescribed', 'Irrigated_prescribed'],
+                                vegetation=['Forest_prescribed', 'Rainfed_prescribed', 'Irrigated_prescribed', 'Maize'],
+                                epic_settings=SimpleNamespace(soil_uses=['Rainfed', 'Forest', 'Irrigated']))
+        model.LANDUSE_VEGETATION = OrderedDict([('Rainfed', ['Rainfed_prescribed']), ('Forest', ['Forest_prescribed']),
+                                                ('Irrigated', ['Irrigated_prescribed'])])
+        model.get_indexes_from_landuse_and_veg_list_GLOBAL = \
+            lambda landuse, veg_list: LisfloodModel_ini.get_indexes_from_landuse_and_veg_list_GLOBAL(model, landuse, veg_list)
+        indexes = VegetationIndexes(model)
+        assert indexes.prescribed.tolist() == [1, 0, 2]
+        assert indexes.landuse == OrderedDict([('Rainfed', 0), ('Forest', 1), ('Irrigated', 2)])
+        assert indexes.landuse_vegetation == [([1], [0], 0), ([0], [1], 1), ([2], [2], 2)]
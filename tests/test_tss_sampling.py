@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import os
+import shutil
+
+import numpy as np
+from netCDF4 import Dataset
+
+from lisfloodutilities.compare.pcr import TSSComparator
+
+from lisflood.main import lisfloodexe
+from lisflood.global_modules.add1 import decompress
+from lisflood.global_modules.zusatz import TimeoutputTimeseries
+
+from .test_utils import setoptions, mk_path_out, ETRS89TestCase
+
+
+def pcraster_sample(tss, values):
+    """Sampling of time series through PCRaster maps (areaaverage over the IDs of the output points)"""
+    tss.sample(decompress(values))
+
+
+class TestTssSampling(ETRS89TestCase):
+    case_dir = os.path.join(os.path.dirname(__file__), 'data', 'LF_ETRS89_UseCase')
+    settings_file = os.path.join(case_dir, 'settings', 'full.xml')
+    out_dir_a = os.path.join(case_dir, 'out', 'a')
+    out_dir_b = os.path.join(case_dir, 'out', 'b')
+
+    def run(self, path_out, out_dir, maps=(), **tss_options):
+        # time series at gauges and sites, upstream averages ('total') and catchment averages (mass balance)
+        vars_to_set = {'StepStart': '30/07/2016 06:00', 'StepEnd': '01/09/2016 06:00', 'DtSec': '86400', 'PathOut': path_out}
+        vars_to_set.update(tss_options)
+        settings = setoptions(self.settings_file,
+                              opts_to_set=('repDischargeTs', 'repStateSites', 'repStateUpsGauges', 'repRateUpsGauges',
+                                           'repMBTs') + tuple(maps),
+                              vars_to_set=vars_to_set)
+        mk_path_out(out_dir)
+        lisfloodexe(settings)
+
+    def test_same_as_pcraster(self, mocker):
+        self.run('$(PathRoot)/out/a', self.out_dir_a)
+        mocker.patch.object(TimeoutputTimeseries, 'sampleCompressed', pcraster_sample)
+        # steps written every 7 steps, through the buffer of sample
+        self.run('$(PathRoot)/out/b', self.out_dir_b, TssFlushSteps='7')
+
+        comparator = TSSComparator()
+        tss_files = [f for f in os.listdir(self.out_dir_a) if f.endswith('.tss')]
+        assert tss_files
+        for tss_file in tss_files:
+            comparator.compare_files(os.path.join(self.out_dir_b, tss_file), os.path.join(self.out_dir_a, tss_file))
+
+    def test_streaming(self):
+        self.run('$(PathRoot)/out/a', self.out_dir_a, TssFlushSteps='0')
+        self.run('$(PathRoot)/out/b', self.out_dir_b, TssFlushSteps='7')
+
+        for tss_file in [f for f in os.listdir(self.out_dir_a) if f.endswith('.tss')]:
+            # same files, but for the creation date in the header
+            with open(os.path.join(self.out_dir_a, tss_file)) as tss_a, open(os.path.join(self.out_dir_b, tss_file)) as tss_b:
+                assert tss_a.readlines()[1:] == tss_b.readlines()[1:]
+
+    def test_netcdf_format(self):
+        self.run('$(PathRoot)/out/a', self.out_dir_a)
+        self.run('$(PathRoot)/out/b', self.out_dir_b, TssFlushSteps='7', TssFormat='netcdf')
+
+        with open(os.path.join(self.out_dir_a, 'disWin.tss')) as tss_file:
+            lines = tss_file.readlines()
+        num_points = int(lines[1]) - 1
+        tss = np.loadtxt(lines[3 + num_points:], ndmin=2)
+        tss[tss == 1e31] = np.nan
+        with Dataset(os.path.join(self.out_dir_b, 'disWin.tss.nc')) as nc:
+            assert np.array_equal(nc.variables['time'][:], tss[:, 0])
+            assert np.allclose(nc.variables['disWin'][:].filled(np.nan), tss[:, 1:], rtol=1e-5, equal_nan=True)
+
+    def test_netcdf_format_with_maps(self):
+        # map stack dis.nc and time series dis.tss.nc, from DischargeMaps and DisTS of the same name
+        self.run('$(PathRoot)/out/b', self.out_dir_b, maps=('repDischargeMaps',), TssFormat='netcdf',
+                 DisTS='$(PathOut)/dis.tss')
+
+        with Dataset(os.path.join(self.out_dir_b, 'dis.nc')) as nc:
+            assert 'point' not in nc.dimensions and nc.variables['dis'].dimensions[0] == 'time'
+        with Dataset(os.path.join(self.out_dir_b, 'dis.tss.nc')) as nc:
+            assert nc.variables['dis'].dimensions == ('time', 'point')
+
+    def teardown_method(self):
+        print('Cleaning directories')
+        shutil.rmtree(self.out_dir_a, ignore_errors=True)
+        shutil.rmtree(self.out_dir_b, ignore_errors=True)